@@ -0,0 +1,94 @@
+import json
+import base64
+import binascii
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import QuerySet
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Pages of rows ordered by field and id, next page starts after (field, id) of the last row of page.
+
+    Unlike offset pagination, rows of previous pages are not scanned and rows are not counted, so every page
+    is read from index (e.g. transaction_card_created_idx) with the same speed. Response has only link to next page.
+    Ordering is chosen by ?ordering= from orderings, cursor is valid only for ordering of its link.
+
+    """
+
+    page_size = 10
+    max_page_size = 100
+    page_size_query_param = "limit"
+    cursor_query_param = "cursor"
+    ordering_query_param = "ordering"
+    orderings = ("-created", "created", "-amount", "amount")  # the first one is default
+
+    def paginate_queryset(self, queryset: QuerySet, request: Request, view=None) -> list:
+        self.request = request
+        page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request)
+        field = self.ordering.lstrip("-")
+        descending = self.ordering.startswith("-")
+        queryset = queryset.order_by(self.ordering, "-id" if descending else "id")
+
+        cursor = self.decode_cursor(request, queryset.model)
+        if cursor is not None:
+            value, pk = cursor
+            # field <= cursor (or >=) is range of index, rows with the same value are compared by id
+            if descending:
+                queryset = queryset.filter(**{f"{field}__lte": value}).exclude(**{field: value, "id__gte": pk})
+            else:
+                queryset = queryset.filter(**{f"{field}__gte": value}).exclude(**{field: value, "id__lte": pk})
+
+        rows = list(queryset[: page_size + 1])  # one more row tells that there is next page
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.last_row = rows[-1] if rows else None
+        return rows
+
+    def get_paginated_response(self, data) -> Response:
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema: dict) -> dict:
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {"next": {"type": "string", "nullable": True, "format": "uri"}, "results": schema},
+        }
+
+    def get_page_size(self, request: Request) -> int:
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering(self, request: Request) -> str:
+        ordering = request.query_params.get(self.ordering_query_param, self.orderings[0])
+        if ordering not in self.orderings:
+            raise ValidationError(f"Error. Ordering should be one of: {', '.join(self.orderings)}")
+        return ordering
+
+    def get_next_link(self) -> str | None:
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last_row))
+
+    def encode_cursor(self, row) -> str:
+        value = json.dumps([str(getattr(row, self.ordering.lstrip("-"))), row.id])
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    def decode_cursor(self, request: Request, model) -> tuple | None:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            return model._meta.get_field(self.ordering.lstrip("-")).to_python(value), int(pk)
+        except (binascii.Error, ValueError, TypeError, DjangoValidationError):
+            raise NotFound("Error. Invalid cursor")
@@ -1,12 +1,30 @@
 import random
 from decimal import Decimal
+from datetime import timedelta
+from unittest.mock import patch
 
 from rest_framework.authtoken.models import Token
+from django.db import connection
 from django.test import TestCase, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from .views import GetCardBalance
-from database_models.models import Transaction, Receipt, Profile, Card, Company, IncreaseBalanceRequest
+from database_models.receipt_rendering import render_receipt
+from database_models.ledger import get_ledger_balance, card_account, company_account, EXTERNAL_ACCOUNT
+from database_models.serializers import CompanySerializer
+from database_models.models import (
+    Transaction,
+    Receipt,
+    Profile,
+    Card,
+    Company,
+    CompanyBalanceShard,
+    IncreaseBalanceRequest,
+    Notification,
+    LedgerEntry,
+)
 
 
 def do_user_login(email: str, password: str, username: str = "testname") -> tuple[User, str]:
@@ -268,6 +286,16 @@ class IncreaseCardBalanceTestCase(TestCase):
         card = cards.first()
         self.assertEqual(card.balance, Decimal(10))
 
+    def test_top_up_written_to_ledger(self):
+        headers = {"Authorization": f"Token {self.user_token}"}
+
+        body = {"card_number": self.card.card_number, "amount": 10}
+
+        self.client.post(self.url, body, headers=headers)
+        self.assertEqual(get_ledger_balance(card_account(self.card.id)), Decimal(10))
+        self.assertEqual(get_ledger_balance(EXTERNAL_ACCOUNT), Decimal(-10))
+        self.assertEqual(LedgerEntry.objects.filter(kind="card_top_up").count(), 2)
+
 
 class IncreaseCompanyBalanceTestCase(TestCase):
     def setUp(self):
@@ -305,7 +333,8 @@ class IncreaseCompanyBalanceTestCase(TestCase):
         self.assertNotEqual(companies.count(), 0)
 
         company = companies.first()
-        self.assertEqual(company.balance, Decimal(10))
+        self.assertEqual(company.get_balance(), Decimal(10))
+        self.assertEqual(get_ledger_balance(company_account(company.id)), Decimal(10))
 
 
 class GetCardBalanceTestCase(TestCase):
@@ -381,6 +410,327 @@ class GetUserTransactionsTestCase(TestCase):
         response_body = response.json()
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response_body["results"]), 5)
+        self.assertEqual(response_body["results"][0]["card"]["_card_number"], self.card.card_number)
+        self.assertIsNone(response_body["next"])
+
+    def test_queries_do_not_grow_with_page(self):
+        headers = {"Authorization": f"Token {self.user_token}"}
+        with CaptureQueriesContext(connection) as small_page:
+            self.assertEqual(self.client.get(self.url, {"limit": 1}, headers=headers).status_code, 200)
+        with CaptureQueriesContext(connection) as full_page:
+            self.assertEqual(self.client.get(self.url, {"limit": 5}, headers=headers).status_code, 200)
+        with CaptureQueriesContext(connection) as flat_page:
+            self.assertEqual(self.client.get(self.url, {"shape": "flat"}, headers=headers).status_code, 200)
+        self.assertEqual(len(full_page), len(small_page))
+        self.assertEqual(len(full_page), 3)  # token, page and shards of company balances
+        self.assertEqual(len(flat_page), 2)
+        self.assertNotIn("OFFSET", full_page[1]["sql"])
+        self.assertNotIn("COUNT", full_page[1]["sql"])
+        for page in (full_page, flat_page):
+            self.assertNotIn("_company_token", page[1]["sql"])
+        self.assertNotIn("_card_uid", flat_page[1]["sql"])
+
+    def test_company_balance_includes_shards(self):
+        company = Company.objects.get(name="Store")
+        company._balance = Decimal(100)
+        company.save()
+        CompanyBalanceShard.objects.create(company=company, shard=2, _balance=Decimal("7.50"))
+
+        response = self.client.get(self.url, {"limit": 1}, headers={"Authorization": f"Token {self.user_token}"})
+        self.assertEqual(response.json()["results"][0]["company"]["_balance"], "107.50")
+        company = Company.objects.prefetch_related("balance_shards").get(id=company.id)
+        self.assertEqual(CompanySerializer(company).data["_balance"], "107.50")
+
+    def test_keyset_pages(self):
+        headers = {"Authorization": f"Token {self.user_token}"}
+        transactions = list(Transaction.objects.order_by("-created", "-id"))
+        Transaction.objects.filter(pk__in=[t.pk for t in transactions[1:4]]).update(created=transactions[2].created)
+        expected = list(Transaction.objects.order_by("-created", "-id").values_list("receipt_id", flat=True))
+
+        received = []
+        params = {"limit": 2, "shape": "flat"}
+        url = self.url
+        while url:
+            response_body = self.client.get(url, params, headers=headers).json()
+            self.assertLessEqual(len(response_body["results"]), 2)
+            received += [transaction["receipt_id"] for transaction in response_body["results"]]
+            url, params = response_body["next"], None
+        self.assertEqual(received, expected)
+
+    def test_flat_shape(self):
+        headers = {"Authorization": f"Token {self.user_token}"}
+        response = self.client.get(self.url, {"shape": "flat", "limit": 1}, headers=headers)
+        transaction = Transaction.objects.order_by("-created", "-id").first()
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {
+                    "id": transaction.id,
+                    "amount": f"{transaction.amount:.2f}",
+                    "card_number": self.card.card_number,
+                    "company_name": "Store",
+                    "receipt_id": transaction.receipt_id,
+                    "receipt_img": None,
+                    "receipt_render_status": "pending",
+                    "card_balance_after": f"{transaction.card_balance_after:.2f}",
+                    "created": transaction.created.isoformat().replace("+00:00", "Z"),
+                }
+            ],
+        )
+
+    def test_invalid_cursor(self):
+        headers = {"Authorization": f"Token {self.user_token}"}
+        response = self.client.get(self.url, {"cursor": "not-a-cursor"}, headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_other_user_transactions(self):
+        _, other_user_token = do_user_login("other@gmail.com", "password1213", username="othername")
+        response = self.client.get(self.url, headers={"Authorization": f"Token {other_user_token}"})
+        self.assertEqual(response.json()["results"], [])
+
+
+class TransactionSearchTestCase(TestCase):
+    """Filters of get_user_transactions on seeded transactions of many users, their pages have to be read
+    from indexes, not by sequential scan of transactions table
+
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.user_token = do_user_login("test@gmail.com", "password1213")
+        profiles = [cls.user.profile]
+        for number in range(1, 20):
+            user = User.objects.create(username=f"user{number}", email=f"user{number}@gmail.com")
+            profiles.append(Profile.objects.create(user=user))
+        cards = Card.objects.bulk_create(
+            Card(owner=profile, _card_number=f"{number:016d}", _card_uid=f"{number:08x}")
+            for number, profile in enumerate(profiles * 2)
+        )
+        companies = Company.objects.bulk_create(Company(name=f"Store {number}") for number in range(8))
+        receipts = Receipt.objects.bulk_create(Receipt(render_status="on_demand") for _ in range(len(cards) * 100))
+        Transaction.objects.bulk_create(
+            Transaction(
+                card=cards[number % len(cards)], company=companies[number % 7], receipt=receipt, amount=number % 50
+            )
+            for number, receipt in enumerate(receipts)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE database_models_transaction SET created = now() - (id % 90) * interval '1 day'")
+            cursor.execute("ANALYZE database_models_transaction")
+        cls.card = cards[0]
+        cls.transactions = Transaction.objects.filter(card__owner=cls.user.profile)
+
+    def setUp(self):
+        self.client = Client()
+        self.url = "/client_api/get_user_transactions/"
+        self.headers = {"Authorization": f"Token {self.user_token}"}
+
+    def get_all(self, params: dict) -> list[int]:
+        """Receipt ids of all pages"""
+        received = []
+        url, params = self.url, {"shape": "flat", "limit": 100, **params}
+        while url:
+            response = self.client.get(url, params, headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            received += [transaction["receipt_id"] for transaction in response.json()["results"]]
+            url, params = response.json()["next"], None
+        return received
+
+    def get_plan(self, params: dict) -> dict:
+        """Plan of page query of request"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, {"shape": "flat", **params}, headers=self.headers)
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {queries[-1]['sql']}")
+            return cursor.fetchone()[0][0]["Plan"]
+
+    def get_nodes(self, plan: dict) -> list[dict]:
+        nodes = [plan]
+        for subplan in plan.get("Plans", []):
+            nodes += self.get_nodes(subplan)
+        return nodes
+
+    def test_filters(self):
+        month_ago = timezone.localdate() - timedelta(days=30)
+        expected = self.transactions.filter(
+            company__name="Store 3", created__date__gte=month_ago, amount__gte=10, amount__lte=40
+        ).order_by("amount", "id")
+        params = {
+            "company": "Store 3",
+            "created_from": month_ago.isoformat(),
+            "amount_min": "10",
+            "amount_max": "40",
+            "ordering": "amount",
+        }
+        self.assertEqual(self.get_all(params), list(expected.values_list("receipt_id", flat=True)))
+        self.assertGreater(expected.count(), 0)
+
+    def test_card_and_date_range(self):
+        created_to = timezone.localdate() - timedelta(days=10)
+        expected = self.transactions.filter(card=self.card, created__date__lte=created_to).order_by("created", "id")
+        params = {"card_number": self.card.card_number, "created_to": created_to.isoformat(), "ordering": "created"}
+        self.assertEqual(self.get_all(params), list(expected.values_list("receipt_id", flat=True)))
+
+    def test_orderings(self):
+        for ordering in ("-created", "created", "-amount", "amount"):
+            expected = self.transactions.order_by(ordering, "-id" if ordering.startswith("-") else "id")
+            self.assertEqual(
+                self.get_all({"ordering": ordering, "limit": 30}), list(expected.values_list("receipt_id", flat=True))
+            )
+
+    def test_invalid_params(self):
+        for params in ({"created_from": "yesterday"}, {"amount_min": "ten"}, {"amount_max": "NaN"}, {"ordering": "id"}):
+            response = self.client.get(self.url, params, headers=self.headers)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(response.json()["success"])
+
+    def test_no_sequential_scans(self):
+        month_ago = (timezone.localdate() - timedelta(days=30)).isoformat()
+        searches = [
+            {},
+            {"ordering": "created"},
+            {"card_number": self.card.card_number},
+            {"company": "Store 3", "created_from": month_ago},
+            {"amount_min": "10", "amount_max": "20", "ordering": "-amount"},
+            {"card_number": self.card.card_number, "company": "Store 1", "created_from": month_ago},
+        ]
+        for params in searches:
+            with self.subTest(**params):
+                scans = [
+                    (node["Node Type"], node.get("Relation Name")) for node in self.get_nodes(self.get_plan(params))
+                ]
+                self.assertNotIn(("Seq Scan", "database_models_transaction"), scans)
+                self.assertIn("database_models_transaction", [relation for _, relation in scans])
+
+    def test_company_month_is_index_range(self):
+        month_ago = (timezone.localdate() - timedelta(days=30)).isoformat()
+        params = {"card_number": self.card.card_number, "company": "Store 1", "created_from": month_ago}
+        index_scans = [
+            node for node in self.get_nodes(self.get_plan(params)) if "transaction_" in node.get("Index Name", "")
+        ]
+        self.assertEqual(len(index_scans), 1)
+        self.assertEqual(index_scans[0]["Index Name"], "transaction_card_company_idx")
+        self.assertIn("company_id =", index_scans[0]["Index Cond"])
+        self.assertIn("created >=", index_scans[0]["Index Cond"])
+
+
+class GetReceiptStatusTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+
+        self.user, self.user_token = do_user_login("test@gmail.com", "password1213")
+        self.card = Card.objects.create(owner=self.user.profile)
+        self.card.card_uid = "e3a333b3"
+        self.card.generate_card_number()
+        self.card.save()
+
+        company = Company(name="Store")
+        company.save()
+        self.receipt = Receipt.objects.create()
+        Transaction.objects.create(card=self.card, company=company, receipt=self.receipt, amount=5)
+
+        self.url = f"/client_api/get_receipt_status/{self.receipt.id}/"
+
+    def test_incorrect_token(self):
+        headers = {"Authorization": "Token 898w9735bo359"}
+
+        response = self.client.get(self.url, headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_not_owner_request(self):
+        _, other_user_token = do_user_login("other@gmail.com", "password1213", username="othername")
+        headers = {"Authorization": f"Token {other_user_token}"}
+
+        response = self.client.get(self.url, headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_correct_request(self):
+        headers = {"Authorization": f"Token {self.user_token}"}
+
+        response = self.client.get(self.url, headers=headers)
+        response_body = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_body["data"]["id"], self.receipt.id)
+        self.assertEqual(response_body["data"]["render_status"], "pending")
+
+
+class GetReceiptImageTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+
+        self.user, self.user_token = do_user_login("test@gmail.com", "password1213")
+        self.card = Card.objects.create(owner=self.user.profile)
+        self.card.card_uid = "e3a333b3"
+        self.card.generate_card_number()
+        self.card.save()
+
+        company = Company(name="Store", hotline_phone="+380000000000", country="Ukraine", city="Kharkiv")
+        company.save()
+        self.receipt = Receipt.objects.create(render_status="on_demand")
+        Transaction.objects.create(card=self.card, company=company, receipt=self.receipt, amount=5)
+
+        self.url = f"/client_api/get_receipt_image/{self.receipt.id}/"
+        self.headers = {"Authorization": f"Token {self.user_token}"}
+
+    def tearDown(self):
+        self.receipt.refresh_from_db()
+        if self.receipt.img:
+            self.receipt.img.delete(save=False)
+            self.receipt.preview.delete(save=False)
+
+    def test_not_owner_request(self):
+        _, other_user_token = do_user_login("other@gmail.com", "password1213", username="othername")
+        response = self.client.get(self.url, headers={"Authorization": f"Token {other_user_token}"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_rendered_on_first_request(self):
+        response = self.client.get(self.url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("private", response["Cache-Control"])
+        self.assertTrue(response["ETag"])
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"\xff\xd8"))  # jpeg header
+
+        self.receipt.refresh_from_db()
+        self.assertEqual(self.receipt.render_status, "ready")
+        self.assertEqual(self.receipt.data["amount"], "5.00")
+        self.assertEqual(self.receipt.get_receipt_data()["body"]["amount"].data, Decimal(5))
+
+    def test_preview(self):
+        image_etag = self.client.get(self.url, headers=self.headers)["ETag"]
+        response = self.client.get(f"{self.url}?preview=1", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertNotEqual(response["ETag"], image_etag)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"\x89PNG"))
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url, headers=self.headers)["ETag"]
+        with patch.object(Receipt, "_generate_receipt_img") as generate_receipt_img:
+            response = self.client.get(self.url, headers={**self.headers, "If-None-Match": etag})
+        generate_receipt_img.assert_not_called()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+    def test_claimed_receipt_rendered_once(self):
+        Receipt.objects.filter(id=self.receipt.id).update(render_status="rendering")
+        response = self.client.get(self.url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        self.receipt.refresh_from_db()
+        with patch.object(Receipt, "_generate_receipt_img") as generate_receipt_img:
+            status = render_receipt(self.receipt.id)
+        generate_receipt_img.assert_not_called()
+        self.assertEqual(status, "ready")
+        self.assertEqual(Receipt.objects.get(id=self.receipt.id).img, self.receipt.img)
+
+    def test_render_error(self):
+        with patch.object(Receipt, "_generate_receipt_img", return_value=("", "")):
+            response = self.client.get(self.url, headers=self.headers)
+        self.assertEqual(response.status_code, 500)
+        self.receipt.refresh_from_db()
+        self.assertEqual(self.receipt.render_status, "failed")
 
 
 class CreateIncreaseBalanceRequestTestCase(TestCase):
@@ -514,6 +864,22 @@ class ConsiderIncreaseBalanceRequestsTestCase(TestCase):
 
         self.card = Card.objects.first()
         self.assertEqual(self.card.balance, Decimal(100))
+        self.assertEqual(get_ledger_balance(card_account(self.card.id)), Decimal(100))
+
+    def test_request_accepted_once(self):
+        self.user.profile.role = "admin"
+        self.user.profile.save()
+
+        headers = {"Authorization": f"Token {self.user_token}"}
+
+        body = {"request_id": self.balance_request.id, "status": "accepted"}
+
+        self.assertEqual(self.client.post(self.url, headers=headers, data=body).status_code, 200)
+        self.assertEqual(self.client.post(self.url, headers=headers, data=body).status_code, 404)
+
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(100))
+        self.assertEqual(LedgerEntry.objects.filter(kind="balance_request").count(), 2)
 
 
 class GetUserCardsTestCase(TestCase):
@@ -545,6 +911,31 @@ class GetUserCardsTestCase(TestCase):
         self.assertEqual(len(response_body["data"]), 1)
 
 
+class SendUserAnalyticsTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = "/client_api/send_user_analytics/"
+
+        self.admin, _ = do_user_login("admin@gmail.com", "password1213", username="admin")
+        self.admin.profile.role = "admin"
+        self.admin.profile.telegram_chat_id = "2222222"
+        self.admin.profile.save()
+
+    def test_incorrect_method(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 405)
+
+    def test_correct_request(self):
+        body = {"user_full_name": "Bob Smith", "username": "bob", "telegram_user_id": 1, "telegram_chat_id": 3333333}
+
+        response = self.client.post(self.url, body, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+        notification = Notification.objects.get()
+        self.assertEqual(notification.telegram_chat_id, "2222222")
+        self.assertIn("Bob Smith", notification.text)
+
+
 # class GetUserCardsReceiptsTestCase(TestCase):
 #     def setUp(self):
 #         self.client = Client()
@@ -14,6 +14,8 @@ urlpatterns = [
     path("increase_company_balance/", views.IncreaseCompanyBalance.as_view()),
     # path("get_receipts_by_cards/", views.GetUserCardsReceipts.as_view()),
     path("get_user_transactions/", views.GetUserTransactions.as_view()),
+    path("get_receipt_status/<int:receipt_id>/", views.GetReceiptStatus.as_view()),
+    path("get_receipt_image/<int:receipt_id>/", views.GetReceiptImage.as_view()),
     path("create_increase_balance_request/", views.CreateIncreaseBalanceRequest.as_view()),
     path("get_increase_balance_requests/", views.GetIncreaseBalanceRequests.as_view()),
     path("consider_increase_balance_request/", views.ConsiderIncreaseBalanceRequests.as_view()),
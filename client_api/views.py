@@ -1,22 +1,47 @@
 import json
+import mimetypes
 import logging
-from decimal import Decimal
-from multiprocessing import Process
-
-from django.http import JsonResponse
+from decimal import Decimal, InvalidOperation
+from datetime import datetime, time, timedelta
+
+from django.db import transaction as django_transaction
+from django.http import FileResponse, HttpResponseNotModified, JsonResponse
+from django.http.response import HttpResponseBase
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import parse_etags
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView
-from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.core.exceptions import ObjectDoesNotExist
 
-from database_models.models import Card, Profile, Company, Transaction, IncreaseBalanceRequest
+from database_models.models import (
+    Card,
+    Profile,
+    Company,
+    Receipt,
+    Transaction,
+    IncreaseBalanceRequest,
+    Notification,
+    LedgerEntry,
+)
+from database_models.balances import top_up_card, top_up_company
 from database_models.utils import check_hex_digit
-from database_models.serializers import CardSerializer, TransactionSerializer, IncreaseBalanceRequestSerializer
-from telegram_bot.bot_send_receipt import run_async_send_message_in_process
+from database_models.serializers import (
+    CardSerializer,
+    ReceiptSerializer,
+    TransactionSerializer,
+    FlatTransactionSerializer,
+    IncreaseBalanceRequestSerializer,
+)
+from .pagination import KeysetPagination
+
+RECEIPT_IMAGE_MAX_AGE = 24 * 60 * 60  # cached copy is revalidated with ETag after a day
 
 
 class IncreaseCardBalance(APIView):
@@ -26,7 +51,7 @@ class IncreaseCardBalance(APIView):
         try:
             card_number = request.data.get("card_number")
             amount = request.data.get("amount", 0)
-            logging.log(logging.INFO, f"Data from request - card_number: {card_number}, amount: {amount}")
+            logging.log(logging.DEBUG, "Data from request - card_number: %s, amount: %s", card_number, amount)
 
             if card_number is None:
                 return Response(data={"success": False, "message": "Error. There is no card_number."}, status=400)
@@ -39,9 +64,8 @@ class IncreaseCardBalance(APIView):
 
             card = cards.first()
             if request.user == card.owner.user:
-                card.balance = card.balance + Decimal(amount)
-                card.save()
-                logging.log(logging.INFO, f"User card balance increased: {card.balance}")
+                balance = top_up_card(card.id, Decimal(amount), LedgerEntry.KINDS["card_top_up"])
+                logging.log(logging.INFO, "User card balance increased: %s", balance)
                 return Response(data={"success": True, "message": ""})
             else:
                 return Response(data={"success": False, "message": "Error. You are not card owner."}, status=403)
@@ -54,7 +78,7 @@ class IncreaseCompanyBalance(APIView):
         try:
             company_token = request.data.get("company_token")
             amount = request.data.get("amount", 0)
-            logging.log(logging.INFO, f"Data from request - company_token: {company_token}, amount: {amount}")
+            logging.log(logging.DEBUG, "Data from request - company_token: %s, amount: %s", company_token, amount)
 
             if company_token is None:
                 return Response(data={"success": False, "message": "Error. There is no company_token."}, status=400)
@@ -66,9 +90,8 @@ class IncreaseCompanyBalance(APIView):
                     status=404,
                 )
             company = companies.first()
-            company.balance = company.balance + Decimal(amount)
-            company.save()
-            logging.log(logging.INFO, f"{company.name} company balance increased: {company.balance}")
+            top_up_company(company.id, Decimal(amount))
+            logging.log(logging.INFO, "%s company balance increased by: %s", company.name, amount)
             return Response(data={"success": True, "message": ""})
         except Exception as ex:
             return Response(data={"success": False, "message": f"Error. {str(ex)}"}, status=500)
@@ -77,7 +100,7 @@ class IncreaseCompanyBalance(APIView):
 class GetCardBalance(APIView):  # inner view
     def get(self, request: Request, card_uid: str) -> Response:
         try:
-            logging.log(logging.INFO, f"Data from url - card_uid: {card_uid}")
+            logging.log(logging.DEBUG, "Data from url - card_uid: %s", card_uid)
 
             if check_hex_digit(card_uid):
                 card = Card.objects.get(_card_uid=card_uid.lower())
@@ -109,14 +132,169 @@ class GetCardBalance(APIView):  # inner view
 
 
 class GetUserTransactions(ListAPIView):
+    """Transactions of user cards, newest first. Next page is given by cursor of "next" link, ?limit=N sets page size.
+    With ?shape=flat transaction is one level object, without card owner and company details.
+
+    Filters: card_number, company (name), created_from and created_to (ISO date or datetime, date of created_to
+    is included), amount_min and amount_max. ?ordering= is one of -created (default), created, -amount, amount.
+    Card, company and date filters are read by range of one index (see Transaction indexes)
+
+    """
+
+    permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    # rows of page and all their related objects are read by one query (and shards of company balance by one
+    # more), only columns of response are read
+    flat_fields = [
+        "amount",
+        "card_balance_after",
+        "created",
+        "card___card_number",
+        "company__name",
+        "receipt__img",
+        "receipt__render_status",
+    ]
+    nested_deferred_fields = [
+        "card___pin_code",
+        "card__owner__user__password",
+        "card__owner__user__last_login",
+        "company___company_token",
+        "receipt__preview",
+    ]
+
+    def is_flat(self) -> bool:
+        return self.request.query_params.get("shape") == "flat"
+
+    def get_serializer_class(self):
+        return FlatTransactionSerializer if self.is_flat() else TransactionSerializer
+
+    def list(self, request: Request, *args, **kwargs) -> Response:
+        try:
+            return super().list(request, *args, **kwargs)
+        except ValidationError as ex:
+            return Response(data={"success": False, "message": str(ex.detail[0])}, status=400)
+
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+        if params.get("card_number"):
+            queryset = queryset.filter(card___card_number=params["card_number"])
+        if params.get("company"):
+            queryset = queryset.filter(company__name=params["company"])
+        if params.get("created_from"):
+            queryset = queryset.filter(created__gte=self.parse_date_param("created_from")[0])
+        if params.get("created_to"):
+            created_to, is_date = self.parse_date_param("created_to")
+            if is_date:
+                queryset = queryset.filter(created__lt=created_to + timedelta(days=1))
+            else:
+                queryset = queryset.filter(created__lte=created_to)
+        if params.get("amount_min"):
+            queryset = queryset.filter(amount__gte=self.parse_amount_param("amount_min"))
+        if params.get("amount_max"):
+            queryset = queryset.filter(amount__lte=self.parse_amount_param("amount_max"))
+        return queryset
+
+    def parse_date_param(self, name: str) -> tuple[datetime, bool]:
+        """Aware datetime of param and whether param is date (its datetime is midnight)"""
+        value = self.request.query_params[name]
+        try:
+            parsed, is_date = parse_date(value), True
+            if parsed is None:
+                parsed, is_date = parse_datetime(value), False
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValidationError(f"Error. {name} should be ISO date or datetime")
+        if is_date:
+            parsed = datetime.combine(parsed, time.min)
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed, is_date
+
+    def parse_amount_param(self, name: str) -> Decimal:
+        try:
+            amount = Decimal(self.request.query_params[name])
+        except InvalidOperation:
+            amount = None
+        if amount is None or not amount.is_finite():
+            raise ValidationError(f"Error. {name} should be number")
+        return amount
+
+    def get_queryset(self):
+        queryset = Transaction.objects.filter(card__owner__user=self.request.user)
+        if self.is_flat():
+            return queryset.select_related("card", "company", "receipt").only(*self.flat_fields)
+        return (
+            queryset.select_related("card__owner__user", "company", "receipt")
+            .prefetch_related("company__balance_shards")
+            .defer(*self.nested_deferred_fields)
+        )
+
+
+class GetReceiptStatus(APIView):
     permission_classes = [IsAuthenticated]
-    queryset = Transaction.objects.all().order_by("-created")
-    serializer_class = TransactionSerializer
-    pagination_class = LimitOffsetPagination
 
-    def get_queryset(self, *args, **kwargs):
-        logging.log(logging.INFO, f"args: {args}, kwargs: {kwargs}")
-        return super().get_queryset(*args, **kwargs).filter(card__owner=self.request.user.profile)
+    def get(self, request: Request, receipt_id: int) -> Response:
+        try:
+            logging.log(logging.DEBUG, "Data from url - receipt_id: %s", receipt_id)
+
+            receipts = Receipt.objects.filter(pk=receipt_id, transaction__card__owner__user=request.user)
+            if receipts.count() == 0:
+                return Response(
+                    data={"success": False, "message": "Error. There is no receipt with this id"}, status=404
+                )
+
+            serializer = ReceiptSerializer(receipts.first())
+            return Response(data={"success": True, "data": serializer.data, "message": ""}, status=200)
+        except Exception as ex:
+            return Response(data={"success": False, "message": f"Error. {str(ex)}"}, status=500)
+
+
+class GetReceiptImage(APIView):
+    """Receipt image (or its small variant with ?preview=1), receipt which was not rendered yet is rendered
+    and stored on the first request.
+
+    Rendered image does not change, so client revalidates its cached copy with If-None-Match and gets 304.
+
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request: Request, receipt_id: int) -> HttpResponseBase:
+        try:
+            logging.log(logging.DEBUG, "Data from url - receipt_id: %s", receipt_id)
+
+            with django_transaction.atomic():
+                # lock, so concurrent requests and render worker (it locks claimed receipt too) render receipt once
+                receipt = (
+                    Receipt.objects.select_for_update(of=("self",))
+                    .select_related("transaction__card", "transaction__company")
+                    .filter(pk=receipt_id, transaction__card__owner__user=request.user)
+                    .first()
+                )
+                if receipt is None:
+                    return Response(
+                        data={"success": False, "message": "Error. There is no receipt with this id"}, status=404
+                    )
+                if not receipt.img:
+                    receipt.get_receipt_img()
+            if not receipt.img:
+                return Response(
+                    data={"success": False, "message": "Error. Receipt image can not be rendered"}, status=500
+                )
+
+            preview = request.query_params.get("preview") == "1"
+            etag = receipt.get_img_etag(preview)
+            if etag in parse_etags(request.headers.get("If-None-Match", "")):
+                response = HttpResponseNotModified()
+            else:
+                image = receipt.get_image(preview)
+                response = FileResponse(image.open("rb"), content_type=mimetypes.guess_type(image.name)[0])
+            response["ETag"] = etag
+            patch_cache_control(response, private=True, max_age=RECEIPT_IMAGE_MAX_AGE)
+            return response
+        except Exception as ex:
+            return Response(data={"success": False, "message": f"Error. {str(ex)}"}, status=500)
 
 
 class CreateIncreaseBalanceRequest(APIView):
@@ -130,8 +308,12 @@ class CreateIncreaseBalanceRequest(APIView):
             message = request.data.get("message")
 
             logging.log(
-                logging.INFO,
-                f"Data from request - card_number: {card_number}, telegram_chat_id: {telegram_chat_id}, amount: {amount}, message: {message}",
+                logging.DEBUG,
+                "Data from request - card_number: %s, telegram_chat_id: %s, amount: %s, message: %s",
+                card_number,
+                telegram_chat_id,
+                amount,
+                message,
             )
 
             cards = Card.objects.filter(owner__user=request.user, _card_number=card_number)
@@ -144,7 +326,7 @@ class CreateIncreaseBalanceRequest(APIView):
             increase_balance_request.telegram_chat_id = telegram_chat_id
             increase_balance_request.attached_message = message
             increase_balance_request.save()
-            logging.log(logging.INFO, f"IncreaseBalanceRequest created with id: {increase_balance_request.id}")
+            logging.log(logging.INFO, "IncreaseBalanceRequest created with id: %s", increase_balance_request.id)
             return Response(data={"success": True, "message": ""}, status=200)
         except Exception as ex:
             return Response(data={"success": False, "message": f"Error. {str(ex)}"}, status=500)
@@ -171,7 +353,7 @@ class GetIncreaseBalanceRequests(APIView):
                 IncreaseBalanceRequest.objects.filter(request_status="waiting"), many=True
             )
             data = serializer.data
-            logging.log(logging.INFO, f"Get increase balance requests with status 'waiting': {data}")
+            logging.log(logging.INFO, "Get increase balance requests with status 'waiting': %s", data)
 
             return Response(data={"success": True, "data": data, "message": ""}, status=200)
         except Exception as ex:
@@ -201,14 +383,15 @@ class ConsiderIncreaseBalanceRequests(APIView):
 
             logging.log(logging.INFO, "User has admin role")
 
-            logging.log(logging.INFO, f"Data from request - request_id: {request_id}, new_status: {new_status}")
+            logging.log(logging.DEBUG, "Data from request - request_id: %s, new_status: %s", request_id, new_status)
 
             if request_id is None or new_status is None:
                 return Response(data={"success": False, "message": "Error. Invalid request data"}, status=400)
 
             increase_requests = IncreaseBalanceRequest.objects.filter(pk=request_id, request_status="waiting")
+            increase_request = increase_requests.first()
 
-            if increase_requests.count() == 0:
+            if increase_request is None:
                 return Response(
                     data={
                         "success": False,
@@ -216,22 +399,27 @@ class ConsiderIncreaseBalanceRequests(APIView):
                     },
                     status=404,
                 )
-            increase_request = increase_requests.first()
 
             if new_status != "accepted" and new_status != "denied":
                 return Response(
                     data={"success": False, "message": "Error. Incorrect status in request body"}, status=400
                 )
 
-            if new_status == "accepted":
-                increase_request.card.balance = increase_request.card.balance + increase_request.requested_money
-                increase_request.card.save()
-
+            with django_transaction.atomic():
+                # status is changed only if it is still waiting, so request can not be accepted twice
+                if not increase_requests.update(request_status=new_status, updated=timezone.now()):
+                    return Response(
+                        data={"success": False, "message": "Error. Increase balance request is already considered"},
+                        status=409,
+                    )
+                if new_status == "accepted":
+                    top_up_card(
+                        increase_request.card_id, increase_request.requested_money, LedgerEntry.KINDS["balance_request"]
+                    )
             increase_request.request_status = new_status
-            increase_request.save()
 
             logging.log(
-                logging.INFO, f"Money request considered and now status equal - {increase_request.request_status} "
+                logging.INFO, "Money request considered and now status equal - %s", increase_request.request_status
             )
 
             return Response(data={"success": True, "message": ""}, status=200)
@@ -250,7 +438,7 @@ class GetUserCards(ListAPIView):
 
             data = serializer.data
 
-            logging.log(logging.INFO, f"Getting user cards: {data} ")
+            logging.log(logging.INFO, "Getting user cards: %s", data)
 
             return Response(data={"success": True, "data": data, "message": ""}, status=200)
         except Exception as ex:
@@ -275,21 +463,17 @@ def send_user_analytics(request):
                 f"Username: https://t.me/{username}\n"
             )
 
-            admin_chat_ids = Profile.objects.filter(role="admin").values_list("telegram_chat_id").distinct()
-
-            for chat_id in admin_chat_ids:
-                logging.log(logging.INFO, f"Admin chat_id: {chat_id[0]} {type(chat_id[0])}, telegram_chat_id: {telegram_chat_id} {type(telegram_chat_id)}")
-                if chat_id[0] != str(telegram_chat_id):
-                    process = Process(
-                        target=run_async_send_message_in_process,
-                        args=(
-                            chat_id[0],
-                            admin_message,
-                        ),
-                    )
-                    process.start()
+            admin_chat_ids = Profile.objects.filter(role="admin").values_list("telegram_chat_id", flat=True).distinct()
+
+            Notification.objects.bulk_create(
+                [
+                    Notification(telegram_chat_id=chat_id, text=admin_message)
+                    for chat_id in admin_chat_ids
+                    if chat_id and chat_id != str(telegram_chat_id)
+                ]
+            )
             return JsonResponse(data={"success": True, "message": ""}, status=200)
         except Exception as ex:
             return JsonResponse(data={"success": False, "message": f"Error. {str(ex)}"}, status=500)
     else:
-        return JsonResponse(data={"success": False, "message": "This method is not allowed"}, status=405)
\ No newline at end of file
+        return JsonResponse(data={"success": False, "message": "This method is not allowed"}, status=405)
@@ -1,5 +1,16 @@
 from django.contrib import admin
-from .models import Card, Receipt, Profile, Company, Transaction, Product, ServiceSetting, IncreaseBalanceRequest
+from .models import (
+    Card,
+    Receipt,
+    Profile,
+    Company,
+    CompanyBalanceShard,
+    Transaction,
+    Product,
+    ServiceSetting,
+    IncreaseBalanceRequest,
+    Notification,
+)
 
 
 @admin.register(Card)
@@ -9,7 +20,7 @@ class CardAdmin(admin.ModelAdmin):
 
 @admin.register(Receipt)
 class ReceiptAdmin(admin.ModelAdmin):
-    list_display = ("img", "created", "updated")
+    list_display = ("img", "render_status", "created", "updated")
 
 
 @admin.register(Profile)
@@ -30,7 +41,20 @@ class ProductAdmin(admin.ModelAdmin):
 
 @admin.register(Company)
 class CompanyAdmin(admin.ModelAdmin):
-    list_display = ("name", "_company_token", "_balance", "created", "updated")
+    list_display = ("name", "_company_token", "balance", "created", "updated")
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related("balance_shards")  # balance of page by one query
+
+    def balance(self, obj):
+        return obj.balance
+
+    balance.short_description = "Balance"
+
+
+@admin.register(CompanyBalanceShard)
+class CompanyBalanceShardAdmin(admin.ModelAdmin):
+    list_display = ("company", "shard", "_balance", "updated")
 
 
 @admin.register(Transaction)
@@ -56,3 +80,8 @@ class ServiceSettingAdmin(admin.ModelAdmin):
 @admin.register(IncreaseBalanceRequest)
 class IncreaseBalanceRequestAdmin(admin.ModelAdmin):
     list_display = ("requested_money", "card___card_number", "attached_message", "request_status", "created", "updated")
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ("kind", "telegram_chat_id", "delivery_status", "attempts", "next_attempt_at", "sent_at", "created")
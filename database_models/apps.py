@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class DatabaseModelsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "database_models"
+
+    def ready(self):
+        from .entity_cache import connect_signals
+        from .receipt_rendering import connect_signals as connect_receipt_signals
+
+        connect_signals()
+        connect_receipt_signals()
@@ -0,0 +1,302 @@
+import random
+import uuid
+from decimal import Decimal
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from ecoreceipt_api.metrics import stage_timer
+
+from .entity_cache import card_cache, company_cache
+from .ledger import make_transfer_entries, card_account, company_account
+from .models import Card, Company, CompanyBalanceShard, LedgerEntry, Profile, Receipt, Transaction
+
+
+class WriteOffResult(NamedTuple):
+    card_id: int
+    card_balance_after: Decimal
+    owner_telegram_chat_id: str
+    company_id: int
+    company_balance_after: Decimal
+    receipt_data: dict
+
+
+# Company fields printed on receipt, they are returned by WRITE_OFF_SQL so receipt data costs no queries
+RECEIPT_COMPANY_FIELDS = ("name", "hotline_phone", "country", "city", "street", "building")
+
+
+WRITE_OFF_SQL = f"""
+WITH debit AS (
+    UPDATE {Card._meta.db_table}
+    SET _balance = _balance - %(amount)s, updated = %(now)s
+    WHERE id = %(card_id)s AND _card_uid = %(card_uid)s AND _balance >= %(amount)s
+        AND EXISTS (
+            SELECT 1 FROM {Company._meta.db_table} WHERE id = %(company_id)s AND _company_token = %(company_token)s
+        )
+    RETURNING id, owner_id, _balance, _card_number
+), credit AS (
+    INSERT INTO {CompanyBalanceShard._meta.db_table} AS shard (company_id, shard, _balance, updated)
+    SELECT %(company_id)s, %(shard)s, %(amount)s, %(now)s FROM debit
+    ON CONFLICT (company_id, shard) DO UPDATE
+    SET _balance = shard._balance + EXCLUDED._balance, updated = EXCLUDED.updated
+    RETURNING company_id, _balance
+), ledger AS (
+    INSERT INTO {LedgerEntry._meta.db_table} (transfer, kind, account_type, account_id, amount, created)
+    SELECT %(transfer)s::uuid, 'payment', 'card', id, -%(amount)s, %(now)s FROM debit
+    UNION ALL
+    SELECT %(transfer)s::uuid, 'payment', 'company', company_id, %(amount)s, %(now)s FROM credit
+)
+SELECT debit.id, debit._balance, COALESCE(profile.telegram_chat_id, ''), credit.company_id,
+    company._balance + credit._balance + COALESCE((
+        SELECT SUM(_balance) FROM {CompanyBalanceShard._meta.db_table}
+        WHERE company_id = credit.company_id AND shard <> %(shard)s
+    ), 0),
+    debit._card_number, {", ".join(f"company.{field}" for field in RECEIPT_COMPANY_FIELDS)}
+FROM debit
+CROSS JOIN credit
+JOIN {Company._meta.db_table} AS company ON company.id = credit.company_id
+JOIN {Profile._meta.db_table} AS profile ON profile.id = debit.owner_id
+"""
+
+CREDIT_SHARD_SQL = f"""
+INSERT INTO {CompanyBalanceShard._meta.db_table} AS shard (company_id, shard, _balance, updated)
+VALUES (%(company_id)s, %(shard)s, %(amount)s, %(now)s)
+ON CONFLICT (company_id, shard) DO UPDATE
+SET _balance = shard._balance + EXCLUDED._balance, updated = EXCLUDED.updated
+"""
+
+TOP_UP_CARD_SQL = f"""
+WITH credit AS (
+    UPDATE {Card._meta.db_table}
+    SET _balance = _balance + %(amount)s, updated = %(now)s
+    WHERE id = %(card_id)s
+    RETURNING id, _balance
+), ledger AS (
+    INSERT INTO {LedgerEntry._meta.db_table} (transfer, kind, account_type, account_id, amount, created)
+    SELECT %(transfer)s::uuid, %(kind)s, 'external', 0, -%(amount)s, %(now)s FROM credit
+    UNION ALL
+    SELECT %(transfer)s::uuid, %(kind)s, 'card', id, %(amount)s, %(now)s FROM credit
+)
+SELECT _balance FROM credit
+"""
+
+TOP_UP_COMPANY_SQL = f"""
+WITH credit AS (
+    INSERT INTO {CompanyBalanceShard._meta.db_table} AS shard (company_id, shard, _balance, updated)
+    VALUES (%(company_id)s, %(shard)s, %(amount)s, %(now)s)
+    ON CONFLICT (company_id, shard) DO UPDATE
+    SET _balance = shard._balance + EXCLUDED._balance, updated = EXCLUDED.updated
+    RETURNING company_id
+)
+INSERT INTO {LedgerEntry._meta.db_table} (transfer, kind, account_type, account_id, amount, created)
+SELECT %(transfer)s::uuid, %(kind)s, 'external', 0, -%(amount)s, %(now)s FROM credit
+UNION ALL
+SELECT %(transfer)s::uuid, %(kind)s, 'company', company_id, %(amount)s, %(now)s FROM credit
+"""
+
+FOLD_SHARDS_SQL = f"""
+WITH folded AS (
+    DELETE FROM {CompanyBalanceShard._meta.db_table}
+    RETURNING company_id, _balance
+), total AS (
+    SELECT company_id, SUM(_balance) AS amount FROM folded GROUP BY company_id
+)
+UPDATE {Company._meta.db_table} AS company
+SET _balance = company._balance + total.amount
+FROM total
+WHERE company.id = total.company_id
+"""
+
+
+def get_balance_shard(card_id: int) -> int:
+    # Payments from one card are serialized on card row anyway, so card does not add waiting on its shard
+    return card_id % settings.COMPANY_BALANCE_SHARDS
+
+
+def write_off_money(card_uid: str, company_token: str, amount: Decimal) -> WriteOffResult | None:
+    """Move amount from card to company balance shard with one conditional statement, which also writes
+    payment to ledger.
+
+    Card row is changed only if its balance is not lower than amount and company with this token exists,
+    so concurrent payments from one card can not overdraw it or lose an update. Company row is not locked,
+    payments to one company wait for each other only if they are credited to the same shard.
+    Returned company balance is read without lock, so it is exact only if payments are not concurrent.
+    Card and company ids are taken from entity cache, unknown card or company costs no queries. Rows are
+    still checked by uid and token, so entry which is not yet expired in other process can not be misused.
+    Returns None if nothing was changed, see get_write_off_error for the reason.
+
+    """
+    with stage_timer("write_off_money", "lookup"):
+        card = card_cache.get(card_uid)
+        company = company_cache.get(company_token)
+    if card is None or company is None:
+        return None
+
+    now = timezone.now()
+    with stage_timer("write_off_money", "debit"), connection.cursor() as cursor:
+        cursor.execute(
+            WRITE_OFF_SQL,
+            {
+                "amount": amount,
+                "now": now,
+                "card_id": card["id"],
+                "card_uid": card_uid,
+                "company_id": company["id"],
+                "company_token": company_token,
+                "shard": get_balance_shard(card["id"]),
+                "transfer": str(uuid.uuid4()),
+            },
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+
+    card_id, card_balance_after, owner_telegram_chat_id, company_id, company_balance_after, card_number = row[:6]
+    company = Company(id=company_id, **dict(zip(RECEIPT_COMPANY_FIELDS, row[6:])))
+    receipt_data = Receipt.make_data(company, card_number, amount, now)
+    return WriteOffResult(
+        card_id, card_balance_after, owner_telegram_chat_id, company_id, company_balance_after, receipt_data
+    )
+
+
+def get_write_off_error(card_uid: str, company_token: str, amount: Decimal) -> str:
+    """Reason of failed write_off_money: card_not_found, low_balance or company_not_found"""
+    card = card_cache.get(card_uid)
+    if card is None:
+        return "card_not_found"
+    # card row could be deleted or get other uid after it was cached, balances are never cached
+    card_balance = Card.objects.filter(id=card["id"], _card_uid=card_uid).values_list("_balance", flat=True).first()
+    if card_balance is None:
+        return "card_not_found"
+    if card_balance < amount:
+        return "low_balance"
+    return "company_not_found"
+
+
+def get_receipt_render_status(telegram_chat_id: str) -> str:
+    """Receipts sent to telegram are rendered by worker right away, other ones only when image is requested"""
+    return Receipt.RENDER_STATUSES["pending" if telegram_chat_id else "on_demand"]
+
+
+def write_off_money_batch(company: Company, write_offs: list[tuple[str, Decimal]]) -> list[Transaction | str]:
+    """Apply write offs (card_uid, amount) to locked company in given order with constant count of queries.
+
+    Card rows are resolved and locked with one query, balances are changed in memory and saved with
+    bulk_update, receipts, transactions and ledger entries are created with bulk_create.
+    Returns saved Transaction or error reason (card_not_found, low_balance) for every write off.
+    Must be called inside atomic block, company should be selected for update (no_key is enough), so batches
+    to one company are applied one after another. Single payments are credited to balance shards without
+    the company row lock, so like in write_off_money company balances of transactions are exact only if
+    there are no concurrent single payments to the company.
+
+    """
+    cards = {
+        card.card_uid: card
+        for card in Card.objects.select_for_update(of=("self",))
+        .select_related("owner")
+        .filter(_card_uid__in={card_uid for card_uid, _ in write_offs})
+        .order_by("id")  # the same lock order as in other batches, so batches do not deadlock
+    }
+
+    results = []
+    company_balance = company.get_balance()
+    for card_uid, amount in write_offs:
+        card = cards.get(card_uid)
+        if card is None:
+            results.append("card_not_found")
+        elif card.balance < amount:
+            results.append("low_balance")
+        else:
+            transaction = Transaction(card=card, company=company, amount=amount)
+            transaction.card_balance_before = card.balance
+            transaction.company_balance_before = company_balance
+            card.balance = card.balance - amount
+            company_balance = company_balance + amount
+            transaction.card_balance_after = card.balance
+            transaction.company_balance_after = company_balance
+            results.append(transaction)
+
+    transactions = [result for result in results if isinstance(result, Transaction)]
+    if transactions:
+        now = timezone.now()
+        changed_cards = {transaction.card.id: transaction.card for transaction in transactions}.values()
+        for card in changed_cards:
+            card.updated = now
+        Card.objects.bulk_update(changed_cards, ["_balance", "updated"])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                CREDIT_SHARD_SQL,
+                {
+                    "company_id": company.id,
+                    "shard": random.randrange(settings.COMPANY_BALANCE_SHARDS),
+                    "amount": sum(transaction.amount for transaction in transactions),
+                    "now": now,
+                },
+            )
+
+        receipts = Receipt.objects.bulk_create(
+            [
+                Receipt(
+                    render_status=get_receipt_render_status(transaction.card.owner.telegram_chat_id),
+                    data=Receipt.make_data(company, transaction.card.card_number, transaction.amount, now),
+                )
+                for transaction in transactions
+            ]
+        )
+        for transaction, receipt in zip(transactions, receipts):
+            transaction.receipt = receipt
+        Transaction.objects.bulk_create(transactions)
+        LedgerEntry.objects.bulk_create(
+            [
+                entry
+                for transaction in transactions
+                for entry in make_transfer_entries(
+                    LedgerEntry.KINDS["payment"],
+                    card_account(transaction.card.id),
+                    company_account(company.id),
+                    transaction.amount,
+                )
+            ]
+        )
+
+    return results
+
+
+def top_up_card(card_id: int, amount: Decimal, kind: str) -> Decimal | None:
+    """Add money from outside to card balance and ledger, returns new card balance or None if there is no card"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            TOP_UP_CARD_SQL,
+            {"card_id": card_id, "amount": amount, "kind": kind, "now": timezone.now(), "transfer": str(uuid.uuid4())},
+        )
+        row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+def top_up_company(company_id: int, amount: Decimal):
+    """Add money from outside to company balance shard and ledger, company row is not locked"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            TOP_UP_COMPANY_SQL,
+            {
+                "company_id": company_id,
+                "shard": random.randrange(settings.COMPANY_BALANCE_SHARDS),
+                "amount": amount,
+                "kind": LedgerEntry.KINDS["company_top_up"],
+                "now": timezone.now(),
+                "transfer": str(uuid.uuid4()),
+            },
+        )
+
+
+def fold_company_balances() -> int:
+    """Move all balance shards to Company._balance with one statement, returns count of changed companies.
+
+    Company.updated is not changed, it tells that texts printed on receipts were changed (header strip cache key).
+
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(FOLD_SHARDS_SQL)
+        return cursor.rowcount
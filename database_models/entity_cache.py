@@ -0,0 +1,206 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Callable
+
+import redis
+from django.conf import settings
+from django.db import transaction as django_transaction
+from django.db.models import DEFERRED
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete, post_delete
+
+from ecoreceipt_api.metrics import ENTITY_CACHE_LOOKUPS
+from .models import Card, Company
+
+_redis_client = None
+_redis_disabled_until = 0.0
+REDIS_RETRY_AFTER = 30  # seconds without redis after connection error
+
+
+def get_redis_client() -> redis.Redis | None:
+    global _redis_client
+    if settings.REDIS_HOST is None or time.monotonic() < _redis_disabled_until:
+        return None
+    if _redis_client is None:
+        _redis_client = redis.Redis(
+            host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=1, socket_timeout=0.1, socket_connect_timeout=0.1
+        )
+    return _redis_client
+
+
+def disable_redis(ex: redis.RedisError):
+    global _redis_disabled_until
+    logging.log(logging.INFO, "Error. Entity cache works without redis for %ss: %s", REDIS_RETRY_AFTER, ex)
+    _redis_disabled_until = time.monotonic() + REDIS_RETRY_AFTER
+
+
+class EntityCache:
+    """Two-tier cache of identity data: size-bounded per-process LRU in front of shared redis.
+
+    Only data which does not change on payments may be cached (ids, never balances). Entries are invalidated
+    by model signals, other processes drop their local copy after local_ttl seconds. Not found entities
+    are not cached, so newly registered card works at once.
+
+    """
+
+    def __init__(self, name: str, loader: Callable[[str], dict | None], local_size: int, local_ttl: float):
+        self.name = name
+        self.loader = loader
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self.local: OrderedDict[str, tuple[float, dict]] = OrderedDict()  # key: (expires at, value)
+        self.lock = threading.Lock()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    def get(self, key: str) -> dict | None:
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.local.move_to_end(key)
+                self.stats["local_hits"] += 1
+                ENTITY_CACHE_LOOKUPS.labels(self.name, "local_hit").inc()
+                return entry[1]
+
+        value = self.get_from_redis(key)
+        with self.lock:
+            self.stats["redis_hits" if value is not None else "misses"] += 1
+        ENTITY_CACHE_LOOKUPS.labels(self.name, "redis_hit" if value is not None else "miss").inc()
+
+        if value is None:
+            value = self.loader(key)
+            if value is None:
+                return None
+            self.set_to_redis(key, value)
+
+        with self.lock:
+            self.local[key] = (time.monotonic() + self.local_ttl, value)
+            self.local.move_to_end(key)
+            if len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+        return value
+
+    def invalidate(self, key: str | None):
+        if key is None:
+            return
+        with self.lock:
+            self.local.pop(key, None)
+
+        client = get_redis_client()
+        if client is not None:
+            try:
+                client.delete(self.get_redis_key(key))
+            except redis.RedisError as ex:
+                disable_redis(ex)
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+            self.stats = dict.fromkeys(self.stats, 0)
+
+    def get_redis_key(self, key: str) -> str:
+        return f"entity_cache:{self.name}:{key}"
+
+    def get_from_redis(self, key: str) -> dict | None:
+        client = get_redis_client()
+        if client is None:
+            return None
+        try:
+            value = client.get(self.get_redis_key(key))
+        except redis.RedisError as ex:
+            disable_redis(ex)
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set_to_redis(self, key: str, value: dict):
+        client = get_redis_client()
+        if client is None:
+            return
+        try:
+            client.set(self.get_redis_key(key), json.dumps(value), ex=settings.ENTITY_CACHE_REDIS_TTL)
+        except redis.RedisError as ex:
+            disable_redis(ex)
+
+
+def load_card(card_uid: str) -> dict | None:
+    return Card.objects.filter(_card_uid=card_uid).values("id", "owner_id").first()
+
+
+def load_company(company_token: str) -> dict | None:
+    return Company.objects.filter(_company_token=company_token).values("id").first()
+
+
+card_cache = EntityCache("card", load_card, settings.ENTITY_CACHE_LOCAL_SIZE, settings.ENTITY_CACHE_LOCAL_TTL)
+company_cache = EntityCache("company", load_company, settings.ENTITY_CACHE_LOCAL_SIZE, settings.ENTITY_CACHE_LOCAL_TTL)
+
+
+# fields which are cached, change of them invalidates cache entry
+IDENTITY_FIELDS = {Card: ("_card_uid", "owner_id"), Company: ("_company_token",)}
+
+
+def remember_identity(sender, instance: Card | Company, **kwargs):
+    """Identity of loaded row, fields deferred by only()/defer() are not read (reading loads them by one more query),
+    they are DEFERRED until row is saved or deleted
+
+    """
+    instance._cached_identity = tuple(instance.__dict__.get(field, DEFERRED) for field in IDENTITY_FIELDS[sender])
+
+
+def load_stored_identity(sender, instance: Card | Company, **kwargs):
+    """Deferred fields of remembered identity are read from stored row before it is changed or deleted"""
+    if DEFERRED not in instance._cached_identity or instance._state.adding:
+        return
+    stored = sender.objects.filter(pk=instance.pk).values_list(*IDENTITY_FIELDS[sender]).first()
+    if stored is not None:
+        instance._cached_identity = tuple(
+            stored_value if value is DEFERRED else value
+            for value, stored_value in zip(instance._cached_identity, stored)
+        )
+
+
+def get_identity(sender, instance: Card | Company) -> tuple:
+    # field which is still deferred was not changed
+    return tuple(
+        instance.__dict__.get(field, cached_value)
+        for field, cached_value in zip(IDENTITY_FIELDS[sender], instance._cached_identity)
+    )
+
+
+def invalidate_later(cache: EntityCache, key: str | None):
+    if key is DEFERRED:  # unsaved row
+        return
+    cache.invalidate(key)
+    # and after commit, otherwise other process can cache old row again before it
+    django_transaction.on_commit(partial(cache.invalidate, key))
+
+
+def is_identity_changed(kwargs: dict, identity, cached_identity) -> bool:
+    return kwargs.get("created") or kwargs["signal"] is post_delete or identity != cached_identity
+
+
+def invalidate_card(sender, instance: Card, **kwargs):
+    # Balance changes do not touch cached data, so cache is called only when identity is changed
+    identity = get_identity(sender, instance)
+    if is_identity_changed(kwargs, identity, instance._cached_identity):
+        for card_uid in {identity[0], instance._cached_identity[0]}:
+            invalidate_later(card_cache, card_uid)
+    instance._cached_identity = identity
+
+
+def invalidate_company(sender, instance: Company, **kwargs):
+    identity = get_identity(sender, instance)
+    if is_identity_changed(kwargs, identity, instance._cached_identity):
+        for company_token in {identity[0], instance._cached_identity[0]}:
+            invalidate_later(company_cache, company_token)
+    instance._cached_identity = identity
+
+
+def connect_signals():
+    for model, invalidate in ((Card, invalidate_card), (Company, invalidate_company)):
+        post_init.connect(remember_identity, sender=model)
+        pre_save.connect(load_stored_identity, sender=model)
+        pre_delete.connect(load_stored_identity, sender=model)
+        post_save.connect(invalidate, sender=model)
+        post_delete.connect(invalidate, sender=model)
@@ -0,0 +1,95 @@
+import json
+import hashlib
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+
+CLAIM_KEYS_SQL = """
+INSERT INTO {table} (key, company_token, request_hash, created, updated)
+VALUES {values}
+ON CONFLICT (company_token, key) DO NOTHING
+RETURNING id, key
+"""
+
+
+def get_request_hash(card_uid, amount, company_token) -> str:
+    """Hash of payment which is sent with idempotency key, the same payment in other encoding has the same hash"""
+    try:
+        amount = str(Decimal(str(amount)).normalize())
+    except InvalidOperation:
+        amount = str(amount)
+    payment = json.dumps([str(card_uid).lower(), amount, str(company_token)])
+    return hashlib.sha256(payment.encode()).hexdigest()
+
+
+def is_same_request(stored_key: IdempotencyKey, request_hash: str) -> bool:
+    """Stored response is replayed only for the same payment, keys stored before hashes have no hash"""
+    return not stored_key.request_hash or stored_key.request_hash == request_hash
+
+
+def claim_idempotency_keys(
+    keys: list[str], company_token: str, request_hashes: dict[str, str] | None = None
+) -> tuple[dict[str, int], dict[str, IdempotencyKey]]:
+    """Returns ids of keys claimed by current request and already stored keys with responses, both by key.
+    request_hashes (by key) are stored with claimed keys.
+
+    Should be called inside transaction which stores the responses. If the same key is being handled
+    by another request, insert waits until that transaction ends, so the response is always stored.
+
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return {}, {}
+
+    now = timezone.now()
+    request_hashes = request_hashes or {}
+    values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(keys))
+    sql = CLAIM_KEYS_SQL.format(table=IdempotencyKey._meta.db_table, values=values)
+    with connection.cursor() as cursor:
+        params = [param for key in keys for param in (key, company_token, request_hashes.get(key, ""), now, now)]
+        cursor.execute(sql, params)
+        claimed_keys = {key: key_id for key_id, key in cursor.fetchall()}
+
+    stored_keys = {}
+    if len(claimed_keys) != len(keys):
+        stored_keys = {
+            stored_key.key: stored_key
+            for stored_key in IdempotencyKey.objects.filter(
+                company_token=company_token, key__in=[key for key in keys if key not in claimed_keys]
+            )
+        }
+    return claimed_keys, stored_keys
+
+
+def claim_idempotency_key(key: str, company_token: str, request_hash: str = "") -> IdempotencyKey | None:
+    """Returns None if key is claimed by current request, otherwise already stored key with response"""
+    _, stored_keys = claim_idempotency_keys([key], company_token, {key: request_hash})
+    return stored_keys.get(key)
+
+
+def save_idempotent_response(key: str, company_token: str, status: int, body: dict):
+    IdempotencyKey.objects.filter(key=key, company_token=company_token).update(
+        response_status=status, response_body=body, updated=timezone.now()
+    )
+
+
+def save_idempotent_responses(claimed_keys: dict[str, int], responses: dict[str, tuple[int, dict]]):
+    """Store responses (status, body) by key for keys returned by claim_idempotency_keys, with one query"""
+    now = timezone.now()
+    IdempotencyKey.objects.bulk_update(
+        [
+            IdempotencyKey(id=claimed_keys[key], response_status=status, response_body=body, updated=now)
+            for key, (status, body) in responses.items()
+        ],
+        ["response_status", "response_body", "updated"],
+    )
+
+
+def purge_idempotency_keys(ttl: timedelta) -> int:
+    deleted, _ = IdempotencyKey.objects.filter(created__lt=timezone.now() - ttl).delete()
+    return deleted
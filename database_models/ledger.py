@@ -0,0 +1,92 @@
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection
+from django.utils import timezone
+
+from .models import LedgerEntry, LedgerSnapshot
+
+Account = tuple[str, int]  # (account type, account id)
+
+EXTERNAL_ACCOUNT = (LedgerEntry.ACCOUNT_TYPES["external"], LedgerEntry.EXTERNAL_ACCOUNT_ID)
+
+
+def card_account(card_id: int) -> Account:
+    return LedgerEntry.ACCOUNT_TYPES["card"], card_id
+
+
+def company_account(company_id: int) -> Account:
+    return LedgerEntry.ACCOUNT_TYPES["company"], company_id
+
+
+def make_transfer_entries(kind: str, from_account: Account, to_account: Account, amount: Decimal) -> list[LedgerEntry]:
+    transfer = uuid.uuid4()
+    now = timezone.now()
+    return [
+        LedgerEntry(
+            transfer=transfer,
+            kind=kind,
+            account_type=account_type,
+            account_id=account_id,
+            amount=entry_amount,
+            created=now,
+        )
+        for (account_type, account_id), entry_amount in ((from_account, -amount), (to_account, amount))
+    ]
+
+
+LEDGER_BALANCE_SQL = f"""
+WITH snapshot AS (
+    SELECT balance, last_entry_id FROM {LedgerSnapshot._meta.db_table}
+    WHERE account_type = %(account_type)s AND account_id = %(account_id)s
+    ORDER BY last_entry_id DESC
+    LIMIT 1
+)
+SELECT COALESCE((SELECT balance FROM snapshot), 0) + COALESCE(SUM(amount), 0)
+FROM {LedgerEntry._meta.db_table}
+WHERE account_type = %(account_type)s AND account_id = %(account_id)s
+    AND id > COALESCE((SELECT last_entry_id FROM snapshot), 0)
+"""
+
+
+def get_ledger_balance(account: Account) -> Decimal:
+    """Balance of account: its latest snapshot plus entries after it, read from indexes only"""
+    account_type, account_id = account
+    with connection.cursor() as cursor:
+        cursor.execute(LEDGER_BALANCE_SQL, {"account_type": account_type, "account_id": account_id})
+        return cursor.fetchone()[0]
+
+
+SNAPSHOT_BALANCES_SQL = f"""
+WITH latest AS (
+    SELECT DISTINCT ON (account_type, account_id) account_type, account_id, balance, last_entry_id
+    FROM {LedgerSnapshot._meta.db_table}
+    ORDER BY account_type, account_id, last_entry_id DESC
+)
+INSERT INTO {LedgerSnapshot._meta.db_table} (account_type, account_id, balance, last_entry_id, created)
+SELECT entry.account_type, entry.account_id, COALESCE(latest.balance, 0) + SUM(entry.amount), MAX(entry.id), %(now)s
+FROM {LedgerEntry._meta.db_table} AS entry
+LEFT JOIN latest ON latest.account_type = entry.account_type AND latest.account_id = entry.account_id
+WHERE entry.id > COALESCE(latest.last_entry_id, 0) AND entry.id <= %(max_entry_id)s
+GROUP BY entry.account_type, entry.account_id, latest.balance
+"""
+
+
+def snapshot_ledger_balances(settle_after: timedelta) -> int:
+    """Write snapshots of accounts which have new entries, returns count of snapshots.
+
+    Entry ids are not given in commit order, so only entries older than settle_after are snapshotted,
+    entry which is not committed yet could be skipped by snapshot otherwise.
+
+    """
+    now = timezone.now()
+    max_entry_id = (
+        LedgerEntry.objects.filter(created__lt=now - settle_after).order_by("-id").values_list("id", flat=True).first()
+    )
+    if max_entry_id is None:
+        return 0
+
+    with connection.cursor() as cursor:
+        cursor.execute(SNAPSHOT_BALANCES_SQL, {"now": now, "max_entry_id": max_entry_id})
+        return cursor.rowcount
@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Q
+
+from database_models.models import Receipt
+from database_models.receipt_rendering import preload_receipt_templates, rerender_receipt
+
+
+class Command(BaseCommand):
+    help = (
+        "Render or render again receipts in bulk (receipts without image, receipts of date range after template "
+        "change), using a pool of processes. Receipts are taken in id order, so stopped run can be resumed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--missing", action="store_true", help="Receipts without image")
+        parser.add_argument("--since", type=date.fromisoformat, help="Receipts created on this date or later")
+        parser.add_argument("--until", type=date.fromisoformat, help="Receipts created on this date or earlier")
+        parser.add_argument(
+            "--status", action="append", choices=list(Receipt.RENDER_STATUSES), help="Receipts with render status"
+        )
+        parser.add_argument("--all", action="store_true", help="All receipts")
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(), help="Count of render processes, 0 - render in this process"
+        )
+        parser.add_argument("--chunk-size", type=int, default=100, help="Receipts read from db and rendered at once")
+        parser.add_argument("--after-id", type=int, default=0, help="Start after receipt with this id")
+        parser.add_argument(
+            "--state-file", help="File with id of last rendered receipt, it is read on start and updated after chunks"
+        )
+
+    def handle(self, *args, **options):
+        receipts = self.get_receipts(options)
+        after_id = max(options["after_id"], self.read_state(options["state_file"]))
+        receipts = receipts.filter(id__gt=after_id).order_by("id")
+        total = receipts.count()
+        self.stdout.write(f"Receipts to render: {total}, after id {after_id}")
+
+        workers = options["workers"]
+        executor = None
+        if workers > 0:
+            # processes are forked now, before server side cursor of iterator is opened in this process
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=preload_receipt_templates)
+            list(executor.map(time.sleep, [0] * workers))
+        else:
+            preload_receipt_templates()
+
+        statuses = Counter()
+        started = time.perf_counter()
+        try:
+            receipt_ids = []
+            for receipt_id in receipts.values_list("id", flat=True).iterator(chunk_size=options["chunk_size"]):
+                receipt_ids.append(receipt_id)
+                if len(receipt_ids) == options["chunk_size"]:
+                    self.render_chunk(receipt_ids, executor, statuses, total, started, options["state_file"])
+                    receipt_ids = []
+            if receipt_ids:
+                self.render_chunk(receipt_ids, executor, statuses, total, started, options["state_file"])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def render_chunk(
+        self,
+        receipt_ids: list[int],
+        executor: ProcessPoolExecutor | None,
+        statuses: Counter,
+        total: int,
+        started: float,
+        state_file: str | None,
+    ):
+        if executor is None:
+            statuses.update(rerender_receipt_safe(receipt_id) for receipt_id in receipt_ids)
+        else:
+            statuses.update(executor.map(rerender_receipt_safe, receipt_ids))
+        self.write_state(state_file, receipt_ids[-1])
+
+        done = sum(statuses.values())
+        self.stdout.write(
+            f"Rendered {statuses['ready']} of {done}/{total} receipts, failed {statuses['failed']}, "
+            f"skipped {statuses['skipped']}, last id {receipt_ids[-1]}, "
+            f"{done / (time.perf_counter() - started):.1f} receipts/s"
+        )
+
+    @staticmethod
+    def get_receipts(options: dict):
+        conditions = Q()
+        if options["missing"]:
+            conditions &= Q(img="") | Q(img__isnull=True)
+        if options["since"] is not None:
+            conditions &= Q(created__date__gte=options["since"])
+        if options["until"] is not None:
+            conditions &= Q(created__date__lte=options["until"])
+        if options["status"]:
+            conditions &= Q(render_status__in=options["status"])
+        if not conditions and not options["all"]:
+            raise CommandError("Choose receipts with --missing, --since, --until, --status or --all")
+        return Receipt.objects.filter(conditions)
+
+    @staticmethod
+    def read_state(state_file: str | None) -> int:
+        if state_file is None or not os.path.exists(state_file):
+            return 0
+        with open(state_file) as file:
+            return int(file.read().strip() or 0)
+
+    @staticmethod
+    def write_state(state_file: str | None, last_id: int):
+        if state_file is None:
+            return
+        with open(f"{state_file}.tmp", "w") as file:
+            file.write(str(last_id))
+        os.replace(f"{state_file}.tmp", state_file)
+
+
+def rerender_receipt_safe(receipt_id: int) -> str:
+    try:
+        return rerender_receipt(receipt_id)
+    except Exception as ex:
+        logging.log(logging.INFO, "Error. Receipt %s was not rendered: %s", receipt_id, ex)
+        return "failed"
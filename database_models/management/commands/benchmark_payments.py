@@ -0,0 +1,245 @@
+import time
+import random
+import asyncio
+import statistics
+from argparse import BooleanOptionalAction
+from collections import Counter
+from decimal import Decimal
+from io import StringIO
+
+import aiohttp
+from aiohttp import web
+from aiogram.client.telegram import TelegramAPIServer
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction as django_transaction
+from django.db.models import Value
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIRequestFactory
+
+from database_models.balances import top_up_card
+from database_models.entity_cache import card_cache, company_cache
+from database_models.models import Card, Company, LedgerEntry, Notification, Profile, Receipt
+from telegram_bot.bot import bot
+from telegram_bot.notification_dispatcher import NotificationDispatcher
+from terminal_api.views import WriteOffMoney
+
+BENCHMARK_USERNAME = "benchmark"
+BENCHMARK_BALANCE = Decimal(10**7)
+
+
+def get_percentiles(values: list[float]) -> dict[str, float]:
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return {"p50": value, "p95": value, "p99": value}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p95": quantiles[94], "p99": quantiles[98]}
+
+
+def seed_benchmark_data(cards_count: int, companies_count: int) -> tuple[list[str], list[str]]:
+    """Create (or reuse) benchmark cards and companies, cards are topped up. Returns card uids and tokens"""
+    user, _ = User.objects.get_or_create(username=BENCHMARK_USERNAME, defaults={"email": "benchmark@localhost"})
+    profile, _ = Profile.objects.get_or_create(user=user, defaults={"telegram_chat_id": "1"})
+    Token.objects.get_or_create(user=user)  # receipt notifications are sent only to logged in owners
+
+    card_uids = [f"be{i:06x}" for i in range(cards_count)]
+    existing_uids = set(Card.objects.filter(_card_uid__in=card_uids).values_list("_card_uid", flat=True))
+    for card_uid in card_uids:
+        if card_uid not in existing_uids:
+            card = Card.objects.create(owner=profile, _card_uid=card_uid)
+            card.generate_card_number()
+            card.generate_cvv()
+    for card_id, balance in Card.objects.filter(_card_uid__in=card_uids).values_list("id", "_balance"):
+        if balance < BENCHMARK_BALANCE:
+            top_up_card(card_id, BENCHMARK_BALANCE - balance, LedgerEntry.KINDS["card_top_up"])
+
+    company_tokens = []
+    for i in range(companies_count):
+        company, created = Company.objects.get_or_create(name=f"Benchmark company {i}")
+        if created or company.company_token is None:
+            company.generate_token()
+        company_tokens.append(company.company_token)
+    return card_uids, company_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        "Load benchmark of /terminal_api/write_off_money/ on running local server with virtual terminals. "
+        "Seeds benchmark cards and companies in the same database, so run it only against development database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base url of running server")
+        parser.add_argument("--terminals", type=int, default=10, help="Count of virtual terminals working at once")
+        parser.add_argument("--requests", type=int, default=100, help="Count of payments made by every terminal")
+        parser.add_argument("--cards", type=int, default=100, help="Count of benchmark cards")
+        parser.add_argument("--companies", type=int, default=1, help="Count of benchmark companies")
+        parser.add_argument("--amount", type=Decimal, default=Decimal(1), help="Amount of every payment")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Seconds before payment request fails")
+        parser.add_argument(
+            "--query-sample", type=int, default=20, help="Payments made in this process to count db queries"
+        )
+        parser.add_argument(
+            "--render",
+            action=BooleanOptionalAction,
+            default=True,
+            help="Render receipts of benchmark payments after load (renders whole pending queue)",
+        )
+        parser.add_argument("--render-workers", type=int, default=None, help="Render processes, see render_receipts")
+        parser.add_argument(
+            "--notify",
+            action=BooleanOptionalAction,
+            default=True,
+            help="Deliver notifications of benchmark payments to local telegram stub",
+        )
+        parser.add_argument("--stub-port", type=int, default=0, help="Port of local telegram api stub, 0 - any free")
+        parser.add_argument("--telegram-latency", type=float, default=0.0, help="Milliseconds of stub response delay")
+
+    def handle(self, *args, **options):
+        card_uids, company_tokens = seed_benchmark_data(options["cards"], options["companies"])
+        started_at = timezone.now()
+
+        self.report_queries(card_uids, company_tokens, options)
+        self.report_payments(card_uids, company_tokens, options)
+
+        receipts = Receipt.objects.filter(transaction__card__owner__user__username=BENCHMARK_USERNAME)
+        receipts = receipts.filter(created__gte=started_at)
+        if options["render"]:
+            self.report_render(receipts, options)
+        elif options["notify"]:
+            # without images receipt notifications are delivered as plain messages
+            receipts.filter(render_status=Receipt.RENDER_STATUSES["pending"]).update(
+                render_status=Receipt.RENDER_STATUSES["failed"]
+            )
+
+        if options["notify"]:
+            self.report_notify(receipts, options)
+
+    def report_queries(self, card_uids: list[str], company_tokens: list[str], options: dict):
+        factory = APIRequestFactory()
+        view = WriteOffMoney.as_view()
+        counts = []
+        # steady state is measured, server processes have these entities cached after first payments too
+        for card_uid in card_uids:
+            card_cache.get(card_uid)
+        for company_token in company_tokens:
+            company_cache.get(company_token)
+        for _ in range(options["query_sample"]):
+            body = {
+                "card_uid": random.choice(card_uids),
+                "amount": options["amount"],
+                "company_token": random.choice(company_tokens),
+            }
+            with django_transaction.atomic():
+                with CaptureQueriesContext(connection) as context:
+                    view(factory.post("/terminal_api/write_off_money/", body))
+                django_transaction.set_rollback(True)  # sample payments are not saved
+            counts.append(len([query for query in context.captured_queries if "SAVEPOINT" not in query["sql"]]))
+
+        if counts:
+            self.stdout.write(f"DB queries per payment: avg {statistics.mean(counts):.1f}, max {max(counts)}")
+
+    def report_payments(self, card_uids: list[str], company_tokens: list[str], options: dict):
+        latencies, status_codes, duration = async_to_sync(self.run_terminals)(card_uids, company_tokens, options)
+
+        total = sum(status_codes.values())
+        percentiles = get_percentiles(latencies)
+        self.stdout.write(
+            f"Payments: {total} in {duration:.2f}s, {total / duration:.1f} req/s, "
+            f"latency p50 {percentiles['p50']:.1f}ms, p95 {percentiles['p95']:.1f}ms, p99 {percentiles['p99']:.1f}ms"
+        )
+        errors = {status: count for status, count in status_codes.items() if status != "200"}
+        error_rate = sum(errors.values()) / total * 100 if total else 0
+        self.stdout.write(f"Errors: {error_rate:.2f}% {dict(sorted(errors.items()))}")
+
+    async def run_terminals(
+        self, card_uids: list[str], company_tokens: list[str], options: dict
+    ) -> tuple[list[float], Counter, float]:
+        url = f"{options['url'].rstrip('/')}/terminal_api/write_off_money/"
+        latencies = []
+        status_codes = Counter()
+
+        async def terminal(company_token: str):
+            for _ in range(options["requests"]):
+                body = {"card_uid": random.choice(card_uids), "amount": str(options["amount"])}
+                body["company_token"] = company_token
+                request_started = time.perf_counter()
+                try:
+                    async with session.post(url, json=body) as response:
+                        await response.read()
+                        status_codes[str(response.status)] += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                    status_codes[type(ex).__name__] += 1
+                latencies.append((time.perf_counter() - request_started) * 1000)
+
+        timeout = aiohttp.ClientTimeout(total=options["timeout"])
+        connector = aiohttp.TCPConnector(limit=options["terminals"])
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(terminal(company_tokens[i % len(company_tokens)]) for i in range(options["terminals"]))
+            )
+            duration = time.perf_counter() - started
+        return latencies, status_codes, duration
+
+    def report_render(self, receipts, options: dict):
+        render_options = {"once": True, "stdout": StringIO()}
+        if options["render_workers"] is not None:
+            render_options["workers"] = options["render_workers"]
+
+        started = time.perf_counter()
+        call_command("render_receipts", **render_options)
+        duration = time.perf_counter() - started
+
+        statuses = Counter(receipts.values_list("render_status", flat=True))
+        rendered = statuses[Receipt.RENDER_STATUSES["ready"]]
+        self.stdout.write(
+            f"Render: {rendered} receipts in {duration:.2f}s, {rendered / duration:.1f} receipts/s, "
+            f"failed {statuses[Receipt.RENDER_STATUSES['failed']]}"
+        )
+
+    def report_notify(self, receipts, options: dict):
+        started = time.perf_counter()
+        async_to_sync(self.run_dispatcher)(receipts, options)
+        duration = time.perf_counter() - started
+
+        statuses = Counter(Notification.objects.filter(receipt__in=receipts).values_list("delivery_status", flat=True))
+        sent = statuses[Notification.STATUSES["sent"]]
+        self.stdout.write(
+            f"Notify: {sent} sent in {duration:.2f}s, {sent / duration:.1f} messages/s, "
+            f"not sent {sum(statuses.values()) - sent}"
+        )
+
+    async def run_dispatcher(self, receipts, options: dict):
+        async def telegram_stub(request: web.Request) -> web.Response:
+            await request.read()  # receipt photo is uploaded as multipart body
+            await asyncio.sleep(options["telegram_latency"] / 1000)
+            message = {"message_id": 1, "date": int(time.time()), "chat": {"id": 1, "type": "private"}}
+            return web.json_response({"ok": True, "result": message})
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", telegram_stub)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", options["stub_port"]).start()
+        stub_port = runner.addresses[0][1]
+
+        # only benchmark notifications are delivered, other ones are left in outbox for real dispatcher
+        notifications = await sync_to_async(list)(
+            Notification.objects.filter(receipt__in=receipts, delivery_status=Notification.STATUSES["pending"])
+            .select_related("receipt")
+            .annotate(owner_logged_in=Value(True))
+        )
+        dispatcher = NotificationDispatcher()
+        api = bot.session.api
+        bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{stub_port}")
+        try:
+            await asyncio.gather(*(dispatcher.deliver(notification) for notification in notifications))
+        finally:
+            bot.session.api = api
+            await bot.session.close()
+            await runner.cleanup()
@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from receipt_creation.benchmarks import RECEIPT_SIZES, benchmark_receipt_sizes
+from receipt_creation.encoders import ENCODERS
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark of receipt rendering stages for receipts of different count of products: milliseconds of every "
+        "stage, peak memory and output bytes. Json output of releases can be compared to find regressions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=lambda value: tuple(int(size) for size in value.split(",")),
+            default=RECEIPT_SIZES,
+            help="Counts of products, comma separated",
+        )
+        parser.add_argument("--iterations", type=int, default=5, help="Receipts rendered for every size")
+        parser.add_argument("--format", default="jpeg", choices=list(ENCODERS), help="Format of receipt image")
+        parser.add_argument("--output", help="Json file for results")
+
+    def handle(self, *args, **options):
+        results = benchmark_receipt_sizes(options["sizes"], options["iterations"], options["format"])
+
+        barcode = results["barcode"]
+        self.stdout.write(f"Barcode: {barcode['cold_ms']:.2f}ms rendered, {barcode['warm_ms']:.3f}ms from cache")
+        stages = list(results["receipts"][0]["stages_ms"])
+        self.stdout.write(
+            f"{'Items':>6}" + "".join(f"{stage:>12}" for stage in stages) + f"{'Total ms':>10}{'Peak KB':>9}"
+            f"{'Image KB':>10}{'Bytes':>9}"
+        )
+        for result in results["receipts"]:
+            self.stdout.write(
+                f"{result['items']:>6}"
+                + "".join(f"{result['stages_ms'][stage]:>12.2f}" for stage in stages)
+                + f"{result['total_ms']:>10.2f}{result['peak_traced_bytes'] // 1024:>9}"
+                f"{result['image_bytes'] // 1024:>10}{result['output_bytes']:>9}"
+            )
+
+        if options["output"] is not None:
+            with open(options["output"], "w") as file:
+                json.dump(results, file, indent=2)
+            self.stdout.write(f"Results are written to {options['output']}")
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from receipt_creation.benchmarks import benchmark_template_registry, compare_receipt_formats, compare_text_backends
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark of receipt rendering with and without preloaded templates and fonts, of text drawing with "
+        "ImageDraw.text and glyph atlas and of receipt image formats (size and encode time), nothing is saved to db"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20, help="Receipts rendered for every measurement")
+        parser.add_argument("--items", type=int, default=5, help="Count of products on every receipt")
+
+    def handle(self, *args, **options):
+        results = benchmark_template_registry(options["iterations"], options["items"])
+        self.stdout.write(
+            f"Templates loading: {results['load_templates_without_registry_ms']:.2f}ms without registry, "
+            f"{results['load_templates_from_registry_ms']:.2f}ms from registry"
+        )
+        self.stdout.write(
+            f"make_receipt: {results['make_receipt_cold_registry_ms']:.2f}ms cold, "
+            f"{results['make_receipt_warm_registry_ms']:.2f}ms warm, "
+            f"saved {results['saved_per_receipt_ms']:.2f}ms per receipt"
+        )
+
+        self.stdout.write(f"{'Texts':<18}{'ImageDraw ms':>14}{'Atlas ms':>10}{'Speedup':>9}")
+        for name, result in compare_text_backends(options["iterations"], options["items"]).items():
+            self.stdout.write(
+                f"{name:<18}{result['image_draw_ms']:>14.2f}{result['glyph_atlas_ms']:>10.2f}{result['speedup']:>8.1f}x"
+            )
+
+        self.stdout.write(f"{'Format':<18}{'Bytes':>9}{'Encode ms':>11}{'Smaller than jpeg':>19}")
+        for name, result in compare_receipt_formats(options["iterations"], options["items"]).items():
+            self.stdout.write(
+                f"{name:<18}{result['bytes']:>9}{result['encode_ms']:>11.2f}{result['smaller_than_jpeg']:>18.1f}x"
+            )
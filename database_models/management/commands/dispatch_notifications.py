@@ -0,0 +1,31 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from telegram_bot.notification_dispatcher import NotificationDispatcher
+
+
+class Command(BaseCommand):
+    help = "Deliver telegram notifications from outbox with one long-lived bot session"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=10, help="Max count of simultaneous telegram requests")
+        parser.add_argument("--batch-size", type=int, default=50, help="Count of notifications claimed per iteration")
+        parser.add_argument("--max-attempts", type=int, default=5, help="Attempts before notification marked failed")
+        parser.add_argument("--backoff-base", type=float, default=2.0, help="Seconds before first retry, doubled after")
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds to sleep when outbox is empty")
+        parser.add_argument("--once", action="store_true", help="Drain the outbox one time and exit")
+
+    def handle(self, *args, **options):
+        dispatcher = NotificationDispatcher(
+            concurrency=options["concurrency"],
+            batch_size=options["batch_size"],
+            max_attempts=options["max_attempts"],
+            backoff_base=options["backoff_base"],
+        )
+        try:
+            # async_to_sync keeps orm calls of dispatcher in this thread
+            async_to_sync(dispatcher.run)(interval=options["interval"], once=options["once"])
+        except KeyboardInterrupt:
+            logging.log(logging.INFO, "Notification dispatcher stopped")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from database_models.balances import fold_company_balances
+
+
+class Command(BaseCommand):
+    help = "Move company balance shards to company balance, run it periodically (cron or systemd timer)"
+
+    def handle(self, *args, **options):
+        folded = fold_company_balances()
+        self.stdout.write(f"Folded balances of companies: {folded}")
@@ -0,0 +1,16 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from database_models.idempotency import purge_idempotency_keys
+
+
+class Command(BaseCommand):
+    help = "Delete stored terminal payment responses older than ttl, run it periodically (cron or systemd timer)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ttl-hours", type=int, default=24, help="How long payment retries are replayed")
+
+    def handle(self, *args, **options):
+        deleted = purge_idempotency_keys(timedelta(hours=options["ttl_hours"]))
+        self.stdout.write(f"Deleted idempotency keys: {deleted}")
@@ -0,0 +1,74 @@
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from database_models.receipt_rendering import (
+    claim_pending_receipts,
+    release_stale_receipts,
+    render_receipt,
+    preload_receipt_templates,
+)
+
+
+class Command(BaseCommand):
+    help = "Render pending receipt images outside of payment requests, using a pool of processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(), help="Count of render processes, 0 - render in this process"
+        )
+        parser.add_argument("--batch-size", type=int, default=20, help="Count of receipts claimed per iteration")
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds to sleep when queue is empty")
+        parser.add_argument(
+            "--stale-after", type=int, default=300, help="Seconds after which 'rendering' receipt is rendered again"
+        )
+        parser.add_argument("--once", action="store_true", help="Drain the queue one time and exit")
+
+    def handle(self, *args, **options):
+        workers = options["workers"]
+        # forked processes get preloaded templates, initializer loads them if processes are spawned
+        preload_receipt_templates()
+        executor = (
+            ProcessPoolExecutor(max_workers=workers, initializer=preload_receipt_templates) if workers > 0 else None
+        )
+
+        try:
+            while True:
+                released = release_stale_receipts(options["stale_after"])
+                if released:
+                    logging.log(logging.INFO, "Stale receipts returned to queue: %s", released)
+
+                receipt_ids = claim_pending_receipts(options["batch_size"])
+                if receipt_ids:
+                    self.render_batch(receipt_ids, executor)
+                elif options["once"]:
+                    break
+                else:
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            logging.log(logging.INFO, "Receipt render worker stopped")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def render_batch(self, receipt_ids: list[int], executor: ProcessPoolExecutor | None):
+        if executor is None:
+            statuses = [render_receipt_safe(receipt_id) for receipt_id in receipt_ids]
+        else:
+            # Forked render processes must open their own db connections
+            connections.close_all()
+            statuses = list(executor.map(render_receipt_safe, receipt_ids))
+
+        self.stdout.write(f"Rendered {statuses.count('ready')} of {len(receipt_ids)} receipts")
+
+
+def render_receipt_safe(receipt_id: int) -> str:
+    try:
+        return render_receipt(receipt_id)
+    except Exception as ex:
+        logging.log(logging.INFO, "Error. Receipt %s was not rendered: %s", receipt_id, ex)
+        return "failed"
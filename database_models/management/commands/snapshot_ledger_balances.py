@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from database_models.ledger import snapshot_ledger_balances
+
+
+class Command(BaseCommand):
+    help = "Write balance snapshots of ledger accounts with new entries, run it periodically (cron or systemd timer)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--settle-seconds", type=int, default=60, help="Entries newer than this are left for the next snapshot"
+        )
+
+    def handle(self, *args, **options):
+        snapshots = snapshot_ledger_balances(timedelta(seconds=options["settle_seconds"]))
+        self.stdout.write(f"Ledger snapshots written: {snapshots}")
@@ -0,0 +1,24 @@
+# Generated by Django 5.1 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+def mark_rendered_receipts_ready(apps, schema_editor):
+    Receipt = apps.get_model('database_models', 'Receipt')
+    Receipt.objects.exclude(img='').exclude(img__isnull=True).update(render_status='ready')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0020_increasebalancerequest_telegram_chat_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='render_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('rendering', 'rendering'), ('ready', 'ready'), ('failed', 'failed')], db_index=True, default='pending'),
+        ),
+        migrations.RunPython(mark_rendered_receipts_ready, migrations.RunPython.noop),
+    ]
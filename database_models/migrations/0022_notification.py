@@ -0,0 +1,35 @@
+# Generated by Django 5.1 on 2026-10-18 12:49
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0021_receipt_render_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('message', 'message'), ('receipt', 'receipt')], default='message')),
+                ('telegram_chat_id', models.CharField(max_length=20)),
+                ('text', models.TextField(blank=True, default='')),
+                ('delivery_status', models.CharField(choices=[('pending', 'pending'), ('sent', 'sent'), ('failed', 'failed')], default='pending')),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('receipt', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='notifications', to='database_models.receipt')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('delivery_status', 'pending')), fields=['next_attempt_at'], name='notification_pending_idx')],
+            },
+        ),
+    ]
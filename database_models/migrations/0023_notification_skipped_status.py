@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0022_notification'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='delivery_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('sent', 'sent'), ('failed', 'failed'), ('skipped', 'skipped')], default='pending'),
+        ),
+    ]
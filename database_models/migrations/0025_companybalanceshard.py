@@ -0,0 +1,27 @@
+# Generated by Django 5.1 on 2026-10-18 13:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0024_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompanyBalanceShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('_balance', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_shards', to='database_models.company')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('company', 'shard'), name='unique_company_balance_shard')],
+            },
+        ),
+    ]
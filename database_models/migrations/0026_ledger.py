@@ -0,0 +1,67 @@
+# Generated by Django 5.1 on 2026-10-18 13:05
+
+import uuid
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def write_opening_balances(apps, schema_editor):
+    """Existing balances are moved to ledger as transfers from external account"""
+    Card = apps.get_model('database_models', 'Card')
+    Company = apps.get_model('database_models', 'Company')
+    CompanyBalanceShard = apps.get_model('database_models', 'CompanyBalanceShard')
+    LedgerEntry = apps.get_model('database_models', 'LedgerEntry')
+
+    balances = [('card', card_id, balance) for card_id, balance in Card.objects.values_list('id', '_balance')]
+    for company_id, balance in Company.objects.values_list('id', '_balance'):
+        shards = CompanyBalanceShard.objects.filter(company_id=company_id).aggregate(total=models.Sum('_balance'))
+        balances.append(('company', company_id, balance + (shards['total'] or 0)))
+
+    entries = []
+    for account_type, account_id, balance in balances:
+        if balance:
+            transfer = uuid.uuid4()
+            entries.append(LedgerEntry(transfer=transfer, kind='opening', account_type='external', account_id=0, amount=-balance))
+            entries.append(LedgerEntry(transfer=transfer, kind='opening', account_type=account_type, account_id=account_id, amount=balance))
+    LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0025_companybalanceshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transfer', models.UUIDField()),
+                ('kind', models.CharField(choices=[('opening', 'opening'), ('payment', 'payment'), ('card_top_up', 'card_top_up'), ('company_top_up', 'company_top_up'), ('balance_request', 'balance_request')], max_length=20)),
+                ('account_type', models.CharField(choices=[('card', 'card'), ('company', 'company'), ('external', 'external')], max_length=10)),
+                ('account_id', models.BigIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account_type', 'account_id', 'id'], include=('amount', 'created'), name='ledger_account_history_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_type', models.CharField(choices=[('card', 'card'), ('company', 'company'), ('external', 'external')], max_length=10)),
+                ('account_id', models.BigIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('last_entry_id', models.BigIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account_type', 'account_id', '-last_entry_id'], include=('balance',), name='ledger_snapshot_latest_idx')],
+            },
+        ),
+        migrations.RunPython(write_opening_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0026_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='data',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='receipt',
+            name='render_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('on_demand', 'on_demand'), ('rendering', 'rendering'), ('ready', 'ready'), ('failed', 'failed')], db_index=True, default='pending'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1 on 2026-10-18 13:34
+
+import database_models.receipt_storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0028_receipt_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='preview',
+            field=models.ImageField(blank=True, null=True, storage=database_models.receipt_storage.get_receipt_storage, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1 on 2026-10-18 13:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0029_receipt_preview'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['card', '-created', '-id'], name='transaction_card_created_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1 on 2026-10-18 14:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0030_transaction_card_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['card', 'company', '-created', '-id'], name='transaction_card_company_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['card', 'amount', 'id'], name='transaction_card_amount_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 14:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database_models', '0031_transaction_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='request_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -1,15 +1,29 @@
 import logging
 import os
 import hashlib
+from datetime import datetime
+from io import BytesIO
 from random import randint
 from decimal import Decimal
 
+from django.conf import settings
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.db.utils import IntegrityError
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .receipt_storage import get_content_name, get_receipt_storage
 from .utils import check_hex_digit, get_random_goods_with_all_amount
-from receipt_creation.receipt_builder import ReceiptBuilder, ReceiptData, ReceiptDataItem
+from receipt_creation.encoders import ENCODERS, ReceiptEncoder
+from receipt_creation.receipt_builder import (
+    ReceiptBuilder,
+    ReceiptData,
+    make_receipt_data,
+    dump_receipt_data,
+    load_receipt_data,
+)
 
 
 class Profile(models.Model):
@@ -125,11 +139,21 @@ class Company(models.Model):
 
     @property
     def balance(self):
+        """Company balance is its own _balance plus not yet folded balance shards, which are summed only if they
+        are loaded by prefetch_related("balance_shards") (lists of companies). Otherwise it is the folded
+        balance, use get_balance() to read shards too. Balance is changed by top_up_company and payments.
+
+        """
+        shards = getattr(self, "_prefetched_objects_cache", {}).get("balance_shards")
+        if shards is not None:
+            return self._balance + sum((shard._balance for shard in shards), Decimal(0))
         return self._balance
 
-    @balance.setter
-    def balance(self, new_balance: Decimal):
-        self._balance = new_balance
+    def get_balance(self) -> Decimal:
+        """Folded _balance plus balance shards, shards are read with one query unless they are prefetched"""
+        if self.pk is None or "balance_shards" in getattr(self, "_prefetched_objects_cache", {}):
+            return self.balance
+        return self._balance + (self.balance_shards.aggregate(total=models.Sum("_balance"))["total"] or Decimal(0))
 
     @property
     def address(self):
@@ -164,6 +188,24 @@ class Company(models.Model):
         self.save()
 
 
+class CompanyBalanceShard(models.Model):
+    """Part of company balance which payments are credited to, so payments to one company do not wait
+    for each other on the company row. Shards are folded to Company._balance by fold_company_balances command
+    """
+
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name="balance_shards")
+    shard = models.PositiveSmallIntegerField()
+    _balance = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["company", "shard"], name="unique_company_balance_shard")]
+
+    def __str__(self):
+        return f"Company balance shard: {self.company_id} - {self.shard}"
+
+
 class Product(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(null=True, blank=True)
@@ -179,7 +221,21 @@ class Product(models.Model):
 
 
 class Receipt(models.Model):
-    img = models.ImageField(upload_to="uploads/%Y/%m/%d/", blank=True, null=True)
+    # on_demand receipts are not rendered by worker, only when image is requested (no one is notified about them)
+    RENDER_STATUSES = {
+        "pending": "pending",
+        "on_demand": "on_demand",
+        "rendering": "rendering",
+        "ready": "ready",
+        "failed": "failed",
+    }
+    BACKGROUND_PATH = "media/receipt_background.jpg"
+    TEMPLATE_PATH = "media/exact_receipt.jpg"
+
+    img = models.ImageField(upload_to="uploads/%Y/%m/%d/", storage=get_receipt_storage, blank=True, null=True)
+    preview = models.ImageField(storage=get_receipt_storage, blank=True, null=True)  # small variant for telegram
+    render_status = models.CharField(choices=RENDER_STATUSES, default=RENDER_STATUSES["pending"], db_index=True)
+    data = models.JSONField(blank=True, null=True)  # see dump_receipt_data
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -187,67 +243,93 @@ class Receipt(models.Model):
     def __str__(self):
         return f"Receipt: {self.img}"
 
-    def get_receipt_img(self):
-        if not self.img:
-            img = self._generate_receipt_img()
+    def get_receipt_img(self, rerender: bool = False):
+        """Render image if there is no one yet, or render it again. Failed rerender keeps previous image"""
+        if not self.img or rerender:
+            img, preview = self._generate_receipt_img()
             if img:
                 self.img = img
-                self.save()
+                self.preview = preview
+                self.render_status = self.RENDER_STATUSES["ready"]
+            elif not self.img:
+                self.render_status = self.RENDER_STATUSES["failed"]
+            self.save()
 
         return self.img
 
-    def _generate_receipt_img(self) -> str:
-        try:
-            year, month, day, hour, minute = (
-                self.created.year,
-                self.created.month,
-                self.created.day,
-                self.created.hour,
-                self.created.minute,
+    @staticmethod
+    def make_data(company: Company, card_number: str, amount: Decimal, created: datetime) -> dict:
+        """Data printed on receipt (products are random).
+
+        It is made at payment time, so receipt keeps texts of company at purchase time however late it is rendered.
+
+        """
+        return dump_receipt_data(
+            make_receipt_data(
+                company.name,
+                company.address,
+                company.hotline_phone,
+                created,
+                get_random_goods_with_all_amount(amount),
+                amount,
+                f"**** **** **** {(card_number or '')[-4:]}",
+            )
+        )
+
+    def get_receipt_data(self) -> ReceiptData:
+        """Data printed on receipt, receipts made before data was stored at payment time get it on first render"""
+        if self.data is None:
+            transaction = self.transaction
+            self.data = self.make_data(
+                transaction.company, transaction.card.card_number, transaction.amount, self.created
             )
+        return load_receipt_data(self.data)
+
+    def get_image(self, preview: bool = False):
+        """Full image or its preview, receipts rendered before previews have only full image"""
+        return self.preview if preview and self.preview else self.img
+
+    def get_img_etag(self, preview: bool = False) -> str:
+        """Image name is hash of its content (names of older receipts are unique too)"""
+        return f'"{os.path.splitext(os.path.basename(self.get_image(preview).name))[0]}"'
 
-            new_receipt_image_path = (
-                f"media/uploads/{year}/{month}/{day}/receipt_{year}_{month}_{day}_{hour}_{minute}.jpg"
+    def get_img_url(self, preview: bool = False) -> str:
+        """Absolute url of rendered receipt image, site domain is taken from CURRENT_SITE_DOMAIN service setting"""
+        site_domain = ServiceSetting.objects.filter(name="CURRENT_SITE_DOMAIN").first()
+        domain = site_domain.get_value().rstrip("/") if site_domain is not None else ""
+        return f"{domain}/{settings.MEDIA_URL}{self.get_image(preview)}"
+
+    def _generate_receipt_img(self) -> tuple[str, str]:
+        """Render receipt and save its image and preview, returns their names or empty strings on error"""
+        try:
+            receipt_creator = ReceiptBuilder(self.BACKGROUND_PATH, self.TEMPLATE_PATH)
+            data = self.get_receipt_data()
+            logging.log(logging.DEBUG, "Data for making receipt: %s", data)
+            transaction = self.transaction
+            receipt_creator.set_params(data, (transaction.company_id, transaction.company.updated))
+
+            image_encoder = ENCODERS[settings.RECEIPT_IMAGE_FORMAT]
+            image_file = BytesIO()
+            image_size = receipt_creator.make_receipt(image_file, image_encoder)
+            preview_encoder = ENCODERS[settings.RECEIPT_PREVIEW_FORMAT]
+            preview_file = BytesIO()
+            preview_size = receipt_creator.encode_receipt(preview_file, preview_encoder)
+            logging.log(
+                logging.INFO, "Receipt %s encoded, size: %s, preview: %s bytes", self.id, image_size, preview_size
             )
-            if not os.path.exists(os.path.dirname(new_receipt_image_path)):
-                logging.log(logging.INFO, "Dirs for storing receipt created")
-                os.makedirs(os.path.dirname(new_receipt_image_path))
-            else:
-                logging.log(
-                    logging.INFO, f"Dirs for storing receipt already created: {os.path.dirname(new_receipt_image_path)}"
-                )
-
-            receipt_creator = ReceiptBuilder(
-                "media/receipt_background.jpg", "media/exact_receipt.jpg", new_receipt_image_path
+
+            return self._save_image_file(image_file, image_encoder), self._save_image_file(
+                preview_file, preview_encoder
             )
-            products = get_random_goods_with_all_amount(self.transaction.amount)
-            products_part_height = (
-                30 + len(products) * 25 + 5
-            )  # top border height + products height + bottom border height
-
-            data: ReceiptData = {
-                "header": {
-                    "title": ReceiptDataItem(self.transaction.company.name, 70),
-                    "address": ReceiptDataItem(self.transaction.company.address, 30),
-                    "hotline_phone": ReceiptDataItem(self.transaction.company.hotline_phone, 30),
-                    "datetime": ReceiptDataItem(self.created, 20),
-                },
-                "body": {
-                    "products": ReceiptDataItem(products, products_part_height),
-                    "amount": ReceiptDataItem(self.transaction.amount, 30),
-                },
-                "footer": {
-                    "card_number": ReceiptDataItem(f"**** **** **** {self.transaction.card.card_number[-4:]}", 30),
-                    "wish_phrase": ReceiptDataItem("THANK YOU FOR SHOPPING!", 30),
-                },
-            }
-            logging.log(logging.INFO, f"Data for making receipt: {data}")
-            receipt_creator.set_params(data)
-            receipt_creator.make_receipt()
-            return new_receipt_image_path.replace("media/", "")
         except Exception as ex:
-            logging.log(logging.INFO, f"Error. {str(ex)}")
-            return ""
+            logging.log(logging.INFO, "Error. %s", ex)
+            return "", ""
+
+    def _save_image_file(self, image_file: BytesIO, encoder: ReceiptEncoder) -> str:
+        # identical receipts get the same name and share one file
+        name = get_content_name(image_file.getbuffer(), encoder.extension)
+        image_file.seek(0)
+        return self.img.storage.save(name, File(image_file))
 
 
 class Transaction(models.Model):
@@ -265,10 +347,81 @@ class Transaction(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # history of card, pages of it start after (created, id) of previous page (see KeysetPagination)
+            models.Index(fields=["card", "-created", "-id"], name="transaction_card_created_idx"),
+            # purchases of card in company by date, e.g. "all my purchases at X last month"
+            models.Index(fields=["card", "company", "-created", "-id"], name="transaction_card_company_idx"),
+            # amount range and ordering by amount
+            models.Index(fields=["card", "amount", "id"], name="transaction_card_amount_idx"),
+        ]
+
     def __str__(self):
         return f"Transaction: {self.card.card_number}"
 
 
+class LedgerEntry(models.Model):
+    """Insert-only half of balance movement. Every movement (transfer) is written as two entries
+    with opposite amounts, so sum of all entries is always zero. Money which comes from outside
+    (balance top ups) is taken from external account
+    """
+
+    ACCOUNT_TYPES = {"card": "card", "company": "company", "external": "external"}
+    KINDS = {
+        "opening": "opening",
+        "payment": "payment",
+        "card_top_up": "card_top_up",
+        "company_top_up": "company_top_up",
+        "balance_request": "balance_request",
+    }
+    EXTERNAL_ACCOUNT_ID = 0
+
+    transfer = models.UUIDField()
+    kind = models.CharField(max_length=20, choices=KINDS)
+    account_type = models.CharField(max_length=10, choices=ACCOUNT_TYPES)
+    account_id = models.BigIntegerField()
+    amount = models.DecimalField(max_digits=15, decimal_places=2)  # positive is credit, negative is debit
+
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # account history and balance since snapshot are read from this index only
+            models.Index(
+                fields=["account_type", "account_id", "id"],
+                include=["amount", "created"],
+                name="ledger_account_history_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"Ledger entry: {self.account_type} {self.account_id} {self.amount}"
+
+
+class LedgerSnapshot(models.Model):
+    """Balance of ledger account after all entries up to last_entry_id, made by snapshot_ledger_balances command"""
+
+    account_type = models.CharField(max_length=10, choices=LedgerEntry.ACCOUNT_TYPES)
+    account_id = models.BigIntegerField()
+    balance = models.DecimalField(max_digits=15, decimal_places=2)
+    last_entry_id = models.BigIntegerField()
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["account_type", "account_id", "-last_entry_id"],
+                include=["balance"],
+                name="ledger_snapshot_latest_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"Ledger snapshot: {self.account_type} {self.account_id} {self.balance}"
+
+
 class ServiceSetting(models.Model):
     class TYPES(models.TextChoices):
         INT = (
@@ -318,3 +471,59 @@ class IncreaseBalanceRequest(models.Model):
 
     def __str__(self):
         return f"Increase Balance Request: requested money - {self.requested_money}, card - {self.card.card_number}"
+
+
+class Notification(models.Model):
+    """Outbox of telegram messages, rows are written in the same db transaction as the event
+    and delivered later by dispatch_notifications command
+
+    """
+
+    KINDS = {"message": "message", "receipt": "receipt"}
+    STATUSES = {"pending": "pending", "sent": "sent", "failed": "failed", "skipped": "skipped"}
+
+    kind = models.CharField(choices=KINDS, default=KINDS["message"])
+    telegram_chat_id = models.CharField(max_length=20)
+    text = models.TextField(blank=True, default="")  # message text or receipt photo caption
+    receipt = models.ForeignKey(
+        to=Receipt, on_delete=models.PROTECT, null=True, blank=True, related_name="notifications"
+    )
+    delivery_status = models.CharField(choices=STATUSES, default=STATUSES["pending"])
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(delivery_status="pending"),
+                name="notification_pending_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"Notification: {self.kind} to {self.telegram_chat_id} - {self.delivery_status}"
+
+
+class IdempotencyKey(models.Model):
+    """Response of terminal payment request stored by Idempotency-Key, so retried request is replayed"""
+
+    key = models.CharField(max_length=64)
+    company_token = models.CharField(max_length=15, blank=True, default="")  # keys are unique per terminal company
+    request_hash = models.CharField(max_length=64, blank=True, default="")  # payment of key, see get_request_hash
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(encoder=DjangoJSONEncoder, null=True, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["company_token", "key"], name="unique_idempotency_key")]
+
+    def __str__(self):
+        return f"Idempotency key: {self.key}"
@@ -0,0 +1,99 @@
+import logging
+from datetime import timedelta
+
+from django.db import transaction as django_transaction
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from receipt_creation.glyph_atlas import get_glyph_atlas
+from receipt_creation.header_strips import invalidate_header_strip
+from receipt_creation.receipt_builder import HEADER_FONT_SIZE, PARAGRAPH_FONT_SIZE
+from receipt_creation.template_registry import MONOSPACE_FONT_PATH, template_registry
+from .models import Company, Receipt
+
+
+def claim_pending_receipts(batch_size: int) -> list[int]:
+    """Mark up to batch_size pending receipts as rendering and return their ids.
+
+    Rows locked by another worker are skipped, so several workers can drain the same queue.
+
+    """
+    with django_transaction.atomic():
+        receipt_ids = list(
+            Receipt.objects.select_for_update(skip_locked=True)
+            .filter(render_status=Receipt.RENDER_STATUSES["pending"])
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        Receipt.objects.filter(id__in=receipt_ids).update(
+            render_status=Receipt.RENDER_STATUSES["rendering"], updated=timezone.now()
+        )
+    return receipt_ids
+
+
+def release_stale_receipts(stale_after: int) -> int:
+    """Return receipts stuck in rendering (worker was killed) back to the pending queue"""
+    stale_border = timezone.now() - timedelta(seconds=stale_after)
+    return Receipt.objects.filter(render_status=Receipt.RENDER_STATUSES["rendering"], updated__lt=stale_border).update(
+        render_status=Receipt.RENDER_STATUSES["pending"], updated=timezone.now()
+    )
+
+
+def render_receipt(receipt_id: int) -> str:
+    """Render receipt image, returns new render status. Telegram delivery is done by dispatch_notifications
+
+    Claimed receipt can still be requested by user, request renders it under lock of the row, so worker waits
+    for the lock and does not render receipt which got its image meanwhile.
+
+    """
+    with django_transaction.atomic():
+        receipt = (
+            Receipt.objects.select_for_update(of=("self",))
+            .select_related("transaction__card", "transaction__company")
+            .get(pk=receipt_id)
+        )
+        if receipt.img:
+            return receipt.render_status
+        receipt.get_receipt_img()
+    logging.log(logging.INFO, "Receipt %s rendered with status: %s", receipt_id, receipt.render_status)
+    return receipt.render_status
+
+
+def rerender_receipt(receipt_id: int) -> str:
+    """Render receipt image again (or first time), returns new render status or skipped.
+
+    Receipt which is rendered by worker or on request at the same moment is skipped.
+
+    """
+    with django_transaction.atomic():
+        receipt = (
+            Receipt.objects.select_for_update(skip_locked=True, of=("self",))
+            .select_related("transaction__card", "transaction__company")
+            .filter(pk=receipt_id)
+            .exclude(render_status=Receipt.RENDER_STATUSES["rendering"])
+            .first()
+        )
+        if receipt is None:
+            return "skipped"
+        receipt.get_receipt_img(rerender=True)
+    logging.log(logging.INFO, "Receipt %s rendered again with status: %s", receipt_id, receipt.render_status)
+    return receipt.render_status
+
+
+def preload_receipt_templates():
+    """Decode receipt templates and fonts and rasterize glyph atlases once per render process"""
+    template_registry.preload(
+        [Receipt.BACKGROUND_PATH, Receipt.TEMPLATE_PATH],
+        [(MONOSPACE_FONT_PATH, HEADER_FONT_SIZE), (MONOSPACE_FONT_PATH, PARAGRAPH_FONT_SIZE)],
+    )
+    for font_size in (HEADER_FONT_SIZE, PARAGRAPH_FONT_SIZE):
+        get_glyph_atlas(template_registry.get_font(MONOSPACE_FONT_PATH, font_size))
+
+
+def invalidate_company_header(sender, instance: Company, **kwargs):
+    invalidate_header_strip(instance.id)
+
+
+def connect_signals():
+    post_save.connect(invalidate_company_header, sender=Company)
+    post_delete.connect(invalidate_company_header, sender=Company)
@@ -0,0 +1,55 @@
+import os
+import hashlib
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+RECEIPTS_DIR = "receipts"
+
+
+def get_content_name(content: bytes, extension: str) -> str:
+    """receipts/ab/cd/abcd...ef.jpg - two levels of 256 directories, so no directory grows too big"""
+    digest = hashlib.sha256(content).hexdigest()
+    return f"{RECEIPTS_DIR}/{digest[:2]}/{digest[2:4]}/{digest}.{extension}"
+
+
+class ReceiptStorage(FileSystemStorage):
+    """Media storage for content addressed receipt images.
+
+    File with the same name has the same content, so it is not written again (identical receipts share one file)
+    and files are never overwritten or deleted when receipt is rendered again. New file is written to temporary
+    file and renamed, nginx and telegram never get partly written image.
+
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name  # the same name is the same content, see _save
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            return name
+
+        directory = os.path.dirname(full_path)
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        except FileNotFoundError:  # directories are created only once, not checked on every save
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                for chunk in content.chunks():
+                    temp_file.write(chunk)
+            os.chmod(temp_path, self.file_permissions_mode or 0o644)  # mkstemp creates file only for owner
+            os.replace(temp_path, full_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return name
+
+
+receipt_storage = ReceiptStorage()
+
+
+def get_receipt_storage() -> ReceiptStorage:
+    return receipt_storage
@@ -45,11 +45,19 @@ class ProductSerializer(serializers.ModelSerializer):
 class ReceiptSerializer(serializers.ModelSerializer):
     class Meta:
         model = Receipt
-        fields = ["img", "created", "updated"]
-        extra_kwargs = {"created": {"read_only": True}, "updated": {"read_only": True}}
+        fields = ["id", "img", "render_status", "data", "created", "updated"]
+        extra_kwargs = {
+            "render_status": {"read_only": True},
+            "data": {"read_only": True},
+            "created": {"read_only": True},
+            "updated": {"read_only": True},
+        }
 
 
 class CompanySerializer(serializers.ModelSerializer):
+    # with not yet folded balance shards if they are prefetched, see Company.balance
+    _balance = serializers.DecimalField(source="balance", max_digits=15, decimal_places=2, read_only=True)
+
     class Meta:
         model = Company
         fields = ["name", "_balance", "hotline_phone", "country", "city", "street", "building", "created", "updated"]
@@ -60,7 +68,6 @@ class CompanySerializer(serializers.ModelSerializer):
             "city": {"required": True},
             "street": {"required": True},
             "building": {"required": True},
-            "_balance": {"read_only": True},
             "created": {"read_only": True},
             "updated": {"read_only": True},
         }
@@ -102,6 +109,31 @@ class TransactionSerializer(serializers.ModelSerializer):
         extra_kwargs = {"created": {"read_only": True}, "updated": {"read_only": True}}
 
 
+class FlatTransactionSerializer(serializers.ModelSerializer):
+    """Transaction in one level, without card owner and company details (list of user transactions with ?shape=flat)"""
+
+    card_number = serializers.CharField(source="card._card_number")
+    company_name = serializers.CharField(source="company.name")
+    receipt_id = serializers.IntegerField()
+    receipt_img = serializers.ImageField(source="receipt.img")
+    receipt_render_status = serializers.CharField(source="receipt.render_status")
+
+    class Meta:
+        model = Transaction
+        fields = [
+            "id",
+            "amount",
+            "card_number",
+            "company_name",
+            "receipt_id",
+            "receipt_img",
+            "receipt_render_status",
+            "card_balance_after",
+            "created",
+        ]
+        read_only_fields = fields
+
+
 class IncreaseBalanceRequestSerializer(serializers.ModelSerializer):
     card = CardSerializer()
 
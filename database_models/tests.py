@@ -1,11 +1,69 @@
+import os
+import json
+import math
+import hashlib
 import string
+import tempfile
+from io import BytesIO, StringIO
 from decimal import Decimal
-
-from django.db import models
-from django.test import TestCase
+from datetime import timedelta
+from unittest.mock import patch, AsyncMock
+
+from asgiref.sync import async_to_sync
+import numpy as np
+from PIL import Image, ImageDraw
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import models, connection
+from django.test import TestCase, LiveServerTestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
-
-from .models import Profile, Card, Company, Product, Receipt, Transaction, ServiceSetting, IncreaseBalanceRequest
+from rest_framework.authtoken.models import Token
+
+from .models import (
+    Profile,
+    Card,
+    Company,
+    Product,
+    Receipt,
+    Transaction,
+    ServiceSetting,
+    IncreaseBalanceRequest,
+    Notification,
+    CompanyBalanceShard,
+    LedgerEntry,
+    LedgerSnapshot,
+)
+from .balances import fold_company_balances, top_up_company
+from .management.commands.benchmark_payments import get_percentiles
+from .ledger import (
+    make_transfer_entries,
+    get_ledger_balance,
+    snapshot_ledger_balances,
+    card_account,
+    company_account,
+    EXTERNAL_ACCOUNT,
+)
+from .receipt_storage import ReceiptStorage, get_content_name
+from .entity_cache import EntityCache, card_cache, company_cache
+from receipt_creation.generate_barcode import barcode_cache, generate_barcode_img
+from receipt_creation.benchmarks import make_sample_receipt_data
+from receipt_creation.encoders import ENCODERS, ReceiptEncoder
+from receipt_creation.glyph_atlas import AtlasBackend, blend_coverage, get_glyph_atlas
+from receipt_creation.header_strips import header_strips
+from receipt_creation.layout import PRODUCT_GAP, TextItem, ImageItem, PillowBackend, get_font_metrics, wrap_text
+from receipt_creation.receipt_builder import (
+    HEADER_FONT_SIZE,
+    PARAGRAPH_FONT_SIZE,
+    STRIP_HEIGHT,
+    ReceiptBuilder,
+    stretch_template,
+)
+from receipt_creation.template_registry import MONOSPACE_FONT_PATH, TemplateRegistry, template_registry
+from telegram_bot.bot import bot
+from telegram_bot.notification_dispatcher import NotificationDispatcher
+from telegram_bot.receipt_photos import get_receipt_photo
 
 
 def check_created_updated_fields(instance: models.Model):
@@ -122,6 +180,75 @@ class CompanyTestCase(TestCase):
         check_created_updated_fields(self.company)
 
 
+class CompanyBalanceShardTestCase(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Company", _balance=10)
+        CompanyBalanceShard.objects.create(company=self.company, shard=0, _balance=5)
+        CompanyBalanceShard.objects.create(company=self.company, shard=3, _balance=Decimal("2.50"))
+
+    def test_balance_includes_shards(self):
+        self.assertEqual(self.company.get_balance(), Decimal("17.50"))
+        self.assertEqual(self.company.balance, Decimal(10))  # shards are not loaded
+
+        company = Company.objects.prefetch_related("balance_shards").get(id=self.company.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(company.balance, Decimal("17.50"))
+            self.assertEqual(company.get_balance(), Decimal("17.50"))
+
+    def test_top_up_keeps_shards(self):
+        top_up_company(self.company.id, Decimal(10))
+        self.assertEqual(self.company.get_balance(), Decimal("27.50"))
+        self.company.refresh_from_db()
+        self.assertEqual(self.company._balance, Decimal(10))  # company row is not changed
+
+    def test_fold_company_balances(self):
+        other_company = Company.objects.create(name="Other company")
+        updated = self.company.updated
+        self.assertEqual(fold_company_balances(), 1)
+
+        self.company.refresh_from_db()
+        self.assertEqual(self.company.updated, updated)  # header strips of receipts stay cached
+        other_company.refresh_from_db()
+        self.assertEqual(self.company._balance, Decimal("17.50"))
+        self.assertEqual(self.company.get_balance(), Decimal("17.50"))
+        self.assertEqual(other_company.get_balance(), Decimal(0))
+        self.assertFalse(CompanyBalanceShard.objects.exists())
+
+
+class LedgerTestCase(TestCase):
+    def setUp(self):
+        self.card = card_account(1)
+        self.company = company_account(1)
+        entries = make_transfer_entries("card_top_up", EXTERNAL_ACCOUNT, self.card, Decimal(100))
+        entries += make_transfer_entries("payment", self.card, self.company, Decimal(30))
+        LedgerEntry.objects.bulk_create(entries)
+
+    def test_transfer_is_balanced(self):
+        entries = make_transfer_entries("payment", self.card, self.company, Decimal(5))
+        self.assertEqual(entries[0].transfer, entries[1].transfer)
+        self.assertEqual(entries[0].amount + entries[1].amount, 0)
+
+    def test_ledger_balance(self):
+        self.assertEqual(get_ledger_balance(self.card), Decimal(70))
+        self.assertEqual(get_ledger_balance(self.company), Decimal(30))
+        self.assertEqual(get_ledger_balance(company_account(2)), Decimal(0))
+
+    def test_balance_from_snapshot_and_later_entries(self):
+        self.assertEqual(snapshot_ledger_balances(timedelta(0)), 3)
+        self.assertEqual(LedgerSnapshot.objects.get(account_type="card", account_id=1).balance, Decimal(70))
+
+        LedgerEntry.objects.bulk_create(make_transfer_entries("payment", self.card, self.company, Decimal(20)))
+        self.assertEqual(get_ledger_balance(self.card), Decimal(50))
+        self.assertEqual(get_ledger_balance(self.company), Decimal(50))
+
+        self.assertEqual(snapshot_ledger_balances(timedelta(0)), 2)
+        self.assertEqual(get_ledger_balance(self.card), Decimal(50))
+
+    def test_new_entries_are_not_snapshotted(self):
+        self.assertEqual(snapshot_ledger_balances(timedelta(minutes=1)), 0)
+        self.assertFalse(LedgerSnapshot.objects.exists())
+
+
 class ProductTestCase(TestCase):
     def setUp(self):
         self.company = Company.objects.create(
@@ -155,6 +282,7 @@ class ReceiptTestCase(TestCase):
 
     def test_receipt_values(self):
         self.assertEqual(str(self.receipt.img), "")
+        self.assertEqual(self.receipt.render_status, "pending")
 
     def test_created_updated_fields(self):
         check_created_updated_fields(self.receipt)
@@ -277,3 +405,694 @@ class IncreaseBalanceRequestTestCase(TestCase):
 
     def test_created_updated_fields(self):
         check_created_updated_fields(self.balance_request)
+
+
+class NotificationTestCase(TestCase):
+    def setUp(self):
+        self.notification = Notification.objects.create(telegram_chat_id="1111111", text="Hello")
+
+    def test_notification_values(self):
+        self.assertEqual(self.notification.kind, "message")
+        self.assertEqual(self.notification.delivery_status, "pending")
+        self.assertEqual(self.notification.attempts, 0)
+        self.assertIsNone(self.notification.receipt)
+        self.assertIsNone(self.notification.sent_at)
+
+    def test_created_updated_fields(self):
+        check_created_updated_fields(self.notification)
+
+
+@patch("telegram_bot.notification_dispatcher.bot.session.close", new_callable=AsyncMock)
+class NotificationDispatcherTestCase(TestCase):
+    def setUp(self):
+        self.dispatcher = NotificationDispatcher(backoff_base=10)
+        self.message = Notification.objects.create(telegram_chat_id="1111111", text="Hello")
+
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        self.token = Token.objects.create(user=user)
+        card = Card.objects.create(owner=Profile.objects.create(user=user, telegram_chat_id="1111111"))
+        company = Company.objects.create(name="Company")
+        self.receipt = Receipt.objects.create()
+        Transaction.objects.create(card=card, company=company, receipt=self.receipt, amount=10)
+        self.receipt_notification = Notification.objects.create(
+            kind="receipt", telegram_chat_id="1111111", text="Card balance: 90.00", receipt=self.receipt
+        )
+
+    @patch("telegram_bot.notification_dispatcher.send_message", new_callable=AsyncMock)
+    def test_message_sent(self, send_message, _):
+        async_to_sync(self.dispatcher.run)(once=True)
+
+        send_message.assert_awaited_once_with("1111111", "Hello")
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.delivery_status, "sent")
+        self.assertEqual(self.message.attempts, 1)
+        self.assertIsNotNone(self.message.sent_at)
+
+    @patch("telegram_bot.notification_dispatcher.send_message", new_callable=AsyncMock)
+    def test_receipt_waits_for_render(self, send_message, _):
+        async_to_sync(self.dispatcher.run)(once=True)
+
+        self.receipt_notification.refresh_from_db()
+        self.assertEqual(self.receipt_notification.delivery_status, "pending")
+        self.assertEqual(self.receipt_notification.attempts, 0)
+
+    @patch("telegram_bot.notification_dispatcher.send_receipt", new_callable=AsyncMock)
+    @patch("telegram_bot.notification_dispatcher.send_message", new_callable=AsyncMock)
+    def test_rendered_receipt_sent_to_logged_in_owner(self, send_message, send_receipt, _):
+        self.receipt.img = "uploads/receipt.jpg"
+        self.receipt.preview = "receipts/ab/cd/preview.png"
+        self.receipt.render_status = "ready"
+        self.receipt.save()
+
+        async_to_sync(self.dispatcher.run)(once=True)
+
+        send_receipt.assert_awaited_once()
+        self.assertTrue(send_receipt.await_args.args[0].endswith("/media/receipts/ab/cd/preview.png"))
+        self.receipt_notification.refresh_from_db()
+        self.assertEqual(self.receipt_notification.delivery_status, "sent")
+
+    @patch("telegram_bot.notification_dispatcher.send_receipt", new_callable=AsyncMock)
+    @patch("telegram_bot.notification_dispatcher.send_message", new_callable=AsyncMock)
+    def test_receipt_skipped_for_logged_out_owner(self, send_message, send_receipt, _):
+        self.token.delete()
+        self.receipt.render_status = "ready"
+        self.receipt.save()
+
+        async_to_sync(self.dispatcher.run)(once=True)
+
+        send_receipt.assert_not_awaited()
+        self.receipt_notification.refresh_from_db()
+        self.assertEqual(self.receipt_notification.delivery_status, "skipped")
+
+    @patch("telegram_bot.notification_dispatcher.send_message", new_callable=AsyncMock, side_effect=OSError("timeout"))
+    def test_failed_delivery_retried_with_backoff(self, send_message, _):
+        async_to_sync(self.dispatcher.run)(once=True)
+
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.delivery_status, "pending")
+        self.assertEqual(self.message.attempts, 1)
+        self.assertEqual(self.message.last_error, "timeout")
+        self.assertGreater(self.message.next_attempt_at, self.message.updated)
+
+        self.message.attempts = self.dispatcher.max_attempts - 1
+        self.message.next_attempt_at = self.message.created
+        self.message.save()
+        async_to_sync(self.dispatcher.run)(once=True)
+
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.delivery_status, "failed")
+
+
+class EntityCacheTestCase(TestCase):
+    def setUp(self):
+        card_cache.clear()
+        company_cache.clear()
+        self.user = User.objects.create(username="testname", email="test@gmail.com")
+        self.profile = Profile.objects.create(user=self.user, telegram_chat_id="1111111")
+        self.card = Card.objects.create(owner=self.profile)
+        self.card.card_uid = "b2af5522"
+        self.card.save()
+
+    def test_card_cached_after_first_lookup(self):
+        self.assertEqual(card_cache.get("b2af5522"), {"id": self.card.id, "owner_id": self.profile.id})
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(card_cache.get("b2af5522")["id"], self.card.id)
+        self.assertEqual(len(context.captured_queries), 0)
+        self.assertEqual(card_cache.stats, {"local_hits": 1, "redis_hits": 0, "misses": 1})
+
+    def test_unknown_card_not_cached(self):
+        self.assertIsNone(card_cache.get("00000000"))
+        self.card.card_uid = "00000000"
+        self.card.save()
+        self.assertEqual(card_cache.get("00000000")["id"], self.card.id)
+
+    def test_card_invalidated_on_uid_change_and_delete(self):
+        card_cache.get("b2af5522")
+        self.card.card_uid = "c3bf6633"
+        self.card.save()
+        self.assertIsNone(card_cache.get("b2af5522"))
+        self.assertEqual(card_cache.get("c3bf6633")["id"], self.card.id)
+
+        self.card.delete()
+        self.assertIsNone(card_cache.get("c3bf6633"))
+
+    def test_balance_change_keeps_cache(self):
+        card_cache.get("b2af5522")
+        self.card.balance = Decimal(100)
+        self.card.save()
+        self.assertIn("b2af5522", card_cache.local)
+
+    def test_company_invalidated_on_token_change(self):
+        company = Company.objects.create(name="Company")
+        company.generate_token()
+        old_token = company.company_token
+        self.assertEqual(company_cache.get(old_token), {"id": company.id})
+
+        company.name = "Renamed company"
+        company.generate_token()
+        self.assertIsNone(company_cache.get(old_token))
+        self.assertEqual(company_cache.get(company.company_token), {"id": company.id})
+
+    def test_deferred_rows_are_loaded_without_identity(self):
+        companies = Company.objects.bulk_create(Company(name=f"Company {number}") for number in range(5))
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(len(list(Card.objects.only("id", "_card_number"))), 1)
+            self.assertEqual(len(list(Card.objects.defer("_card_uid"))), 1)
+            self.assertEqual(len(list(Card.objects.only("id", "_card_uid"))), 1)
+            self.assertEqual(len(list(Company.objects.only("name"))), 5)
+        self.assertEqual(len(context.captured_queries), 4)
+
+        company = Company.objects.only("name").get(pk=companies[0].pk)
+        company.generate_token()
+        self.assertEqual(company_cache.get(company.company_token), {"id": company.id})
+
+    def test_deferred_card_invalidated_on_uid_change_and_delete(self):
+        card_cache.get("b2af5522")
+        card = Card.objects.only("id", "_balance").get(pk=self.card.pk)
+        card.card_uid = "c3bf6633"
+        card.save()
+        self.assertIsNone(card_cache.get("b2af5522"))
+        self.assertEqual(card_cache.get("c3bf6633")["id"], self.card.id)
+
+        Card.objects.only("id").get(pk=self.card.pk).delete()
+        self.assertIsNone(card_cache.get("c3bf6633"))
+
+    def test_local_cache_size_is_bounded(self):
+        cache = EntityCache("test", lambda key: {"key": key}, local_size=2, local_ttl=60)
+        cache.get("a")
+        cache.get("b")
+        cache.get("a")  # "b" is least recently used now
+        cache.get("c")
+        self.assertEqual(list(cache.local), ["a", "c"])
+
+    def test_local_entries_expire(self):
+        cache = EntityCache("test", lambda key: {"key": key}, local_size=2, local_ttl=0)
+        cache.get("a")
+        cache.get("a")
+        self.assertEqual(cache.stats["misses"], 2)
+
+
+class BenchmarkPaymentsTestCase(LiveServerTestCase):
+    def test_percentiles(self):
+        percentiles = get_percentiles([float(value) for value in range(1, 101)])
+        self.assertAlmostEqual(percentiles["p50"], 50.5)
+        self.assertAlmostEqual(percentiles["p99"], 99.01)
+        self.assertEqual(get_percentiles([]), {"p50": 0.0, "p95": 0.0, "p99": 0.0})
+
+    def test_benchmark_report(self):
+        ServiceSetting.objects.create(name="CURRENT_SITE_DOMAIN", value=self.live_server_url, value_type="str")
+        out = StringIO()
+        call_command(
+            "benchmark_payments",
+            url=self.live_server_url,
+            terminals=2,
+            requests=3,
+            cards=3,
+            query_sample=2,
+            render=False,
+            stdout=out,
+        )
+
+        report = out.getvalue()
+        self.assertIn("DB queries per payment: avg 4.0, max 4", report)
+        self.assertIn("Payments: 6 in", report)
+        self.assertIn("Errors: 0.00% {}", report)
+        self.assertIn("Notify: 6 sent in", report)
+        self.assertEqual(Transaction.objects.count(), 6)
+
+
+class ReceiptPhotoTestCase(LiveServerTestCase):
+    def setUp(self):
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        self.headers = {"Authorization": f"Token {Token.objects.create(user=user).key}"}
+        card = Card.objects.create(owner=Profile.objects.create(user=user, telegram_chat_id="1111111"))
+        card.card_number = "1234567812345678"
+        card.save()
+        company = Company.objects.create(name="Store", hotline_phone="+380000000000", country="Ukraine", city="Kharkiv")
+        self.receipt = Receipt.objects.create(render_status="on_demand")
+        Transaction.objects.create(card=card, company=company, receipt=self.receipt, amount=5)
+
+    def tearDown(self):
+        self.receipt.refresh_from_db()
+        if self.receipt.img:
+            self.receipt.img.delete(save=False)
+            self.receipt.preview.delete(save=False)
+
+    async def download(self, photo) -> bytes:
+        try:
+            return b"".join([chunk async for chunk in photo.read(bot)])
+        finally:
+            await bot.session.close()
+
+    def test_on_demand_receipt_is_rendered_for_photo(self):
+        transaction = {"receipt_id": self.receipt.id, "receipt_img": None}
+        photo = get_receipt_photo(transaction, f"{self.live_server_url}/client_api/", self.headers)
+        content = async_to_sync(self.download)(photo)
+
+        self.receipt.refresh_from_db()
+        self.assertEqual(self.receipt.render_status, "ready")
+        with self.receipt.preview.open("rb") as preview:
+            self.assertEqual(content, preview.read())
+
+    def test_rendered_receipt_photo(self):
+        photo = get_receipt_photo({"receipt_id": 1, "receipt_img": "http://media/receipt.jpg"}, "", self.headers)
+        self.assertEqual(photo.url, "http://media/receipt.jpg")
+        self.assertNotIn("Authorization", photo.headers)  # token is sent only to api
+
+
+class TemplateRegistryTestCase(TestCase):
+    def setUp(self):
+        self.registry = TemplateRegistry()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.image_path = os.path.join(self.temp_dir.name, "template.png")
+        Image.new("RGB", (10, 10), (255, 255, 255)).save(self.image_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_image_decoded_once_and_copied(self):
+        image = self.registry.get_image(self.image_path)
+        image.putpixel((0, 0), (0, 0, 0))
+        with patch("receipt_creation.template_registry.Image.open") as image_open:
+            self.assertEqual(self.registry.get_image(self.image_path).getpixel((0, 0)), (255, 255, 255))
+        image_open.assert_not_called()
+
+    def test_image_reloaded_on_file_change(self):
+        self.registry.get_image(self.image_path)
+        Image.new("RGB", (20, 10)).save(self.image_path)
+        stat = os.stat(self.image_path)
+        os.utime(self.image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(self.registry.get_image(self.image_path).size, (20, 10))
+
+    def test_font_shared(self):
+        font = self.registry.get_font(MONOSPACE_FONT_PATH, HEADER_FONT_SIZE)
+        self.assertIs(self.registry.get_font(MONOSPACE_FONT_PATH, HEADER_FONT_SIZE), font)
+        self.assertIsNot(self.registry.get_font(MONOSPACE_FONT_PATH, PARAGRAPH_FONT_SIZE), font)
+
+    def test_benchmark_receipts(self):
+        out = StringIO()
+        call_command("benchmark_receipts", iterations=1, items=2, stdout=out)
+        self.assertIn("saved", out.getvalue())
+
+    def test_benchmark_receipt_stages(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, "benchmark.json")
+            call_command(
+                "benchmark_receipt_stages", "--sizes", "1,3", "--iterations", "1", "--output", output, stdout=out
+            )
+            with open(output) as file:
+                results = json.load(file)
+        self.assertEqual([result["items"] for result in results["receipts"]], [1, 3])
+        receipt = results["receipts"][1]
+        self.assertEqual(list(receipt["stages_ms"]), ["barcode", "layout", "draw", "encode"])
+        self.assertGreater(receipt["peak_traced_bytes"], 0)
+        self.assertGreater(receipt["output_bytes"], results["receipts"][0]["output_bytes"])
+        self.assertLess(results["barcode"]["warm_ms"], results["barcode"]["cold_ms"])
+        self.assertIn("Results are written", out.getvalue())
+
+
+class BarcodeTestCase(TestCase):
+    options = {
+        "format": "PNG",
+        "font_size": 10,
+        "module_width": 0.7,
+        "module_height": 15.0,
+        "quiet_zone": 1,
+    }
+
+    def setUp(self):
+        barcode_cache.clear()
+
+    def test_white_background_transparent(self):
+        image = generate_barcode_img(self.options)
+        self.assertEqual(image.mode, "RGBA")
+        self.assertEqual(image.getpixel((0, 0))[3], 0)
+        self.assertIn((0, 0, 0, 255), [color for _, color in image.getcolors()])
+
+    def test_barcode_cached_while_payload_is_same(self):
+        generate_barcode_img(self.options)
+        with patch("receipt_creation.generate_barcode.render_barcode_img") as render:
+            image = generate_barcode_img(dict(self.options))
+            image.putpixel((0, 0), (0, 0, 0, 255))
+            self.assertEqual(generate_barcode_img(self.options).getpixel((0, 0))[3], 0)
+        render.assert_not_called()
+        self.assertEqual(generate_barcode_img(self.options, code="123456789012").size, image.size)
+        self.assertEqual(len(barcode_cache), 2)
+
+    def test_saved_only_if_path_given(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            generate_barcode_img(self.options)
+            self.assertEqual(os.listdir(temp_dir), [])
+            path = os.path.join(temp_dir, "barcode.png")
+            generate_barcode_img(self.options, path)
+            self.assertEqual(Image.open(path).mode, "RGBA")
+
+
+class ReceiptBuilderTestCase(TestCase):
+    def make_builder(self) -> ReceiptBuilder:
+        builder = ReceiptBuilder(Receipt.BACKGROUND_PATH, Receipt.TEMPLATE_PATH)
+        builder.set_params(make_sample_receipt_data(3))
+        return builder
+
+    def test_receipt_encoded_once_to_output(self):
+        output = BytesIO()
+        with patch.object(Image.Image, "save", autospec=True, side_effect=Image.Image.save) as save:
+            size = self.make_builder().make_receipt(output)
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(size, len(output.getvalue()))
+        self.assertEqual(Image.open(output).format, "JPEG")
+
+    def test_encoder_is_pluggable(self):
+        output = BytesIO(b"header")
+        output.seek(0, os.SEEK_END)
+        size = self.make_builder().make_receipt(output, ReceiptEncoder("PNG", "png", compress_level=1))
+        self.assertEqual(size, len(output.getvalue()) - len(b"header"))
+        self.assertEqual(Image.open(BytesIO(output.getvalue()[len(b"header") :])).format, "PNG")
+
+    def test_compact_formats(self):
+        builder = self.make_builder()
+        jpeg_size = builder.make_receipt(BytesIO())
+
+        black_white = BytesIO()
+        self.assertLess(builder.encode_receipt(black_white, ENCODERS["png_1bit"]) * 5, jpeg_size)
+        self.assertEqual(Image.open(black_white).mode, "1")
+
+        preview = BytesIO()
+        builder.encode_receipt(preview, ENCODERS["preview"])
+        preview_image = Image.open(preview)
+        self.assertEqual((preview_image.width, preview_image.mode), (320, "P"))
+        self.assertLessEqual(len(preview_image.getcolors()), 4)
+
+        for name in ("jpeg_progressive", "webp", "webp_1bit", "png_gray"):
+            output = BytesIO()
+            self.assertLess(builder.encode_receipt(output, ENCODERS[name]), jpeg_size)
+            self.assertEqual(Image.open(output).format, ENCODERS[name].format)
+
+
+class ReceiptLayoutTestCase(TestCase):
+    def make_builder(self, data, backend: PillowBackend | None = None) -> ReceiptBuilder:
+        builder = ReceiptBuilder(Receipt.BACKGROUND_PATH, Receipt.TEMPLATE_PATH, backend=backend or PillowBackend())
+        builder.set_params(data)
+        builder.make_receipt(BytesIO())
+        return builder
+
+    def test_canvas_has_exact_layout_size(self):
+        builder = self.make_builder(make_sample_receipt_data(3))
+        self.assertEqual(builder.receipt_background.size, (builder.layout.width + 50, builder.layout.height + 50))
+        barcode = builder.layout.items[-1]
+        self.assertIsInstance(barcode, ImageItem)
+        self.assertEqual(builder.layout.height - barcode.y - barcode.image.height, 30)
+
+        product_height = builder.layout.height - self.make_builder(make_sample_receipt_data(2)).layout.height
+        self.assertEqual(product_height, get_font_metrics(builder.monospace_paragraph).line_height + PRODUCT_GAP)
+        self.assertEqual(
+            self.make_builder(make_sample_receipt_data(1)).receipt_background.height,
+            builder.receipt_background.height - 2 * product_height,
+        )
+
+    def test_long_names_wrapped(self):
+        data = make_sample_receipt_data(1)
+        data["body"]["products"].data[0] = ("Product with very long name " * 5 + "X" * 80, Decimal("1234.56"))
+        builder = self.make_builder(data)
+
+        texts = [item for item in builder.layout.items if isinstance(item, TextItem)]
+        for item in texts:
+            self.assertGreaterEqual(item.x, 10)
+            self.assertLessEqual(item.x + get_font_metrics(item.font).text_width(item.text), builder.layout.width - 10)
+        price = next(item for item in texts if item.text == "1234.56$")
+        name_lines = [item for item in texts if item.text.startswith(("Product", "X"))]
+        self.assertGreater(len(name_lines), 3)
+        self.assertEqual(name_lines[0].y, price.y)
+        self.assertEqual("".join(item.text for item in name_lines).count("X"), 80)
+        paragraph = get_font_metrics(builder.monospace_paragraph)
+        self.assertLess(max(item.x + paragraph.text_width(item.text) for item in name_lines), price.x)
+
+    def test_wrap_text(self):
+        metrics = get_font_metrics(template_registry.get_font(MONOSPACE_FONT_PATH, PARAGRAPH_FONT_SIZE))
+        width = metrics.text_width("aaaa bbbb")
+        self.assertEqual(wrap_text("aaaa bbbb cc", width, metrics), ["aaaa bbbb", "cc"])
+        self.assertEqual(wrap_text("aaaaaaaaaaaa", width, metrics), ["aaaaaaaaa", "aaa"])
+        self.assertEqual(wrap_text("", width, metrics), [""])
+
+    def test_font_metrics_measure_characters_once(self):
+        font = TemplateRegistry().get_font(MONOSPACE_FONT_PATH, HEADER_FONT_SIZE)
+        with patch.object(font, "getlength", wraps=font.getlength) as getlength:
+            metrics = get_font_metrics(font)
+            width = metrics.text_width("Привіт abba")
+            metrics.text_width("abba Привіт")
+        self.assertEqual(getlength.call_count, len(set("Привіт abba")))
+        self.assertEqual(width, math.ceil(font.getlength("Привіт abba")))
+        self.assertIs(get_font_metrics(font), metrics)
+
+    def test_backend_is_pluggable(self):
+        class CountingBackend(PillowBackend):
+            items_count = 0
+
+            def render(self, layout, canvas, top=0):
+                self.items_count = len(layout.items)
+                super().render(layout, canvas, top)
+
+        backend = CountingBackend()
+        builder = self.make_builder(make_sample_receipt_data(2), backend)
+        self.assertEqual(backend.items_count, len(builder.layout.items))
+
+    def test_stretch_template(self):
+        template = Image.new("L", (10, 100))
+        template.paste(255, (0, 0, 10, 20))
+        template.paste(128, (0, 80, 10, 100))
+        paper = stretch_template(template, 300)
+        self.assertEqual(paper.size, (10, 300))
+        self.assertEqual((paper.getpixel((0, 19)), paper.getpixel((0, 150)), paper.getpixel((0, 280))), (255, 0, 128))
+        self.assertEqual(stretch_template(template, 30).size, (10, 30))
+        for top, bottom in ((0, 10), (15, 25), (50, 250), (270, 300), (0, 300)):
+            rows = stretch_template(template, 300, top, bottom)
+            self.assertEqual(rows.tobytes(), paper.crop((0, top, 10, bottom)).tobytes())
+
+
+class StripRenderingTestCase(TestCase):
+    def render(self, items_count: int) -> ReceiptBuilder:
+        builder = ReceiptBuilder(Receipt.BACKGROUND_PATH, Receipt.TEMPLATE_PATH)
+        builder.set_params(make_sample_receipt_data(items_count))
+        builder.make_receipt(BytesIO())
+        return builder
+
+    def test_strips_are_the_same_as_whole_receipt(self):
+        with patch("receipt_creation.receipt_builder.stretch_template", wraps=stretch_template) as stretch:
+            builder = self.render(150)
+        self.assertGreater(builder.layout.height, 3 * STRIP_HEIGHT)
+        self.assertGreater(stretch.call_count, 3)
+        self.assertTrue(all(call.args[3] - call.args[2] <= STRIP_HEIGHT for call in stretch.call_args_list))
+
+        with patch("receipt_creation.receipt_builder.STRIP_HEIGHT", 10**6):
+            whole = self.render(150)
+        # resampling of strip of stretched template can round pixel to other side
+        difference = np.asarray(builder.receipt_background, np.int16) - np.asarray(whole.receipt_background, np.int16)
+        self.assertLessEqual(np.abs(difference).max(), 1)
+        self.assertEqual(builder.receipt_background.mode, "L")
+
+    def test_items_between_rows(self):
+        layout = self.render(150).layout
+        strips = [layout.between(top, top + 100) for top in range(0, layout.height, 100)]
+        self.assertEqual({id(item) for strip in strips for item in strip.items}, {id(item) for item in layout.items})
+        self.assertLess(max(len(strip.items) for strip in strips), 20)
+
+
+class GlyphAtlasTestCase(TestCase):
+    def render(self, backend: PillowBackend, title: str) -> tuple[Image.Image, ReceiptBuilder]:
+        builder = ReceiptBuilder(Receipt.BACKGROUND_PATH, Receipt.TEMPLATE_PATH, backend=backend)
+        builder.set_params(make_sample_receipt_data(3, title))
+        builder.make_receipt(BytesIO())
+        return builder.receipt_background, builder
+
+    def test_same_pixels_as_image_draw(self):
+        for title in ("Company", "Компанія"):
+            atlas_receipt, builder = self.render(AtlasBackend(), title)
+            pillow_receipt, _ = self.render(PillowBackend(), title)
+            self.assertEqual(atlas_receipt.tobytes(), pillow_receipt.tobytes())
+
+        title_font = builder.layout.items[0].font
+        self.assertTrue(get_glyph_atlas(builder.monospace_paragraph).covers("AMOUNT 12.50$"))
+        self.assertFalse(get_glyph_atlas(title_font).covers("Компанія"))
+
+    def test_cyrillic_drawn_by_freetype(self):
+        with patch("PIL.ImageDraw.ImageDraw.text", autospec=True, side_effect=ImageDraw.ImageDraw.text) as draw_text:
+            self.render(AtlasBackend(), "Компанія")
+        self.assertEqual([call.args[2] for call in draw_text.call_args_list], ["Компанія"])
+
+    def test_atlas_is_built_once_per_font(self):
+        font = template_registry.get_font(MONOSPACE_FONT_PATH, PARAGRAPH_FONT_SIZE)
+        self.assertIs(get_glyph_atlas(font), get_glyph_atlas(font))
+        self.assertIsNot(get_glyph_atlas(TemplateRegistry().get_font(MONOSPACE_FONT_PATH, 12)), get_glyph_atlas(font))
+
+    def test_blend_coverage_clipped(self):
+        pixels = np.full((4, 4, 3), 255, dtype=np.uint8)
+        blend_coverage(pixels, np.full((3, 3), 255, dtype=np.uint8), 2, -1)
+        self.assertEqual(pixels[:, :, 0].tolist(), [[255, 255, 0, 0], [255, 255, 0, 0], [255] * 4, [255] * 4])
+        blend_coverage(pixels, np.full((3, 3), 128, dtype=np.uint8), 10, 10)
+        self.assertEqual(int(pixels.sum()), 255 * 3 * 12)
+
+
+class HeaderStripTestCase(TestCase):
+    def setUp(self):
+        header_strips.clear()
+        self.company = Company.objects.create(name="Company", hotline_phone="+380000000000", country="Ukraine")
+
+    def render(self, data, header_key: tuple | None) -> ReceiptBuilder:
+        builder = ReceiptBuilder(Receipt.BACKGROUND_PATH, Receipt.TEMPLATE_PATH)
+        builder.set_params(data, header_key)
+        builder.make_receipt(BytesIO())
+        return builder
+
+    def test_strip_pasted_for_next_receipts(self):
+        data = make_sample_receipt_data(3, "Company")
+        header_key = (self.company.id, self.company.updated)
+        first = self.render(data, header_key)
+        self.assertEqual(header_strips[self.company.id].image.size, (first.layout.width, first.layout.header_height))
+
+        with patch.object(AtlasBackend, "render", autospec=True, side_effect=AtlasBackend.render) as render:
+            second = self.render(data, header_key)
+        self.assertEqual(len(render.call_args.args[1].items), len(second.layout.items) - second.layout.header_items)
+        self.assertEqual(second.receipt_background.tobytes(), self.render(data, None).receipt_background.tobytes())
+
+    def test_strip_not_used_for_other_texts_and_versions(self):
+        header_key = (self.company.id, self.company.updated)
+        self.render(make_sample_receipt_data(3, "Company"), header_key)
+        # receipt bought before company was renamed keeps old name
+        old_receipt = self.render(make_sample_receipt_data(3, "Old company"), header_key)
+        self.assertEqual(
+            old_receipt.receipt_background.tobytes(),
+            self.render(make_sample_receipt_data(3, "Old company"), None).receipt_background.tobytes(),
+        )
+        self.assertEqual(header_strips[self.company.id].texts[0], "Old company")
+
+        self.render(
+            make_sample_receipt_data(3, "Company"), (self.company.id, self.company.updated + timedelta(seconds=1))
+        )
+        self.assertEqual(header_strips[self.company.id].version[0], self.company.updated + timedelta(seconds=1))
+
+    def test_company_save_invalidates_strip(self):
+        self.render(make_sample_receipt_data(3, "Company"), (self.company.id, self.company.updated))
+        self.company.name = "New company"
+        self.company.save()
+        self.assertNotIn(self.company.id, header_strips)
+
+    def test_receipt_of_company_uses_strip(self):
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        card = Card.objects.create(owner=Profile.objects.create(user=user))
+        card.generate_card_number()
+        for _ in range(2):
+            receipt = Receipt.objects.create(render_status="on_demand")
+            Transaction.objects.create(card=card, company=self.company, receipt=receipt, amount=5)
+            receipt.get_receipt_img()
+            self.addCleanup(receipt.img.delete, save=False)
+            self.assertEqual(receipt.render_status, "ready")
+        self.assertEqual(header_strips[self.company.id].version[0], self.company.updated)
+
+
+class BackfillReceiptsTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        card = Card.objects.create(owner=Profile.objects.create(user=user, telegram_chat_id="1111111"))
+        card.generate_card_number()
+        company = Company.objects.create(name="Company", hotline_phone="+380000000000", country="Ukraine")
+
+        self.receipts = []
+        for render_status in ("on_demand", "ready", "failed"):
+            receipt = Receipt.objects.create(render_status=render_status)
+            Transaction.objects.create(card=card, company=company, receipt=receipt, amount=5)
+            self.receipts.append(receipt)
+        self.receipts[1].img = "uploads/old_receipt.jpg"
+        self.receipts[1].save()
+
+    def tearDown(self):
+        for receipt in Receipt.objects.exclude(img="uploads/old_receipt.jpg").exclude(img=""):
+            receipt.img.delete(save=False)
+
+    def backfill(self, *args) -> str:
+        out = StringIO()
+        call_command("backfill_receipts", *args, "--workers", "0", "--chunk-size", "2", stdout=out)
+        return out.getvalue()
+
+    def test_missing_receipts_rendered(self):
+        report = self.backfill("--missing")
+        self.assertIn("Receipts to render: 2", report)
+        self.assertIn("Rendered 2 of 2/2 receipts, failed 0", report)
+        statuses = {receipt.id: receipt.render_status for receipt in Receipt.objects.all()}
+        self.assertEqual(statuses, {receipt.id: "ready" for receipt in self.receipts})
+        self.assertEqual(Receipt.objects.get(id=self.receipts[1].id).img, "uploads/old_receipt.jpg")
+
+    def test_rendered_receipt_rendered_again(self):
+        self.backfill("--status", "ready")
+        receipt = Receipt.objects.get(id=self.receipts[1].id)
+        self.assertNotEqual(receipt.img, "uploads/old_receipt.jpg")
+        self.assertIsNotNone(receipt.data)
+
+    def test_failed_rerender_keeps_image(self):
+        with patch.object(Receipt, "_generate_receipt_img", return_value=("", "")):
+            self.backfill("--status", "ready")
+        receipt = Receipt.objects.get(id=self.receipts[1].id)
+        self.assertEqual((receipt.img, receipt.render_status), ("uploads/old_receipt.jpg", "ready"))
+
+    def test_resumed_from_state_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            state_file = os.path.join(temp_dir, "state")
+            with patch.object(
+                Receipt, "_generate_receipt_img", side_effect=[("uploads/new.jpg", ""), KeyboardInterrupt]
+            ):
+                with self.assertRaises(KeyboardInterrupt):
+                    self.backfill("--all", "--state-file", state_file)
+            # the first chunk was not finished, so it is rendered again
+            self.assertIn("Receipts to render: 3, after id 0", self.backfill("--all", "--state-file", state_file))
+            self.assertIn("Receipts to render: 0", self.backfill("--all", "--state-file", state_file))
+
+    def test_receipts_should_be_chosen(self):
+        with self.assertRaises(CommandError):
+            self.backfill()
+
+
+class ReceiptStorageTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.storage = ReceiptStorage(location=self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_content_name_fan_out(self):
+        name = get_content_name(b"receipt", "jpg")
+        digest = hashlib.sha256(b"receipt").hexdigest()
+        self.assertEqual(name, f"receipts/{digest[:2]}/{digest[2:4]}/{digest}.jpg")
+
+    def test_identical_content_saved_once(self):
+        name = get_content_name(b"receipt", "jpg")
+        self.assertEqual(self.storage.save(name, ContentFile(b"receipt")), name)
+        with patch("database_models.receipt_storage.tempfile.mkstemp") as mkstemp:
+            self.assertEqual(self.storage.save(name, ContentFile(b"receipt")), name)
+        mkstemp.assert_not_called()
+
+        directory = os.path.dirname(self.storage.path(name))
+        self.assertEqual(os.listdir(directory), [os.path.basename(name)])  # temporary file was renamed
+        self.assertEqual(os.stat(self.storage.path(name)).st_mode & 0o777, 0o644)
+
+    def test_temporary_file_removed_on_error(self):
+        name = get_content_name(b"receipt", "jpg")
+        with patch("database_models.receipt_storage.os.replace", side_effect=OSError):
+            with self.assertRaises(OSError):
+                self.storage.save(name, ContentFile(b"receipt"))
+        self.assertEqual(os.listdir(os.path.dirname(self.storage.path(name))), [])
+
+    def test_rendered_again_receipt_shares_file(self):
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        card = Card.objects.create(owner=Profile.objects.create(user=user, telegram_chat_id="1111111"))
+        card.generate_card_number()
+        company = Company.objects.create(name="Company", hotline_phone="+380000000000", country="Ukraine")
+        receipt = Receipt.objects.create()
+        Transaction.objects.create(card=card, company=company, receipt=receipt, amount=5)
+
+        with patch.object(Receipt.img.field, "storage", self.storage):
+            name = receipt.get_receipt_img().name
+            self.assertTrue(name.startswith("receipts/"))
+            self.assertTrue(receipt.preview.name.endswith(".png"))
+            self.assertEqual(receipt.get_receipt_img(rerender=True).name, name)
+        self.assertEqual(receipt.get_img_etag(), f'"{os.path.splitext(os.path.basename(name))[0]}"')
@@ -0,0 +1,6 @@
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # metrics files of dead worker are still summed up, only its live gauges are removed
+    multiprocess.mark_process_dead(worker.pid)
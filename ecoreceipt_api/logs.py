@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import queue
+import atexit
+import uuid
+import logging
+import itertools
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.config import ConvertingList
+from logging.handlers import QueueHandler, QueueListener
+
+from django.http import HttpRequest, HttpResponse
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+REQUEST_ID_HEADER = "X-Request-ID"
+REQUEST_ID_PATTERN = re.compile(r"[\w\-]{1,64}")  # id of proxy or terminal is used if it is not too long
+
+# attributes of every record, other attributes are extra fields given to logging call
+RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "request_id"}
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds id of current http request to record, it has to run in thread which logs (see QueueListenerHandler)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Passes only every Nth record of every line which logs below INFO (e.g. debug record per receipt line),
+    records of INFO and higher levels pass always
+
+    """
+
+    def __init__(self, every: int = 100):
+        super().__init__()
+        self.every = every
+        self.counters: dict[tuple[str, int], itertools.count] = {}  # (path, line): count of records
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.INFO:
+            return True
+        # setdefault and next of count are atomic, so threads which log the same line do not lose counts
+        counter = self.counters.setdefault((record.pathname, record.lineno), itertools.count())
+        return next(counter) % self.every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line, with request id and extra fields of logging call"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "process": record.process,
+            "thread": record.thread,
+            "request_id": getattr(record, "request_id", None),
+            "message": record.getMessage(),
+        }
+        data.update((key, value) for key, value in record.__dict__.items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class QueueListenerHandler(QueueHandler):
+    """Puts records to queue, its listener thread passes them to handlers (file, console).
+
+    Logging call only formats message and puts it to queue, it does not wait for disk. Handlers are given as
+    "cfg://handlers.name" in LOGGING, they are configured before this one, because handlers are configured in
+    order of names. Forked processes (render workers) get new queue and listener thread.
+
+    """
+
+    def __init__(self, handlers: list[logging.Handler], respect_handler_level: bool = True):
+        super().__init__(queue.SimpleQueue())
+        if isinstance(handlers, ConvertingList):
+            handlers = [handlers[index] for index in range(len(handlers))]  # indexing converts cfg:// to handler
+        self.handlers = handlers
+        self.respect_handler_level = respect_handler_level
+        self.start_listener()
+        atexit.register(self.stop_listener)
+        os.register_at_fork(after_in_child=self.restart_listener)
+
+    def start_listener(self):
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=self.respect_handler_level)
+        self.listener.start()
+
+    def stop_listener(self):
+        """Write all queued records and stop listener thread"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def restart_listener(self):
+        # listener thread is not copied to forked process, records queued before fork are written by parent
+        self.queue = queue.SimpleQueue()
+        self.start_listener()
+
+    def flush(self):
+        self.stop_listener()
+        self.start_listener()
+
+    def close(self):
+        self.stop_listener()
+        super().close()
+
+
+class RequestIdMiddleware:
+    """Binds id of request to records logged while it is handled and returns it in X-Request-ID header"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        request_id = request.headers.get(REQUEST_ID_HEADER, "")
+        if not REQUEST_ID_PATTERN.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_id_var.reset(token)
+        response[REQUEST_ID_HEADER] = request_id
+        return response
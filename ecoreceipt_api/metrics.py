@@ -0,0 +1,73 @@
+import os
+import time
+
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# With PROMETHEUS_MULTIPROC_DIR environment variable every process (gunicorn workers, render workers)
+# writes metrics to its own files in that dir, and /metrics sums them up
+
+REQUEST_DURATION = Histogram(
+    "ecoreceipt_http_request_duration_seconds", "Duration of http requests", ["route", "method", "status"]
+)
+REQUEST_DB_QUERIES = Histogram(
+    "ecoreceipt_http_request_db_queries",
+    "Count of db queries per http request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100),
+)
+REQUEST_DB_DURATION = Histogram(
+    "ecoreceipt_http_request_db_duration_seconds", "Time of db queries per http request", ["route"]
+)
+STAGE_DURATION = Histogram("ecoreceipt_stage_duration_seconds", "Duration of named stages", ["operation", "stage"])
+ENTITY_CACHE_LOOKUPS = Counter("ecoreceipt_entity_cache_lookups", "Entity cache lookups", ["cache", "result"])
+
+
+def stage_timer(operation: str, stage: str):
+    """Context manager (or decorator) which observes duration of stage of operation"""
+    return STAGE_DURATION.labels(operation, stage).time()
+
+
+class QueryMetrics:
+    """Database execute wrapper which counts queries and their time"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        query_metrics = QueryMetrics()
+        started = time.perf_counter()
+        with connection.execute_wrapper(query_metrics):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        # route instead of path, so urls with ids do not make new time series
+        route = request.resolver_match.route if request.resolver_match is not None else "unmatched"
+        REQUEST_DURATION.labels(route, request.method, response.status_code).observe(duration)
+        REQUEST_DB_QUERIES.labels(route).observe(query_metrics.count)
+        REQUEST_DB_DURATION.labels(route).observe(query_metrics.duration)
+        return response
+
+
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -35,6 +35,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "ecoreceipt_api.logs.RequestIdMiddleware",
+    "ecoreceipt_api.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -78,6 +80,22 @@ DATABASES = {
 }
 
 
+# Redis is shared cache of Card by UID and Company by token lookups, without it only per-process cache is used
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+
+ENTITY_CACHE_LOCAL_SIZE = 1024  # entries of every entity in every process
+ENTITY_CACHE_LOCAL_TTL = 5  # seconds, other processes do not receive invalidation signals
+ENTITY_CACHE_REDIS_TTL = 60 * 60
+
+# Payments are credited to one of company balance shards, see fold_company_balances command
+COMPANY_BALANCE_SHARDS = 16
+
+# Keys of receipt_creation.encoders.ENCODERS, compare them with benchmark_receipts command
+RECEIPT_IMAGE_FORMAT = os.getenv("RECEIPT_IMAGE_FORMAT", "jpeg")
+RECEIPT_PREVIEW_FORMAT = os.getenv("RECEIPT_PREVIEW_FORMAT", "preview")  # sent to telegram
+
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -105,6 +123,10 @@ SWAGGER_SETTINGS = {
     "USE_SESSION_AUTH": False,
 }
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_DEBUG_SAMPLE_EVERY = int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", 100))  # debug records of every line written
+
+# Loggers only put records to queue, file and console are written by listener thread of "queue" handler
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -117,23 +139,32 @@ LOGGING = {
             "format": "{levelname} {message}",
             "style": "{",
         },
+        "json": {"()": "ecoreceipt_api.logs.JsonFormatter"},
+    },
+    "filters": {
+        "request_id": {"()": "ecoreceipt_api.logs.RequestIdFilter"},
+        "debug_sample": {"()": "ecoreceipt_api.logs.SampleFilter", "every": LOG_DEBUG_SAMPLE_EVERY},
     },
     "handlers": {
         "console": {"class": "logging.StreamHandler", "formatter": "simple"},
         "file": {
-            "level": "INFO",
             "class": "logging.handlers.RotatingFileHandler",
             "filename": "ecoreceipt.log",
-            "maxBytes": 50_000,
+            "maxBytes": 10 * 1024 * 1024,
             "backupCount": 10,
-            "formatter": "verbose",
+            "formatter": "json",
+        },
+        "queue": {
+            "()": "ecoreceipt_api.logs.QueueListenerHandler",
+            "handlers": ["cfg://handlers.console", "cfg://handlers.file"],
+            "filters": ["request_id", "debug_sample"],
         },
     },
     "root": {
-        "handlers": ["console", "file"],
-        "level": "INFO",
+        "handlers": ["queue"],
+        "level": LOG_LEVEL,
     },
-    "loggers": {"django": {"handlers": ["console", "file"], "level": "INFO", "propagate": False}},
+    "loggers": {"django": {"handlers": ["queue"], "level": "INFO", "propagate": False}},
 }
 
 # Internationalization
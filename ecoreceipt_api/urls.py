@@ -4,11 +4,13 @@ from django.contrib import admin
 from django.urls import include, path
 
 from docs import views
+from .metrics import metrics_view
 from .swagger import schema_view
 
 urlpatterns = [
     path("", views.docs),
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view),
     path("terminal_api/", include("terminal_api.urls")),
     path("client_api/", include("client_api.urls")),
     path("swagger/", schema_view.with_ui("swagger", cache_timeout=0), name="schema-swagger-ui"),
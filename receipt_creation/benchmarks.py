@@ -0,0 +1,204 @@
+import sys
+import time
+import platform
+import statistics
+import tracemalloc
+from datetime import datetime, timezone
+from decimal import Decimal
+from io import BytesIO
+
+import numpy as np
+import PIL
+from PIL import Image, ImageFont
+
+from .encoders import ENCODERS
+from .generate_barcode import barcode_cache, generate_barcode_img
+from .glyph_atlas import ATLAS_BACKEND
+from .layout import PILLOW_BACKEND
+from .receipt_builder import HEADER_FONT_SIZE, PARAGRAPH_FONT_SIZE, ReceiptBuilder, ReceiptData, make_receipt_data
+from .receipt_builder import stretch_template
+from .template_registry import MONOSPACE_FONT_PATH, template_registry
+
+BACKGROUND_PATH = "media/receipt_background.jpg"
+TEMPLATE_PATH = "media/exact_receipt.jpg"
+
+
+def make_sample_receipt_data(items_count: int, title: str = "Benchmark company") -> ReceiptData:
+    return make_receipt_data(
+        title,
+        "Ukraine, Kharkiv, Sumska 12",
+        "+380000000000",
+        datetime(2024, 1, 1, 12, 0),
+        [(f"Product {i}", Decimal("9.99")) for i in range(items_count)],
+        Decimal("9.99") * items_count,
+        "**** **** **** 1234",
+    )
+
+
+def load_templates_without_registry():
+    """What ReceiptBuilder did for every receipt before template registry"""
+    for path in (TEMPLATE_PATH, BACKGROUND_PATH):
+        Image.open(path).copy()
+    ImageFont.truetype(MONOSPACE_FONT_PATH, HEADER_FONT_SIZE)
+    ImageFont.truetype(MONOSPACE_FONT_PATH, PARAGRAPH_FONT_SIZE)
+
+
+def load_templates_from_registry():
+    for path in (TEMPLATE_PATH, BACKGROUND_PATH):
+        template_registry.get_image(path)
+    template_registry.get_font(MONOSPACE_FONT_PATH, HEADER_FONT_SIZE)
+    template_registry.get_font(MONOSPACE_FONT_PATH, PARAGRAPH_FONT_SIZE)
+
+
+def measure_ms(function, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - started) * 1000 / iterations
+
+
+def benchmark_template_registry(iterations: int = 20, items_count: int = 5) -> dict[str, float]:
+    """Milliseconds per receipt of template loading and of whole make_receipt with cold and warm registry"""
+    data = make_sample_receipt_data(items_count)
+
+    def make_receipt():
+        builder = ReceiptBuilder(BACKGROUND_PATH, TEMPLATE_PATH)
+        builder.set_params(data)
+        builder.make_receipt(BytesIO())
+
+    def make_receipt_cold():
+        template_registry.clear()
+        make_receipt()
+
+    template_registry.clear()
+    results = {
+        "load_templates_without_registry_ms": measure_ms(load_templates_without_registry, iterations),
+        "load_templates_from_registry_ms": measure_ms(load_templates_from_registry, iterations),
+        "make_receipt_cold_registry_ms": measure_ms(make_receipt_cold, iterations),
+        "make_receipt_warm_registry_ms": measure_ms(make_receipt, iterations),
+    }
+    results["saved_per_receipt_ms"] = (
+        results["make_receipt_cold_registry_ms"] - results["make_receipt_warm_registry_ms"]
+    )
+    return results
+
+
+def compare_receipt_formats(iterations: int = 20, items_count: int = 5) -> dict[str, dict[str, float]]:
+    """Size in bytes and encode milliseconds of one receipt in every format of ENCODERS"""
+    builder = ReceiptBuilder(BACKGROUND_PATH, TEMPLATE_PATH)
+    builder.set_params(make_sample_receipt_data(items_count))
+    builder.make_receipt(BytesIO())
+
+    results = {}
+    for name, encoder in ENCODERS.items():
+        size = builder.encode_receipt(BytesIO(), encoder)
+        results[name] = {
+            "bytes": size,
+            "encode_ms": measure_ms(lambda: builder.encode_receipt(BytesIO(), encoder), iterations),
+        }
+    jpeg_size = results["jpeg"]["bytes"]
+    for result in results.values():
+        result["smaller_than_jpeg"] = jpeg_size / result["bytes"]
+    return results
+
+
+def compare_text_backends(iterations: int = 20, items_count: int = 5) -> dict[str, dict[str, float]]:
+    """Milliseconds of drawing receipt texts with ImageDraw.text and from glyph atlas. Cyrillic title is not
+    in atlas, so it is drawn by FreeType in both cases
+
+    """
+    results = {}
+    for name, title in (("latin", "Benchmark company"), ("cyrillic_title", "Компанія для тестів")):
+        builder = ReceiptBuilder(BACKGROUND_PATH, TEMPLATE_PATH)
+        builder.set_params(make_sample_receipt_data(items_count, title))
+        builder.make_receipt(BytesIO())  # warms up glyph atlases and metrics
+        canvas = stretch_template(builder.exact_receipt.convert("L"), builder.layout.height)
+        results[name] = {
+            "image_draw_ms": measure_ms(lambda: PILLOW_BACKEND.render(builder.layout, canvas), iterations),
+            "glyph_atlas_ms": measure_ms(lambda: ATLAS_BACKEND.render(builder.layout, canvas), iterations),
+        }
+        results[name]["speedup"] = results[name]["image_draw_ms"] / results[name]["glyph_atlas_ms"]
+    return results
+
+
+RECEIPT_SIZES = (1, 10, 100, 1000)
+BARCODE_OPTIONS = {
+    "format": "PNG",
+    "font_size": 10,
+    "module_width": 0.7,
+    "module_height": 15.0,
+    "quiet_zone": 1,
+}
+
+
+def benchmark_receipt_size(items_count: int, iterations: int, encoder_name: str = "jpeg") -> dict:
+    """Median milliseconds of every make_receipt stage, peak memory and output size of receipt with items_count
+    products. tracemalloc sees python and numpy allocations, pixel buffers of pillow are counted in image_bytes
+
+    """
+    data = make_sample_receipt_data(items_count)
+    encoder = ENCODERS[encoder_name]
+
+    def make_receipt() -> tuple[ReceiptBuilder, int]:
+        builder = ReceiptBuilder(BACKGROUND_PATH, TEMPLATE_PATH)
+        builder.set_params(data)
+        return builder, builder.make_receipt(BytesIO(), encoder)
+
+    make_receipt()  # warm up registry, glyph atlases and barcode cache
+    stage_durations = {}
+    totals = []
+    for _ in range(iterations):
+        builder, output_bytes = make_receipt()
+        for stage, duration in builder.stage_durations.items():
+            stage_durations.setdefault(stage, []).append(duration * 1000)
+        totals.append(sum(builder.stage_durations.values()) * 1000)
+
+    tracemalloc.start()
+    try:
+        builder, _ = make_receipt()
+        peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    image = builder.receipt_background
+    return {
+        "items": items_count,
+        "stages_ms": {stage: statistics.median(durations) for stage, durations in stage_durations.items()},
+        "total_ms": statistics.median(totals),
+        "peak_traced_bytes": peak_traced_bytes,
+        "image_bytes": image.width * image.height * len(image.getbands()),
+        "image_size": list(image.size),
+        "output_bytes": output_bytes,
+    }
+
+
+def benchmark_barcode(iterations: int) -> dict[str, float]:
+    """Milliseconds of generate_barcode_img, rendered (cache is empty) and taken from cache"""
+
+    def generate_cold():
+        barcode_cache.clear()
+        generate_barcode_img(BARCODE_OPTIONS)
+
+    return {
+        "cold_ms": measure_ms(generate_cold, iterations),
+        "warm_ms": measure_ms(lambda: generate_barcode_img(BARCODE_OPTIONS), iterations),
+    }
+
+
+def benchmark_receipt_sizes(
+    sizes: tuple[int, ...] = RECEIPT_SIZES, iterations: int = 5, encoder_name: str = "jpeg"
+) -> dict:
+    """Results of receipts of every size and of barcode, with versions, so json of releases can be compared"""
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": sys.version.split()[0],
+            "pillow": PIL.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+        },
+        "iterations": iterations,
+        "encoder": encoder_name,
+        "barcode": benchmark_barcode(iterations),
+        "receipts": [benchmark_receipt_size(items_count, iterations, encoder_name) for items_count in sizes],
+    }
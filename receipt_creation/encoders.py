@@ -0,0 +1,70 @@
+from typing import BinaryIO
+
+from PIL import Image
+
+BLACK_WHITE_THRESHOLD = 128  # lighter pixels are white paper, darker ones are text and barcode
+
+
+class ReceiptEncoder:
+    """Pillow format and save options of receipt image, image is encoded with them once.
+
+    Receipt is black text on paper, so it can be reduced before encoding: black_white drops paper texture
+    (pixels become black or white), max_width makes smaller variant, mode "1" stores pixel in one bit
+    and mode "P" stores colors count of gray levels.
+
+    """
+
+    def __init__(
+        self,
+        format: str,
+        extension: str,
+        black_white: bool = False,
+        max_width: int | None = None,
+        mode: str | None = None,
+        colors: int = 256,
+        **options,
+    ):
+        self.format = format
+        self.extension = extension
+        self.black_white = black_white
+        self.max_width = max_width
+        self.mode = mode
+        self.colors = colors
+        self.options = options
+
+    def __repr__(self):
+        return f"ReceiptEncoder({self.format}, mode={self.mode}, max_width={self.max_width}, {self.options})"
+
+    def prepare(self, image: Image.Image) -> Image.Image:
+        if self.black_white:
+            # before resize, so downscaled text is antialiased and not broken by threshold
+            image = image.convert("L").point(lambda value: 255 if value >= BLACK_WHITE_THRESHOLD else 0)
+        if self.max_width is not None and image.width > self.max_width:
+            image = image.resize((self.max_width, round(image.height * self.max_width / image.width)), Image.LANCZOS)
+        if self.mode == "1":
+            image = image.convert("1", dither=Image.Dither.NONE)  # dithered paper texture is compressed badly
+        elif self.mode == "P":
+            image = image.convert("L").quantize(self.colors)
+        elif self.mode is not None:
+            image = image.convert(self.mode)
+        return image
+
+    def encode(self, image: Image.Image, fp: BinaryIO) -> int:
+        """Write encoded image to seekable file-like object, returns count of written bytes"""
+        start = fp.tell()
+        self.prepare(image).save(fp, format=self.format, **self.options)
+        return fp.tell() - start
+
+
+JPEG_ENCODER = ReceiptEncoder("JPEG", "jpg")  # pillow defaults (quality 75), the same as receipts had before
+
+ENCODERS = {
+    "jpeg": JPEG_ENCODER,
+    "jpeg_progressive": ReceiptEncoder("JPEG", "jpg", quality=60, optimize=True, progressive=True),
+    "png_1bit": ReceiptEncoder("PNG", "png", black_white=True, mode="1", optimize=True),
+    "png_gray": ReceiptEncoder("PNG", "png", mode="P", colors=4, optimize=True),
+    "webp": ReceiptEncoder("WEBP", "webp", quality=60, method=6),
+    "webp_1bit": ReceiptEncoder("WEBP", "webp", black_white=True, mode="L", lossless=True),
+    # small variant, which is sent to telegram and shown in mobile lists
+    "preview": ReceiptEncoder("PNG", "png", black_white=True, max_width=320, mode="P", colors=4, optimize=True),
+}
@@ -1,15 +1,17 @@
-import os
+import threading
+from collections import OrderedDict
 from typing import TypedDict
 
 import barcode
-import cv2 as cv
 import numpy as np
 from PIL import Image
 from barcode.writer import ImageWriter
 
+BARCODE_CODE = "091487112432"  # the same ean13 payload on every receipt for now
+BARCODE_CACHE_SIZE = 32
+
 
 class BarCodeOptions(TypedDict):
-    text: str  # all data about receipt
     format: str  # 'PNG'
     font_size: int  # 10
     module_width: float  # .7
@@ -17,17 +19,46 @@ class BarCodeOptions(TypedDict):
     quiet_zone: int  # 1 TODO: read about it
 
 
-def generate_barcode_img(options: BarCodeOptions, filename_path: str) -> Image:
-    if os.path.exists(os.path.dirname(filename_path)):
-        ean = barcode.get("ean13", "091487112432", writer=ImageWriter())
-        filename = ean.save(filename_path, options=options)
+barcode_cache: OrderedDict[tuple, Image.Image] = OrderedDict()
+barcode_cache_lock = threading.Lock()
+
+
+def get_barcode_cache_key(options: BarCodeOptions, code: str) -> tuple:
+    return code, *sorted(options.items())
+
+
+def make_white_transparent(image: Image.Image) -> Image.Image:
+    pixels = np.asarray(image.convert("RGB"))
+    alpha = np.where(np.all(pixels == 255, axis=-1), 0, 255).astype(np.uint8)
+    return Image.fromarray(np.dstack((pixels, alpha)), "RGBA")
+
+
+def render_barcode_img(options: BarCodeOptions, code: str) -> Image.Image:
+    ean = barcode.get("ean13", code, writer=ImageWriter(format=options.get("format", "PNG")))
+    return make_white_transparent(ean.render(options))
+
+
+def generate_barcode_img(
+    options: BarCodeOptions, filename_path: str | None = None, code: str = BARCODE_CODE
+) -> Image.Image:
+    """Barcode with transparent background, rendered in memory and cached while code and options are the same.
+
+    Returned image is a copy, so caller can change it. Image is also saved to filename_path, if it is given.
+
+    """
+    key = get_barcode_cache_key(options, code)
+    with barcode_cache_lock:
+        image = barcode_cache.get(key)
+        if image is not None:
+            barcode_cache.move_to_end(key)
 
-        # Do transparent background
-        image = cv.imread(filename)
-        h, w = image.shape[:2]
-        image_bgra = np.concatenate([image, np.full((h, w, 1), 255, dtype=np.uint8)], axis=-1)
-        white = np.all(image == [255, 255, 255], axis=-1)
-        image_bgra[white, -1] = 0
-        cv.imwrite(filename, image_bgra)
+    if image is None:
+        image = render_barcode_img(options, code)
+        with barcode_cache_lock:
+            barcode_cache[key] = image
+            if len(barcode_cache) > BARCODE_CACHE_SIZE:
+                barcode_cache.popitem(last=False)
 
-        return Image.open(filename)
+    if filename_path is not None:
+        image.save(filename_path, format=options.get("format", "PNG"))
+    return image.copy()
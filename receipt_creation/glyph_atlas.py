@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from .layout import TEXT_COLOR, PillowBackend, ReceiptLayout, TextItem
+
+ATLAS_CHARSET = "".join(chr(code) for code in range(32, 127))  # printable ASCII, texts of most receipts
+GLYPH_PADDING = 2  # glyphs can be drawn a bit outside of their advance
+
+
+class GlyphAtlas:
+    """Glyphs of font rasterized once by FreeType into one coverage array (tile per character).
+
+    Text is assembled from tiles with NumPy, the same way as Pillow assembles glyph bitmaps of text:
+    glyph is placed at sum of advances of previous characters and overlapped pixels take max coverage.
+
+    """
+
+    def __init__(self, font: ImageFont.FreeTypeFont, charset: str = ATLAS_CHARSET):
+        self.font = font
+        ascent, descent = font.getmetrics()
+        self.tile_height = ascent + descent
+        self.advances = {char: font.getlength(char) for char in charset}
+        self.tile_width = math.ceil(max(self.advances.values())) + 2 * GLYPH_PADDING
+
+        atlas = Image.new("L", (self.tile_width * len(charset), self.tile_height))
+        draw = ImageDraw.Draw(atlas)
+        for number, char in enumerate(charset):
+            draw.text((number * self.tile_width + GLYPH_PADDING, 0), char, 255, font=font)
+        self.atlas = np.asarray(atlas)
+        self.tiles = {
+            char: self.atlas[:, number * self.tile_width : (number + 1) * self.tile_width]
+            for number, char in enumerate(charset)
+        }
+
+    def covers(self, text: str) -> bool:
+        tiles = self.tiles
+        return all(char in tiles for char in text)
+
+    def render_coverage(self, text: str) -> np.ndarray:
+        """Coverage (0-255) of text line, its column GLYPH_PADDING is x of text"""
+        positions = []
+        pen = 0.0
+        for char in text:
+            positions.append(round(pen))
+            pen += self.advances[char]
+        coverage = np.zeros((self.tile_height, round(pen) + self.tile_width), dtype=np.uint8)
+        for char, x in zip(text, positions):
+            if char == " ":
+                continue
+            target = coverage[:, x : x + self.tile_width]
+            np.maximum(target, self.tiles[char], out=target)
+        return coverage
+
+
+glyph_atlases: dict[tuple[str, int], GlyphAtlas] = {}  # (font path, size): atlas, like font metrics of layout
+
+
+def get_glyph_atlas(font: ImageFont.FreeTypeFont) -> GlyphAtlas:
+    key = (font.path, font.size)
+    atlas = glyph_atlases.get(key)
+    if atlas is None or atlas.font is not font:  # font file was changed and loaded again by registry
+        atlas = glyph_atlases[key] = GlyphAtlas(font)
+    return atlas
+
+
+def blend_coverage(pixels: np.ndarray, coverage: np.ndarray, x: int, y: int, color: int | tuple = TEXT_COLOR):
+    """Blend text color into pixels (height, width, channels) through coverage placed at x, y, clipped by pixels"""
+    height, width = pixels.shape[:2]
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + coverage.shape[1], width), min(y + coverage.shape[0], height)
+    if left >= right or top >= bottom:
+        return
+    alpha = coverage[top - y : bottom - y, left - x : right - x, np.newaxis].astype(np.uint16)
+    region = pixels[top:bottom, left:right]
+    color = np.array(color, dtype=np.uint16).reshape(-1)[: region.shape[2]]
+    region[:] = (region * (255 - alpha) + color * alpha + 127) // 255
+
+
+class AtlasBackend(PillowBackend):
+    """Draws texts from glyph atlas with NumPy, FreeType (ImageDraw.text) draws only texts with characters
+    which are not in atlas, e.g. cyrillic company names, and they are laid out by FreeType as a whole
+
+    """
+
+    def render(self, layout: ReceiptLayout, canvas: Image.Image, top: int = 0):
+        if canvas.mode not in ("RGB", "L"):
+            return super().render(layout, canvas, top)
+        pixels = np.array(canvas)
+        channels = pixels if pixels.ndim == 3 else pixels[:, :, np.newaxis]  # view, blended into pixels
+
+        other_items = []
+        for item in layout.items:
+            if isinstance(item, TextItem):
+                atlas = get_glyph_atlas(item.font)
+                if atlas.covers(item.text):
+                    blend_coverage(channels, atlas.render_coverage(item.text), item.x - GLYPH_PADDING, item.y - top)
+                    continue
+            other_items.append(item)
+        canvas.paste(Image.fromarray(pixels))
+
+        fallback_layout = ReceiptLayout(layout.width)
+        fallback_layout.height = layout.height
+        fallback_layout.items = other_items
+        super().render(fallback_layout, canvas, top)
+
+
+ATLAS_BACKEND = AtlasBackend()
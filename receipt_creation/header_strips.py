@@ -0,0 +1,41 @@
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from PIL import Image
+
+HEADER_STRIP_CACHE_SIZE = 64  # companies, strip is about 418x170 RGB (210KB)
+
+
+class HeaderStrip(NamedTuple):
+    version: tuple  # company updated and template version
+    texts: tuple[str, ...]  # title, address and phone, old receipts keep texts of company at purchase time
+    image: Image.Image
+
+
+header_strips: OrderedDict[int, HeaderStrip] = OrderedDict()  # company id: strip
+header_strips_lock = threading.Lock()
+
+
+def get_header_strip(company_id: int, version: tuple, texts: tuple[str, ...]) -> Image.Image | None:
+    """Rendered top of receipt of company (paper with title, address and phone), it is only pasted, not changed"""
+    with header_strips_lock:
+        strip = header_strips.get(company_id)
+        if strip is None or strip.version != version or strip.texts != texts:
+            return None
+        header_strips.move_to_end(company_id)
+        return strip.image
+
+
+def set_header_strip(company_id: int, version: tuple, texts: tuple[str, ...], image: Image.Image):
+    with header_strips_lock:
+        header_strips[company_id] = HeaderStrip(version, texts, image)
+        header_strips.move_to_end(company_id)
+        if len(header_strips) > HEADER_STRIP_CACHE_SIZE:
+            header_strips.popitem(last=False)
+
+
+def invalidate_header_strip(company_id: int):
+    """Other processes do not get invalidation, their strips are not used because company updated is changed"""
+    with header_strips_lock:
+        header_strips.pop(company_id, None)
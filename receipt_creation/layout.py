@@ -0,0 +1,204 @@
+import math
+from decimal import Decimal
+
+from PIL import Image, ImageDraw, ImageFont
+
+SIDE_PADDING = 10  # left and right padding of text
+PRICE_RIGHT_PADDING = 30
+TOP_PADDING = 20
+TITLE_GAP = 27  # gaps below title, text rows and products
+ROW_GAP = 13
+PRODUCT_GAP = 8
+WRAPPED_LINE_GAP = 2  # between lines of one wrapped text
+BARCODE_PADDING = 30  # above and below barcode
+PRICE_GAP = 10  # min gap between product name and its price
+GLYPH_OVERFLOW = 4  # some glyphs are drawn a bit below line height
+TEXT_COLOR = 0  # black in L and RGB images
+
+
+class FontMetrics:
+    """Line height and advances of font characters, every character is measured by FreeType only once"""
+
+    __slots__ = ("font", "ascent", "descent", "line_height", "advances")
+
+    def __init__(self, font: ImageFont.FreeTypeFont):
+        self.font = font
+        self.ascent, self.descent = font.getmetrics()
+        self.line_height = self.ascent + self.descent
+        self.advances: dict[str, float] = {}
+
+    def text_width(self, text: str) -> int:
+        width = 0.0
+        for char in text:
+            advance = self.advances.get(char)
+            if advance is None:
+                advance = self.advances[char] = self.font.getlength(char)
+            width += advance
+        return math.ceil(width)
+
+
+font_metrics: dict[tuple[str, int], FontMetrics] = {}  # (font path, size): metrics, shared like fonts of registry
+
+
+def get_font_metrics(font: ImageFont.FreeTypeFont) -> FontMetrics:
+    key = (font.path, font.size)
+    metrics = font_metrics.get(key)
+    if metrics is None or metrics.font is not font:  # font file was changed and loaded again by registry
+        metrics = font_metrics[key] = FontMetrics(font)
+    return metrics
+
+
+class TextItem:
+    __slots__ = ("x", "y", "text", "font", "height")
+
+    def __init__(self, x: int, y: int, text: str, font: ImageFont.FreeTypeFont, height: int):
+        self.x = x
+        self.y = y
+        self.text = text
+        self.font = font
+        self.height = height  # line height of font
+
+    def __repr__(self):
+        return f"TextItem({self.x}, {self.y}, {self.text!r})"
+
+
+class ImageItem:
+    __slots__ = ("x", "y", "image", "height")
+
+    def __init__(self, x: int, y: int, image: Image.Image):
+        self.x = x
+        self.y = y
+        self.image = image
+        self.height = image.height
+
+    def __repr__(self):
+        return f"ImageItem({self.x}, {self.y}, {self.image.size})"
+
+
+class ReceiptLayout:
+    """Draw list of receipt and exact size of its canvas. Header (company title, address and phone) is
+    first header_items of draw list, it takes header_height pixels from top
+
+    """
+
+    __slots__ = ("width", "height", "items", "header_height", "header_items")
+
+    def __init__(self, width: int):
+        self.width = width
+        self.height = 0
+        self.items: list[TextItem | ImageItem] = []
+        self.header_height = 0
+        self.header_items = 0
+
+    def between(self, top: int, bottom: int, first_item: int = 0) -> "ReceiptLayout":
+        """Layout with items (starting from first_item) which are drawn on rows top:bottom"""
+        layout = ReceiptLayout(self.width)
+        layout.height = self.height
+        layout.items = [
+            item for item in self.items[first_item:] if item.y < bottom and item.y + item.height + GLYPH_OVERFLOW > top
+        ]
+        return layout
+
+    def add_lines(self, lines: list[str], metrics: FontMetrics, y: int, align: str = "left") -> int:
+        """Add lines of wrapped text starting at y, returns y below the last line"""
+        for number, line in enumerate(lines):
+            if number:
+                y += metrics.line_height + WRAPPED_LINE_GAP
+            if align == "center":
+                x = (self.width - metrics.text_width(line)) // 2
+            elif align == "right":
+                x = self.width - PRICE_RIGHT_PADDING - metrics.text_width(line)
+            else:
+                x = SIDE_PADDING
+            self.items.append(TextItem(x, y, line, metrics.font, metrics.line_height))
+        return y + metrics.line_height
+
+    def add_text(self, text: str, metrics: FontMetrics, y: int, gap: int, align: str = "left") -> int:
+        lines = wrap_text(text, self.width - 2 * SIDE_PADDING, metrics)
+        return self.add_lines(lines, metrics, y, align) + gap
+
+
+def wrap_text(text: str, max_width: int, metrics: FontMetrics) -> list[str]:
+    """Split text to lines not wider than max_width by spaces, too long words are split too"""
+    lines = []
+    line = ""
+    for word in text.split(" "):
+        candidate = f"{line} {word}" if line else word
+        if metrics.text_width(candidate) <= max_width:
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        while metrics.text_width(word) > max_width and len(word) > 1:
+            cut = len(word) - 1
+            while cut > 1 and metrics.text_width(word[:cut]) > max_width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+        line = word
+    lines.append(line)
+    return lines
+
+
+def format_price(value: Decimal) -> str:
+    return f"{round(value, 2)}$"
+
+
+def layout_receipt(
+    data: dict,
+    width: int,
+    header_font: ImageFont.FreeTypeFont,
+    paragraph_font: ImageFont.FreeTypeFont,
+    barcode: Image.Image | None = None,
+) -> ReceiptLayout:
+    """Place all receipt texts and barcode in one pass, using real font metrics. Canvas height is known after it"""
+    header = get_font_metrics(header_font)
+    paragraph = get_font_metrics(paragraph_font)
+    layout = ReceiptLayout(width)
+    separator = "-" * ((width - 2 * SIDE_PADDING) // paragraph.text_width("-"))
+
+    y = layout.add_text(data["header"]["title"].data, header, TOP_PADDING, TITLE_GAP, "center")
+    y = layout.add_text(f"Address: {data['header']['address'].data}", paragraph, y, ROW_GAP)
+    y = layout.add_text(f"Telephone: {data['header']['hotline_phone'].data}", paragraph, y, ROW_GAP)
+    layout.header_height, layout.header_items = y, len(layout.items)
+    created = data["header"]["datetime"].data.strftime("%d/%m/%Y %H:%M:%S")
+    y = layout.add_text(f"Date and time: {created}", paragraph, y, ROW_GAP)
+    y = layout.add_lines([separator], paragraph, y) + ROW_GAP
+
+    for product_name, product_cost in data["body"]["products"].data:
+        price = format_price(product_cost)
+        name_width = width - SIDE_PADDING - PRICE_RIGHT_PADDING - paragraph.text_width(price) - PRICE_GAP
+        layout.add_lines([price], paragraph, y, "right")
+        y = layout.add_lines(wrap_text(product_name, name_width, paragraph), paragraph, y) + PRODUCT_GAP
+
+    y = layout.add_lines([separator], paragraph, y) + ROW_GAP
+    layout.add_lines([format_price(data["body"]["amount"].data)], paragraph, y, "right")
+    y = layout.add_lines(["AMOUNT"], paragraph, y) + ROW_GAP
+    y = layout.add_text(f"Payment card: {data['footer']['card_number'].data}", paragraph, y, ROW_GAP)
+    y = layout.add_text(data["footer"]["wish_phrase"].data, paragraph, y, ROW_GAP, "center")
+
+    if barcode is not None:
+        y += BARCODE_PADDING
+        layout.items.append(ImageItem((width - barcode.width) // 2, y, barcode))
+        y += barcode.height
+    layout.height = y + BARCODE_PADDING
+    return layout
+
+
+class PillowBackend:
+    """Draws layout items with ImageDraw.text, FreeType rasterizes every text.
+    Other backends only need render(layout, canvas, top), layout does not depend on the way text is drawn
+
+    """
+
+    def render(self, layout: ReceiptLayout, canvas: Image.Image, top: int = 0):
+        """Draw layout on canvas, top is row of layout which is the first row of canvas"""
+        draw = ImageDraw.Draw(canvas)
+        for item in layout.items:
+            if isinstance(item, TextItem):
+                draw.text((item.x, item.y - top), item.text, TEXT_COLOR, font=item.font)
+            else:
+                canvas.paste(item.image, (item.x, item.y - top), item.image)
+
+
+PILLOW_BACKEND = PillowBackend()
@@ -1,42 +1,29 @@
 import os
-import json
+import time
 import logging
+from contextlib import contextmanager
 from datetime import datetime
-from typing import TypedDict, NamedTuple
+from typing import BinaryIO, TypedDict, NamedTuple
 from decimal import Decimal
 
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image
 
+from ecoreceipt_api.metrics import stage_timer
+from .encoders import JPEG_ENCODER, ReceiptEncoder
 from .generate_barcode import BarCodeOptions, generate_barcode_img
+from .glyph_atlas import ATLAS_BACKEND
+from .header_strips import get_header_strip, set_header_strip
+from .layout import PillowBackend, layout_receipt
+from .template_registry import MONOSPACE_FONT_PATH, template_registry
 
-
-class DateTimeAndDecimalEncoder(json.JSONEncoder):
-    """Instead of letting the default encoder convert datetime to string,
-    convert datetime objects into a dict, which can be decoded by the
-    DateTimeDecoder
-    """
-
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return {
-                "__type__": "datetime",
-                "year": obj.year,
-                "month": obj.month,
-                "day": obj.day,
-                "hour": obj.hour,
-                "minute": obj.minute,
-                "second": obj.second,
-                "microsecond": obj.microsecond,
-            }
-        elif isinstance(obj, Decimal):
-            return round(float(obj), 2)
-        else:
-            return json.JSONEncoder.default(self, obj)
+HEADER_FONT_SIZE = 32
+PARAGRAPH_FONT_SIZE = 12
+BACKGROUND_PADDING = 25  # background around paper
+STRIP_HEIGHT = 1024  # rows of receipt drawn at once
 
 
 class ReceiptDataItem(NamedTuple):
     data: str | datetime | Decimal | list[tuple[str, Decimal]]
-    height: int
 
 
 class ReceiptHeader(TypedDict):
@@ -62,87 +49,148 @@ class ReceiptData(TypedDict):
     footer: ReceiptFooter
 
 
-class Coords(NamedTuple):
-    x: int
-    y: int
+WISH_PHRASE = "THANK YOU FOR SHOPPING!"
+
+
+def make_receipt_data(
+    title: str,
+    address: str,
+    hotline_phone: str,
+    created: datetime,
+    products: list[tuple[str, Decimal]],
+    amount: Decimal,
+    card_number: str,
+    wish_phrase: str = WISH_PHRASE,
+) -> ReceiptData:
+    return {
+        "header": {
+            "title": ReceiptDataItem(title),
+            "address": ReceiptDataItem(address),
+            "hotline_phone": ReceiptDataItem(hotline_phone),
+            "datetime": ReceiptDataItem(created),
+        },
+        "body": {
+            "products": ReceiptDataItem(products),
+            "amount": ReceiptDataItem(amount),
+        },
+        "footer": {
+            "card_number": ReceiptDataItem(card_number),
+            "wish_phrase": ReceiptDataItem(wish_phrase),
+        },
+    }
+
+
+def dump_receipt_data(data: ReceiptData) -> dict:
+    """Compact json of receipt data, positions of texts are calculated by layout on every render"""
+    return {
+        "title": data["header"]["title"].data,
+        "address": data["header"]["address"].data,
+        "hotline_phone": data["header"]["hotline_phone"].data,
+        "created": data["header"]["datetime"].data.isoformat(),
+        "products": [[name, str(cost)] for name, cost in data["body"]["products"].data],
+        "amount": str(data["body"]["amount"].data),
+        "card_number": data["footer"]["card_number"].data,
+        "wish_phrase": data["footer"]["wish_phrase"].data,
+    }
+
+
+def load_receipt_data(value: dict) -> ReceiptData:
+    return make_receipt_data(
+        value["title"],
+        value["address"],
+        value["hotline_phone"],
+        datetime.fromisoformat(value["created"]),
+        [(name, Decimal(cost)) for name, cost in value["products"]],
+        Decimal(value["amount"]),
+        value["card_number"],
+        value["wish_phrase"],
+    )
+
+
+def get_edge_height(template: Image.Image, height: int) -> int:
+    return min(int(template.height * 0.2), height // 2)
+
+
+def resize_rows(image: Image.Image, size: tuple[int, int], top: int, bottom: int, box: tuple | None = None):
+    """Rows top:bottom of image (or of its box) resized to size, the whole resized image is not allocated"""
+    x0, y0, x1, y1 = box or (0, 0, image.width, image.height)
+    scale = (y1 - y0) / size[1]
+    return image.resize((size[0], bottom - top), box=(x0, y0 + top * scale, x1, y0 + bottom * scale))
+
+
+def stretch_template(template: Image.Image, height: int, top: int = 0, bottom: int | None = None) -> Image.Image:
+    """Rows top:bottom of paper with exact height, top and bottom parts of template are kept and its middle
+    is stretched
 
+    """
+    bottom = height if bottom is None else bottom
+    width = template.width
+    edge_height = get_edge_height(template, height)
+    paper = Image.new(template.mode, (width, bottom - top))
+    if top < edge_height:
+        paper.paste(template.crop((0, top, width, min(bottom, edge_height))), (0, 0))
+
+    middle_top, middle_bottom = max(top, edge_height), min(bottom, height - edge_height)
+    if middle_top < middle_bottom:
+        middle_box = (0, edge_height, width, template.height - edge_height)
+        middle = resize_rows(
+            template,
+            (width, height - 2 * edge_height),
+            middle_top - edge_height,
+            middle_bottom - edge_height,
+            middle_box,
+        )
+        paper.paste(middle, (0, middle_top - top))
 
-class ReceiptCornerCoords(TypedDict):
-    top_left: Coords
-    top_right: Coords
-    bottom_left: Coords
-    bottom_right: Coords
+    bottom_top = max(top, height - edge_height)
+    if bottom_top < bottom:
+        template_top = template.height - (height - bottom_top)
+        paper.paste(template.crop((0, template_top, width, template_top + bottom - bottom_top)), (0, bottom_top - top))
+    return paper
 
 
 class ReceiptBuilder:
-    def __init__(self, receipt_background_path: str, exact_receipt_path: str, full_receipt_save_path: str):
+    def __init__(
+        self,
+        receipt_background_path: str,
+        exact_receipt_path: str,
+        full_receipt_save_path: str | None = None,
+        backend: PillowBackend = ATLAS_BACKEND,
+    ):
         """Attention. This class do not create directories in receipt_background_path, exact_receipt_path and full_receipt_save_path.
-        They should be already created.
+        They should be already created. full_receipt_save_path is needed only if make_receipt is called without output.
 
         """
         self.bar_code = None
+        self.layout = None
+        self.stage_durations: dict[str, float] = {}
+        self.backend = backend
         if os.path.exists(exact_receipt_path):
             self.exact_receipt_path = exact_receipt_path
-            self.exact_receipt_original = Image.open(exact_receipt_path)
-            self.exact_receipt = self.exact_receipt_original.copy()
-            self.exact_receipt_draw = ImageDraw.Draw(self.exact_receipt)
+            self.exact_receipt = template_registry.get_image(exact_receipt_path, copy=False)  # only cropped
         else:
             raise Exception("Error. Exact receipt path is not valid")
 
         if os.path.exists(receipt_background_path):
             self.receipt_background_path = receipt_background_path
-            self.receipt_background_original = Image.open(receipt_background_path)
-            self.receipt_background = self.receipt_background_original.copy()
+            self.receipt_background = template_registry.get_image(receipt_background_path, copy=False)  # only resized
         else:
             raise Exception("Error. Receipt background path is not valid")
 
-        save_receipt_path = os.path.dirname(full_receipt_save_path)
-        if os.path.exists(save_receipt_path):
-            self.full_receipt_save_path = full_receipt_save_path
-        else:
+        self.full_receipt_save_path = full_receipt_save_path
+        if full_receipt_save_path is not None and not os.path.exists(os.path.dirname(full_receipt_save_path)):
             raise Exception("Error. Full receipt path is not valid")
 
-    def set_params(self, data: ReceiptData):
-        logging.log(logging.INFO, f"Current working directory: {os.getcwd()}")
-        self.monospace_header = ImageFont.truetype(
-            "./receipt_creation/internal_fonts/NotoSansMono-Regular.ttf", 32
-        )  # TODO: font by default
-        self.monospace_paragraph = ImageFont.truetype("./receipt_creation/internal_fonts/NotoSansMono-Regular.ttf", 12)
-        self.header_symbol_width = 16  # 3  -  count of pixels between symbols
-        self.paragraph_symbol_width = 5  # 2
-
+    def set_params(self, data: ReceiptData, header_key: tuple[int, datetime] | None = None):
+        """header_key is (company id, company updated), with it header strip of company is drawn once and cached"""
+        self.monospace_header = template_registry.get_font(MONOSPACE_FONT_PATH, HEADER_FONT_SIZE)
+        self.monospace_paragraph = template_registry.get_font(MONOSPACE_FONT_PATH, PARAGRAPH_FONT_SIZE)
         self.data = data
-
+        self.header_key = header_key
         self.receipt_width = self.exact_receipt.width
-        self.receipt_height = self.exact_receipt.height
-        self.ox_middle_coords = self.receipt_width // 2
-        self.receipt_next_line_oy = 20
-
-    def add_receipt_sections(
-        self, coords: Coords, text: str, font: ImageFont.FreeTypeFont | None = None, color: tuple = (0, 0, 0)
-    ):
-        if font is None:
-            font = self.monospace_paragraph
-
-        logging.log(logging.INFO, text)
-        logging.log(logging.INFO, f"Add text by coords: {(coords.x, coords.y)}")
-        self.exact_receipt_draw.text(coords, text, color, font=font)
-
-    def paste_image(self, coords: Coords, img: Image):
-        self.exact_receipt.paste(img, (coords.x, coords.y), img)
 
     def generate_barcode_img(self):
-        receipt_datetime = self.data["header"]["datetime"].data
-        year, month, day, hour, minute = (
-            receipt_datetime.year,
-            receipt_datetime.month,
-            receipt_datetime.day,
-            receipt_datetime.hour,
-            receipt_datetime.minute,
-        )
-
         options: BarCodeOptions = {
-            "text": json.dumps(self.data, cls=DateTimeAndDecimalEncoder),
             "format": "PNG",
             "font_size": 10,
             "module_width": 0.7,
@@ -150,175 +198,104 @@ class ReceiptBuilder:
             "quiet_zone": 1,
         }
 
-        barcode_save_path = os.path.join(
-            os.path.dirname(self.full_receipt_save_path), f"barcode_{year}_{month}_{day}_{hour}_{minute}.png"
-        )
-        bar_code = generate_barcode_img(options, barcode_save_path)
-        if bar_code is not None:
-            self.bar_code_new_width = self.receipt_width - 100
-            bar_code_resize_coef = self.bar_code_new_width / bar_code.width
-            self.bar_code_new_height = int(bar_code.height * bar_code_resize_coef)
-
-            bar_code = bar_code.resize((self.bar_code_new_width, self.bar_code_new_height))
-            self.bar_code_middle_ox = bar_code.width // 2
-            self.bar_code = bar_code
-
-    def calc_receipt_content_height(self):
-        receipt_data_height = self.receipt_next_line_oy
-        receipt_data_height += self.data["header"]["title"].height
-        receipt_data_height += self.data["header"]["address"].height
-        receipt_data_height += self.data["header"]["hotline_phone"].height
-        receipt_data_height += self.data["header"]["datetime"].height
-
-        receipt_data_height += self.data["body"]["products"].height
-        receipt_data_height += self.data["body"]["amount"].height
-
-        receipt_data_height += self.data["footer"]["card_number"].height
-        receipt_data_height += self.data["footer"]["wish_phrase"].height
-
-        receipt_data_height += 30 + self.bar_code_new_height + 30  # + top and bottom padding on receipt
-        logging.log(logging.INFO, f"Needed receipt height: {receipt_data_height}")
-        return receipt_data_height
+        bar_code = generate_barcode_img(options)  # only pasted on receipt, so it is not saved to disk
+        bar_code_new_width = self.receipt_width - 100
+        bar_code_new_height = int(bar_code.height * bar_code_new_width / bar_code.width)
+        self.bar_code = bar_code.resize((bar_code_new_width, bar_code_new_height))
 
-    def resize_receipt_img(self):
-        needed_receipt_height = self.calc_receipt_content_height()
-
-        bottom_height = top_height = int(self.exact_receipt.height * 0.2)
-        middle_height = self.receipt_height - top_height - bottom_height
-
-        top = self.exact_receipt.crop((0, 0, self.receipt_width, top_height))
-        middle = self.exact_receipt.crop((0, top_height, self.receipt_width, top_height + middle_height))
-        bottom = self.exact_receipt.crop((0, top_height + middle_height, self.receipt_width, self.receipt_height))
-
-        new_middle_height = needed_receipt_height - top_height - bottom_height
-        middle_resized = middle.resize((middle.width, new_middle_height))
-        self.exact_receipt = Image.new("RGB", (self.receipt_width, top_height + new_middle_height + bottom_height))
+    def layout_receipt(self):
+        self.layout = layout_receipt(
+            self.data, self.receipt_width, self.monospace_header, self.monospace_paragraph, self.bar_code
+        )
+        logging.log(
+            logging.DEBUG,
+            "Receipt layout: w - %s, h - %s, %s items",
+            self.layout.width,
+            self.layout.height,
+            len(self.layout.items),
+        )
 
-        self.exact_receipt.paste(top, (0, 0))
-        self.exact_receipt.paste(middle_resized, (0, top_height))
-        self.exact_receipt.paste(bottom, (0, top_height + new_middle_height))
+    def draw_receipt(self):
+        """Draw paper with layout on background by strips of STRIP_HEIGHT rows, straight into receipt image.
 
-        self.exact_receipt_draw = ImageDraw.Draw(self.exact_receipt)
-        self.receipt_width = self.exact_receipt.width
-        self.receipt_height = self.exact_receipt.height
-        self.ox_middle_coords = self.receipt_width // 2
+        Only receipt image (one byte per pixel) has full height, stretched template and background and pixels
+        of text are allocated for one strip, so long receipts do not take much more memory than their image.
 
-        logging.log(
-            logging.INFO,
-            f"Resized receipt w - {self.receipt_width}, h - {self.receipt_height}, middle_ox - {self.ox_middle_coords}",
+        """
+        paper_mode = self.receipt_background.mode  # paper pasted on background took its mode anyway
+        template = self.exact_receipt.convert(paper_mode)
+        background = self.receipt_background
+        width, height = self.layout.width + 2 * BACKGROUND_PADDING, self.layout.height + 2 * BACKGROUND_PADDING
+        self.receipt_background = Image.new(paper_mode, (width, height))
+
+        for top in range(0, height, STRIP_HEIGHT):
+            bottom = min(top + STRIP_HEIGHT, height)
+            strip = resize_rows(background, (width, height), top, bottom)
+            paper_top = max(top - BACKGROUND_PADDING, 0)
+            paper_bottom = min(bottom - BACKGROUND_PADDING, self.layout.height)
+            if paper_top < paper_bottom:
+                paper = self.draw_paper_rows(template, paper_top, paper_bottom)
+                strip.paste(paper, (BACKGROUND_PADDING, paper_top + BACKGROUND_PADDING - top))
+            self.receipt_background.paste(strip, (0, top))
+
+    def draw_paper_rows(self, template: Image.Image, top: int, bottom: int) -> Image.Image:
+        paper = stretch_template(template, self.layout.height, top, bottom)
+        # top part of template is not stretched, so header strip is the same on every receipt of company
+        header_height = self.layout.header_height
+        if (
+            self.header_key is None
+            or top > 0
+            or header_height > bottom
+            or header_height > get_edge_height(template, self.layout.height)
+        ):
+            self.backend.render(self.layout.between(top, bottom), paper, top)
+            return paper
+
+        company_id, company_updated = self.header_key
+        version = (company_updated, self.get_template_version())
+        header = self.data["header"]
+        texts = (header["title"].data, header["address"].data, header["hotline_phone"].data)
+        strip = get_header_strip(company_id, version, texts)
+        if strip is not None:
+            paper.paste(strip, (0, 0))
+            self.backend.render(self.layout.between(top, bottom, self.layout.header_items), paper, top)
+        else:
+            self.backend.render(self.layout.between(top, bottom), paper, top)
+            set_header_strip(company_id, version, texts, paper.crop((0, 0, self.layout.width, header_height)))
+        return paper
+
+    def get_template_version(self) -> tuple:
+        return (
+            self.exact_receipt_path,
+            template_registry.get_file_version(self.exact_receipt_path),
+            template_registry.get_file_version(MONOSPACE_FONT_PATH),
         )
 
-    def add_receipt_background(self):
-        self.receipt_background = self.receipt_background.resize((self.receipt_width + 50, self.receipt_height + 50))
-        self.receipt_background.paste(self.exact_receipt, (25, 25))
-        self.receipt_background.save(self.full_receipt_save_path)
-
-    def fill_receipt_img(self):
-        # Add company name to receipt
-        company_name_count_symbols = len(self.data["header"]["title"].data)
-        company_name_spaces_count = company_name_count_symbols - 1
-        # Using Mono font, every symbol width 16 px and +-3 for space between symbols
-        company_name_width = company_name_count_symbols * self.header_symbol_width + company_name_spaces_count * 3
-
-        coords: Coords = Coords(self.ox_middle_coords - company_name_width // 2, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Company name receipt coords: x - {coords.x}, y - {coords.y}")
-        title_data, title_height = self.data["header"]["title"]
-        self.add_receipt_sections(coords, title_data, self.monospace_header)
-        self.receipt_next_line_oy += title_height
-
-        # Add address
-        coords: Coords = Coords(10, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Company address receipt coords: x - {coords.x}, y - {coords.y}")
-        address_data, address_height = self.data["header"]["address"]
-        self.add_receipt_sections(coords, f"Address: {address_data}")
-        self.receipt_next_line_oy += address_height
-
-        # Add phone
-        coords: Coords = Coords(10, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Company phone receipt coords: x - {coords.x}, y - {coords.y}")
-        phone_data, phone_height = self.data["header"]["hotline_phone"]
-        self.add_receipt_sections(coords, f"Telephone: {phone_data}")
-        self.receipt_next_line_oy += phone_height
-
-        # Add date and time
-        coords: Coords = Coords(10, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Receipt datetime coords: x - {coords.x}, y - {coords.y}")
-        datetime_data, datetime_height = self.data["header"]["datetime"]
-        self.add_receipt_sections(coords, f'Date and time: {datetime_data.strftime("%d/%m/%Y %H:%M:%S")}')
-        self.receipt_next_line_oy += datetime_height
-
-        # Add list of bought goods
-        coords: Coords = Coords(10, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Start line of list of products coords: x - {coords.x}, y - {coords.y}")
-        self.add_receipt_sections(coords, "-----------------------------------------------------")
-        self.receipt_next_line_oy += 30
-
-        for product_tuple in self.data["body"]["products"].data:
-            product_name, product_cost = product_tuple
-            coords: Coords = Coords(10, self.receipt_next_line_oy)
-            logging.log(logging.INFO, f"Product coords: x - {coords.x}, y - {coords.y}")
-            self.add_receipt_sections(coords, product_name)
-
-            cost_str = f"{round(product_cost, 2)}$"
-            cost_str_width = len(cost_str) * self.paragraph_symbol_width + (len(cost_str) - 1) * 2
-            coords: Coords = Coords(self.receipt_width - 30 - cost_str_width, self.receipt_next_line_oy)
-
-            self.add_receipt_sections(coords, cost_str)
-
-            self.receipt_next_line_oy += 25
-
-        self.receipt_next_line_oy += 5
-
-        coords: Coords = Coords(10, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"End line of list of products coords: x - {coords.x}, y - {coords.y}")
-        self.add_receipt_sections(coords, "-----------------------------------------------------")
-        self.receipt_next_line_oy += 20
-
-        # Add total sum
-        coords: Coords = Coords(10, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Text 'AMOUNT' coords: x - {coords.x}, y - {coords.y}")
-        self.add_receipt_sections(coords, "AMOUNT")
-        logging.log(logging.INFO, f"Amount sum coords: x - {coords.x}, y - {coords.y}")
-
-        amount_data, amount_height = self.data["body"]["amount"]
-        amount_str = f"{round(amount_data, 2)}$"
-        amount_str_width = len(amount_str) * self.paragraph_symbol_width + (len(amount_str) - 1) * 2
-
-        coords: Coords = Coords(self.receipt_width - 30 - amount_str_width, self.receipt_next_line_oy)
-
-        self.add_receipt_sections(coords, amount_str)
-        self.receipt_next_line_oy += amount_height
-
-        # Add user card number
-        coords: Coords = Coords(10, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Payment card coords: x - {coords.x}, y - {coords.y}")
-        card_number_data, card_number_height = self.data["footer"]["card_number"]
-        self.add_receipt_sections(coords, f"Payment card: {card_number_data}")
-        self.receipt_next_line_oy += card_number_height
-
-        # Add wish phrase
-        wish_phrase_data, wish_phrase_height = self.data["footer"]["wish_phrase"]
-        phrase_count_symbols = len(wish_phrase_data)
-        phrase_spaces_count = phrase_count_symbols - 1
-        phrase_width = phrase_count_symbols * 5 + phrase_spaces_count * 2
-
-        coords: Coords = Coords(self.ox_middle_coords - phrase_width // 2, self.receipt_next_line_oy)
-        logging.log(logging.INFO, f"Wish phrase coords: x - {coords.x}, y - {coords.y}")
-        self.add_receipt_sections(coords, wish_phrase_data)
-        self.receipt_next_line_oy += wish_phrase_height
-
-        if self.bar_code is not None:
-            barcode_coords: Coords = Coords(
-                self.ox_middle_coords - self.bar_code_middle_ox, self.receipt_height - self.bar_code.height - 30
-            )
-            logging.log(logging.INFO, f"Barcode coords: x - {barcode_coords.x}, y - {barcode_coords.y}")
-            self.paste_image(barcode_coords, self.bar_code.copy())
-
-        self.exact_receipt.save(self.full_receipt_save_path)
-
-    def make_receipt(self):
-        self.generate_barcode_img()
-        self.resize_receipt_img()
-        self.fill_receipt_img()
-        self.add_receipt_background()
-        return os.path.join(self.full_receipt_save_path)
+    def make_receipt(self, output: BinaryIO | None = None, encoder: ReceiptEncoder = JPEG_ENCODER) -> int:
+        """Build receipt in memory and encode it once to output (full_receipt_save_path if it is not given).
+        Returns size of encoded receipt in bytes
+
+        """
+        with self.stage("barcode"):
+            self.generate_barcode_img()
+        with self.stage("layout"):
+            self.layout_receipt()
+        with self.stage("draw"):
+            self.draw_receipt()
+        if output is not None:
+            return self.encode_receipt(output, encoder)
+        with open(self.full_receipt_save_path, "wb") as receipt_file:
+            return self.encode_receipt(receipt_file, encoder)
+
+    def encode_receipt(self, output: BinaryIO, encoder: ReceiptEncoder) -> int:
+        """Encode built receipt again, e.g. its smaller variant. Returns size in bytes"""
+        with self.stage("encode"):
+            return encoder.encode(self.receipt_background, output)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Stage of make_receipt, its duration is observed by metrics and kept in stage_durations (seconds)"""
+        started = time.perf_counter()
+        with stage_timer("make_receipt", name):
+            yield
+        self.stage_durations[name] = time.perf_counter() - started
@@ -0,0 +1,61 @@
+import os
+import threading
+
+from PIL import Image, ImageFont
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "internal_fonts")
+MONOSPACE_FONT_PATH = os.path.join(FONTS_DIR, "NotoSansMono-Regular.ttf")
+
+
+class TemplateRegistry:
+    """Process-wide cache of decoded receipt template images and fonts.
+
+    Images are decoded once and handed out as copies, unless caller only reads them (copy=False). Fonts are shared,
+    drawing does not change them. Every entry is loaded again when its file is changed (mtime or size).
+
+    """
+
+    def __init__(self):
+        self.images: dict[str, tuple[tuple[int, int], Image.Image]] = {}  # path: (file version, image)
+        self.fonts: dict[tuple[str, int], tuple[tuple[int, int], ImageFont.FreeTypeFont]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_file_version(path: str) -> tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get_image(self, path: str, copy: bool = True) -> Image.Image:
+        version = self.get_file_version(path)
+        with self.lock:
+            entry = self.images.get(path)
+            if entry is None or entry[0] != version:
+                with Image.open(path) as image:
+                    image.load()
+                    entry = (version, image.copy())  # copy is detached from closed file
+                self.images[path] = entry
+        return entry[1].copy() if copy else entry[1]
+
+    def get_font(self, path: str, size: int) -> ImageFont.FreeTypeFont:
+        version = self.get_file_version(path)
+        with self.lock:
+            entry = self.fonts.get((path, size))
+            if entry is None or entry[0] != version:
+                entry = (version, ImageFont.truetype(path, size))
+                self.fonts[(path, size)] = entry
+        return entry[1]
+
+    def preload(self, image_paths: list[str], fonts: list[tuple[str, int]]):
+        """Load templates at worker start, so the first receipt is not slower than others"""
+        for path in image_paths:
+            self.get_image(path)
+        for path, size in fonts:
+            self.get_font(path, size)
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.fonts.clear()
+
+
+template_registry = TemplateRegistry()
@@ -1,4 +1,3 @@
-import asyncio
 import logging
 
 from aiogram.types import URLInputFile
@@ -7,22 +6,10 @@ from telegram_bot.bot import bot
 
 
 async def send_receipt(photo_path: str, chat_id: str, caption: str):
-    try:
-        logging.log(logging.INFO, f"photo_path: {photo_path}, chat_id: {chat_id}, caption: {caption}")
-        photo = URLInputFile(photo_path)
-        logging.log(logging.INFO, photo)
-        await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
-    except Exception as ex:  # can be error if bot not started
-        logging.log(logging.INFO, f"Error. Caught exception while trying to send receipt photo to user: {ex}")
+    logging.log(logging.INFO, "photo_path: %s, chat_id: %s, caption: %s", photo_path, chat_id, caption)
+    photo = URLInputFile(photo_path)
+    await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
 
 
 async def send_message(chat_id: str, message: str):
     await bot.send_message(chat_id, message)
-
-
-def run_async_send_message_in_process(chat_id: str, message: str):
-    asyncio.run(send_message(chat_id, message))
-
-
-def run_async_send_receipt_in_process(receipt_url: str, chat_id: str, caption: str):
-    asyncio.run(send_receipt(receipt_url, chat_id, caption))
@@ -1,13 +1,15 @@
 import os
+import logging
 
 from aiohttp import ClientSession
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import CommandStart
-from aiogram.types import Message, URLInputFile, CallbackQuery, ReplyKeyboardRemove
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 from aiogram import F, Router
 
 from bot import bot
 from fsmcontext_types import SendIncreaseBalanceRequest
+from receipt_photos import get_receipt_photo
 from redis_db import get_user_auth_status
 from utils import send_user_analytics
 from keyboards import (
@@ -48,22 +50,24 @@ async def show_receipts_handler(message: Message):
 
     async with ClientSession() as session:
         async with session.get(
-            f"{SERVER_API_DOMAIN}get_user_transactions?count=10&offset=0", headers=headers
+            f"{SERVER_API_DOMAIN}get_user_transactions/?limit=10&shape=flat", headers=headers
         ) as response:
             if response.ok:
                 response_data = await response.json()
                 if response_data["results"]:
                     for transaction in response_data["results"]:
-                        receipt_path = transaction["receipt"]["img"]
-                        photo = URLInputFile(receipt_path)
+                        photo = get_receipt_photo(transaction, SERVER_API_DOMAIN, headers)
 
                         card_balance = transaction["card_balance_after"]
-                        card_number = "**** **** **** " + transaction["card"]["_card_number"][-4:]
-                        await bot.send_photo(
-                            chat_id=message.chat.id,
-                            photo=photo,
-                            caption=f"Card: {card_number}\nCard balance after this operation: {card_balance}",
-                        )
+                        card_number = "**** **** **** " + transaction["card_number"][-4:]
+                        try:
+                            await bot.send_photo(
+                                chat_id=message.chat.id,
+                                photo=photo,
+                                caption=f"Card: {card_number}\nCard balance after this operation: {card_balance}",
+                            )
+                        except Exception as ex:  # receipt image can not be rendered, other receipts are sent
+                            logging.info("Error. Receipt %s was not sent: %s", transaction["receipt_id"], ex)
                 else:
                     await message.answer("❕There are not receipts for now")
             else:
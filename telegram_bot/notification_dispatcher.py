@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from asgiref.sync import sync_to_async
+from django.db import transaction as django_transaction
+from django.db.models import Q, Exists, OuterRef
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from database_models.models import Notification, Receipt
+from telegram_bot.bot import bot
+from telegram_bot.bot_send_receipt import send_message, send_receipt
+
+
+class NotificationDispatcher:
+    """Drains Notification outbox with one bot http session.
+
+    Due notifications are claimed by moving their next_attempt_at forward on lease seconds,
+    so several dispatchers can work with one outbox. Receipt notifications wait until receipt is rendered
+    and are skipped if card owner is not logged in at that moment.
+
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 10,
+        batch_size: int = 50,
+        max_attempts: int = 5,
+        backoff_base: float = 2.0,
+        backoff_max: float = 600.0,
+        lease: int = 60,
+    ):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+
+    def claim_due_notifications(self) -> list[Notification]:
+        now = timezone.now()
+        with django_transaction.atomic():
+            notifications = list(
+                Notification.objects.select_for_update(skip_locked=True, of=("self",))
+                .select_related("receipt")
+                .annotate(
+                    owner_logged_in=Exists(
+                        Token.objects.filter(user__profile__cards__transactions__receipt=OuterRef("receipt"))
+                    )
+                )
+                .filter(delivery_status=Notification.STATUSES["pending"], next_attempt_at__lte=now)
+                .filter(
+                    Q(kind=Notification.KINDS["message"])
+                    | Q(
+                        receipt__render_status__in=[Receipt.RENDER_STATUSES["ready"], Receipt.RENDER_STATUSES["failed"]]
+                    )
+                )
+                .order_by("next_attempt_at")[: self.batch_size]
+            )
+            Notification.objects.filter(id__in=[notification.id for notification in notifications]).update(
+                next_attempt_at=now + timedelta(seconds=self.lease)
+            )
+        return notifications
+
+    def get_retry_delay(self, attempts: int) -> float:
+        return min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+
+    def mark_failed_attempt(self, notification: Notification, error: str, retry_after: float | None = None):
+        notification.last_error = error
+        if notification.attempts >= self.max_attempts:
+            notification.delivery_status = Notification.STATUSES["failed"]
+        else:
+            delay = retry_after if retry_after is not None else self.get_retry_delay(notification.attempts)
+            notification.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+    async def deliver(self, notification: Notification):
+        if notification.kind == Notification.KINDS["receipt"] and not notification.owner_logged_in:
+            notification.delivery_status = Notification.STATUSES["skipped"]
+            await sync_to_async(notification.save)(update_fields=["delivery_status", "updated"])
+            return
+
+        async with self.semaphore:
+            notification.attempts += 1
+            try:
+                receipt = notification.receipt
+                if receipt is not None and receipt.render_status == Receipt.RENDER_STATUSES["ready"]:
+                    receipt_url = await sync_to_async(receipt.get_img_url)(preview=True)
+                    await send_receipt(receipt_url, notification.telegram_chat_id, notification.text)
+                else:  # plain message or receipt which can not be rendered
+                    await send_message(notification.telegram_chat_id, notification.text)
+            except TelegramRetryAfter as ex:
+                self.mark_failed_attempt(notification, str(ex), ex.retry_after)
+            except (TelegramBadRequest, TelegramForbiddenError) as ex:  # chat not found or bot blocked by user
+                notification.last_error = str(ex)
+                notification.delivery_status = Notification.STATUSES["failed"]
+            except Exception as ex:
+                self.mark_failed_attempt(notification, str(ex))
+            else:
+                notification.delivery_status = Notification.STATUSES["sent"]
+                notification.sent_at = timezone.now()
+
+        logging.log(
+            logging.INFO,
+            "Notification %s attempt %s: %s",
+            notification.id,
+            notification.attempts,
+            notification.delivery_status,
+        )
+        await sync_to_async(notification.save)(
+            update_fields=["attempts", "delivery_status", "next_attempt_at", "last_error", "sent_at", "updated"]
+        )
+
+    async def run(self, interval: float = 1.0, once: bool = False):
+        try:
+            while True:
+                notifications = await sync_to_async(self.claim_due_notifications)()
+                if notifications:
+                    await asyncio.gather(*(self.deliver(notification) for notification in notifications))
+                elif once:
+                    break
+                else:
+                    await asyncio.sleep(interval)
+        finally:
+            await bot.session.close()
@@ -0,0 +1,12 @@
+from aiogram.types import URLInputFile
+
+
+def get_receipt_photo(transaction: dict, server_api_domain: str, headers: dict) -> URLInputFile:
+    """Receipt photo of transaction (flat shape of get_user_transactions). Receipt which has no image yet
+    (on_demand or not rendered by worker yet) is rendered and stored by get_receipt_image on this request
+
+    """
+    if transaction["receipt_img"]:
+        return URLInputFile(transaction["receipt_img"])
+    url = f"{server_api_domain}get_receipt_image/{transaction['receipt_id']}/?preview=1"
+    return URLInputFile(url, headers=headers)
@@ -1,10 +1,22 @@
 import os
+import json
+import logging
+import threading
+from io import StringIO
 from decimal import Decimal
+from datetime import timedelta
 
-from django.test import TestCase, Client
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.contrib.auth.models import User
+from prometheus_client import REGISTRY
 
-from database_models.models import Profile, Card, Company, Transaction
+from ecoreceipt_api.logs import JsonFormatter, QueueListenerHandler, RequestIdFilter, SampleFilter
+from database_models.ledger import get_ledger_balance, card_account, company_account
+from database_models.models import Profile, Card, Company, Transaction, Notification, IdempotencyKey, LedgerEntry
 
 
 class WriteOffMoneyViewTestCase(TestCase):
@@ -53,6 +65,15 @@ class WriteOffMoneyViewTestCase(TestCase):
         response = self.client.post(self.url, body)
         self.assertEqual(response.status_code, 404)
 
+    def test_card_changed_after_it_was_cached(self):
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+        self.client.post(self.url, body)  # card and company are cached
+        Card.objects.filter(id=self.card.id).update(_card_uid="ffffffff")  # update() does not invalidate cache
+
+        response = self.client.post(self.url, body)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["terminal_message"], "Card is invalid")
+
     def test_correct_request(self):
         body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
         response = self.client.post(self.url, body)
@@ -68,7 +89,11 @@ class WriteOffMoneyViewTestCase(TestCase):
         transaction = transactions.first()
         self.assertEqual(transaction.card, self.card)
         self.assertEqual(transaction.company, self.company)
-        self.assertNotEqual(str(transaction.receipt.img), "")
+        self.assertEqual(response_data["receipt_id"], transaction.receipt.id)
+
+        # Receipt is rendered by worker, not inside payment request
+        self.assertEqual(str(transaction.receipt.img), "")
+        self.assertEqual(transaction.receipt.render_status, "pending")
 
         self.assertEqual(transaction.amount, Decimal(10))
         self.assertEqual(transaction.card_balance_before, Decimal(100))
@@ -77,10 +102,509 @@ class WriteOffMoneyViewTestCase(TestCase):
         self.assertEqual(transaction.company_balance_before, Decimal(0))
         self.assertEqual(transaction.company_balance_after, Decimal(10))
 
-        # Removing receipt and barcode image after tests
+        call_command("render_receipts", "--once", "--workers", "0", stdout=StringIO())
+        transaction.receipt.refresh_from_db()
+        self.assertEqual(transaction.receipt.render_status, "ready")
+        self.assertNotEqual(str(transaction.receipt.img), "")
+
+        # Barcode is rendered in memory, only receipt image is saved
         receipt_path = f"media/{transaction.receipt.img}"
-        barcode_path = str(transaction.receipt.img).replace("receipt", "barcode").replace("jpg", "png.png")
-        barcode_path = f"media/{barcode_path}"
+        self.assertFalse([name for name in os.listdir(os.path.dirname(receipt_path)) if name.startswith("barcode_")])
 
+        # Removing receipt image after tests
         os.remove(receipt_path)
-        os.remove(barcode_path)
+
+    def test_receipt_without_notification_rendered_on_demand(self):
+        self.profile.telegram_chat_id = ""
+        self.profile.save()
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+        response = self.client.post(self.url, body)
+        self.assertEqual(response.status_code, 200)
+
+        call_command("render_receipts", "--once", "--workers", "0", stdout=StringIO())
+        transaction = Transaction.objects.get(id=response.json()["transaction_id"])
+        self.assertEqual(transaction.receipt.render_status, "on_demand")
+        self.assertFalse(Notification.objects.exists())
+
+    def test_receipt_keeps_company_at_payment_time(self):
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+        response = self.client.post(self.url, body)
+        self.company.name = "Renamed company"
+        self.company.street = "Pushkinska"
+        self.company.save()
+
+        receipt = Transaction.objects.get(id=response.json()["transaction_id"]).receipt
+        self.assertEqual(receipt.data["title"], "Company")
+        self.assertEqual(receipt.data["address"], "Ukraine, Kharkiv, Sumska 12")
+        self.assertEqual(receipt.data["hotline_phone"], "+380000000000")
+        self.assertEqual(receipt.data["card_number"], f"**** **** **** {self.card.card_number[-4:]}")
+        self.assertEqual(sum(Decimal(cost) for _, cost in receipt.data["products"]), Decimal(10))
+        self.assertEqual(receipt.get_receipt_data()["header"]["title"].data, "Company")
+
+    def test_incorrect_amount(self):
+        body = {"card_uid": self.card.card_uid, "amount": -10, "company_token": self.company.company_token}
+        response = self.client.post(self.url, body)
+        self.assertEqual(response.status_code, 400)
+
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(100))
+
+    def test_failed_payment_changes_nothing(self):
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": "1"}
+        self.client.post(self.url, body)
+
+        self.card.refresh_from_db()
+        self.company.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(100))
+        self.assertEqual(self.company.get_balance(), Decimal(0))
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_receipt_notification_added(self):
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+        response = self.client.post(self.url, body)
+        self.assertEqual(response.status_code, 200)
+
+        notification = Notification.objects.get()
+        self.assertEqual(notification.kind, "receipt")
+        self.assertEqual(notification.telegram_chat_id, "1111111")
+        self.assertEqual(notification.receipt.id, response.json()["receipt_id"])
+        self.assertEqual(notification.text, "Card balance: 90.00")
+
+    def test_payment_written_to_ledger(self):
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+        self.client.post(self.url, body)
+
+        card_entry, company_entry = LedgerEntry.objects.filter(kind="payment").order_by("amount")
+        self.assertEqual(card_entry.transfer, company_entry.transfer)
+        self.assertEqual((card_entry.account_type, card_entry.account_id), card_account(self.card.id))
+        self.assertEqual(card_entry.amount, Decimal(-10))
+        self.assertEqual(get_ledger_balance(company_account(self.company.id)), Decimal(10))
+
+    def test_payment_queries_budget(self):
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+        self.client.post(self.url, body)  # card and company are cached after first payment
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url, body)
+        self.assertEqual(response.status_code, 200)
+
+        # Savepoints are made only because test itself runs in transaction
+        queries = [query["sql"] for query in context.captured_queries if "SAVEPOINT" not in query["sql"]]
+        self.assertLessEqual(len(queries), 4, queries)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        profile = Profile.objects.create(user=user, telegram_chat_id="1111111")
+        self.card = Card.objects.create(owner=profile, _card_uid="b2af5522", _balance=100)
+        self.company = Company.objects.create(name="Company")
+        self.company.generate_token()
+
+    def get_metric(self, name: str, labels: dict) -> float:
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    def test_payment_metrics(self):
+        route = {"route": "terminal_api/write_off_money/"}
+        requests_before = self.get_metric(
+            "ecoreceipt_http_request_duration_seconds_count", {**route, "method": "POST", "status": "200"}
+        )
+        queries_before = self.get_metric("ecoreceipt_http_request_db_queries_sum", route)
+        stages_before = {
+            stage: self.get_metric(
+                "ecoreceipt_stage_duration_seconds_count", {"operation": "write_off_money", "stage": stage}
+            )
+            for stage in ("lookup", "debit", "record", "notify")
+        }
+
+        body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+        self.assertEqual(self.client.post("/terminal_api/write_off_money/", body).status_code, 200)
+
+        self.assertEqual(
+            self.get_metric(
+                "ecoreceipt_http_request_duration_seconds_count", {**route, "method": "POST", "status": "200"}
+            ),
+            requests_before + 1,
+        )
+        self.assertGreater(self.get_metric("ecoreceipt_http_request_db_queries_sum", route), queries_before)
+        for stage, count in stages_before.items():
+            self.assertEqual(
+                self.get_metric(
+                    "ecoreceipt_stage_duration_seconds_count", {"operation": "write_off_money", "stage": stage}
+                ),
+                count + 1,
+            )
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            b'ecoreceipt_stage_duration_seconds_count{operation="write_off_money",stage="debit"}', response.content
+        )
+        self.assertIn(b"ecoreceipt_entity_cache_lookups_total", response.content)
+
+
+class LoggingTestCase(TestCase):
+    def make_record(self, msg: str, *args, level: int = logging.INFO, lineno: int = 1, **extra) -> logging.LogRecord:
+        record = logging.LogRecord("root", level, "views.py", lineno, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter(self):
+        record = self.make_record("Payment transaction made with id: %s", 5, receipt_id=7)
+        record.request_id = "abc"
+        data = json.loads(JsonFormatter().format(record))
+        self.assertEqual(data["message"], "Payment transaction made with id: 5")
+        self.assertEqual(data["level"], "INFO")
+        self.assertEqual(data["request_id"], "abc")
+        self.assertEqual(data["receipt_id"], 7)
+
+    def test_debug_records_are_sampled_per_line(self):
+        sample_filter = SampleFilter(every=10)
+        first_line = [sample_filter.filter(self.make_record("row", level=logging.DEBUG)) for _ in range(25)]
+        other_line = sample_filter.filter(self.make_record("row", level=logging.DEBUG, lineno=2))
+        info = [sample_filter.filter(self.make_record("row")) for _ in range(5)]
+        self.assertEqual(first_line.count(True), 3)
+        self.assertTrue(other_line)
+        self.assertTrue(all(info))
+
+    def test_sampling_is_exact_in_threads(self):
+        sample_filter = SampleFilter(every=10)
+        record = self.make_record("row", level=logging.DEBUG)
+        passed = []
+
+        def log_rows():
+            passed.append(sum(sample_filter.filter(record) for _ in range(1000)))
+
+        threads = [threading.Thread(target=log_rows) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(passed), 800)
+
+    def test_queue_handler_writes_records_by_listener(self):
+        stream = StringIO()
+        target = logging.StreamHandler(stream)
+        handler = QueueListenerHandler([target])
+        try:
+            handler.handle(self.make_record("Receipt %s rendered", 3))
+            handler.flush()
+            self.assertEqual(stream.getvalue(), "Receipt 3 rendered\n")
+            handler.handle(self.make_record("Receipt %s rendered", 4))
+        finally:
+            handler.close()
+        self.assertEqual(stream.getvalue(), "Receipt 3 rendered\nReceipt 4 rendered\n")
+
+    def test_request_id_of_payment(self):
+        profile = Profile.objects.create(user=User.objects.create(username="test"), telegram_chat_id="1111111")
+        card = Card.objects.create(owner=profile, _card_uid="b2af5522", _balance=100)
+        company = Company.objects.create(name="Company")
+        company.generate_token()
+        records = []
+        handler = logging.Handler()
+        handler.addFilter(RequestIdFilter())
+        handler.emit = records.append
+        logging.getLogger().addHandler(handler)
+        try:
+            body = {"card_uid": card.card_uid, "amount": 10, "company_token": company.company_token}
+            response = Client().post("/terminal_api/write_off_money/", body, headers={"X-Request-ID": "terminal-1"})
+            generated = Client().post("/terminal_api/write_off_money/", body, headers={"X-Request-ID": "bad id!"})
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+        self.assertEqual(response["X-Request-ID"], "terminal-1")
+        self.assertRegex(generated["X-Request-ID"], r"^[0-9a-f]{32}$")
+        messages = {record.getMessage(): record.request_id for record in records}
+        self.assertEqual(
+            messages[f"Payment transaction made with id: {response.json()['transaction_id']}"], "terminal-1"
+        )
+
+
+class WriteOffMoneyIdempotencyTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = "/terminal_api/write_off_money/"
+
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        profile = Profile.objects.create(user=user)
+        self.card = Card.objects.create(owner=profile, _card_uid="b2af5522", _balance=100)
+        self.company = Company.objects.create(name="Company")
+        self.company.generate_token()
+        self.body = {"card_uid": self.card.card_uid, "amount": 10, "company_token": self.company.company_token}
+
+    def test_retry_replays_response(self):
+        headers = {"Idempotency-Key": "4c1e7a0f-3a8d-4c43-9a55-2f0f6a1c1b11"}
+        response = self.client.post(self.url, self.body, headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        with CaptureQueriesContext(connection) as context:
+            retry_response = self.client.post(self.url, self.body, headers=headers)
+
+        self.assertEqual(retry_response.status_code, 200)
+        self.assertEqual(retry_response.json(), response.json())
+        self.assertEqual(retry_response.headers["Idempotent-Replayed"], "true")
+        for query in context.captured_queries:
+            self.assertNotIn("database_models_card", query["sql"])
+            self.assertNotIn("database_models_company", query["sql"])
+
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(90))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_retry_replays_error_response(self):
+        body = {**self.body, "amount": 1000, "nonce": "1"}
+        self.assertEqual(self.client.post(self.url, body).status_code, 400)
+
+        self.card.balance = 2000
+        self.card.save()
+        response = self.client.post(self.url, body)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_key_reused_with_another_payment(self):
+        headers = {"Idempotency-Key": "payment-1"}
+        self.assertEqual(self.client.post(self.url, self.body, headers=headers).status_code, 200)
+
+        response = self.client.post(self.url, {**self.body, "amount": 50}, headers=headers)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()["terminal_message"], "Key is reused")
+        self.assertNotIn("Idempotent-Replayed", response.headers)
+
+        # the same payment with amount written in other way is replayed
+        retry_body = {**self.body, "amount": "10.00", "card_uid": self.card.card_uid.upper()}
+        retry_response = self.client.post(self.url, retry_body, content_type="application/json", headers=headers)
+        self.assertEqual(retry_response.status_code, 200)
+        self.assertEqual(retry_response.headers["Idempotent-Replayed"], "true")
+
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(90))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_key_stored_without_hash_is_replayed(self):
+        self.client.post(self.url, {**self.body, "nonce": "1"})
+        IdempotencyKey.objects.update(request_hash="")
+        response = self.client.post(self.url, {**self.body, "amount": 20, "nonce": "1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_different_keys_are_different_payments(self):
+        self.client.post(self.url, {**self.body, "nonce": "1"})
+        self.client.post(self.url, {**self.body, "nonce": "2"})
+
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(80))
+
+    def test_too_long_key(self):
+        response = self.client.post(self.url, self.body, headers={"Idempotency-Key": "k" * 65})
+        self.assertEqual(response.status_code, 400)
+
+    def test_purge_old_keys(self):
+        self.client.post(self.url, {**self.body, "nonce": "1"})
+        IdempotencyKey.objects.update(created=timezone.now() - timedelta(hours=25))
+        self.client.post(self.url, {**self.body, "nonce": "2"})
+
+        call_command("purge_idempotency_keys", "--ttl-hours", "24", stdout=StringIO())
+        self.assertEqual(list(IdempotencyKey.objects.values_list("key", flat=True)), ["2"])
+
+
+class BatchWriteOffMoneyTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = "/terminal_api/batch_write_off_money/"
+
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        profile = Profile.objects.create(user=user, telegram_chat_id="1111111")
+        self.card = Card.objects.create(owner=profile, _card_uid="b2af5522", _balance=100)
+        self.card1 = Card.objects.create(owner=profile, _card_uid="c3bf6633", _balance=5)
+        self.company = Company.objects.create(name="Company")
+        self.company.generate_token()
+
+    def post_batch(self, payments: list[dict], company_token: str | None = None):
+        body = {"company_token": company_token or self.company.company_token, "payments": payments}
+        return self.client.post(self.url, body, content_type="application/json")
+
+    def test_incorrect_request_body(self):
+        self.assertEqual(self.post_batch([]).status_code, 400)
+
+    def test_incorrect_company_token(self):
+        response = self.post_batch([{"card_uid": self.card.card_uid, "amount": 10}], company_token="1")
+        self.assertEqual(response.status_code, 404)
+
+    def test_correct_request(self):
+        payments = [
+            {"card_uid": self.card.card_uid, "amount": 10},
+            {"card_uid": self.card1.card_uid, "amount": 10},
+            {"card_uid": "ffffffff", "amount": 10},
+            {"card_uid": self.card.card_uid, "amount": "abc"},
+            {"card_uid": self.card.card_uid.upper(), "amount": "20.50"},
+        ]
+        response = self.post_batch(payments)
+        self.assertEqual(response.status_code, 200)
+
+        results = response.json()["results"]
+        self.assertEqual([result["status"] for result in results], [200, 400, 404, 400, 200])
+        self.assertEqual(results[1]["terminal_message"], "Balance is low")
+
+        first_transaction = Transaction.objects.get(id=results[0]["transaction_id"])
+        self.assertEqual(first_transaction.card_balance_before, Decimal(100))
+        self.assertEqual(first_transaction.card_balance_after, Decimal(90))
+        self.assertEqual(first_transaction.receipt.id, results[0]["receipt_id"])
+        self.assertEqual(first_transaction.receipt.data["title"], "Company")
+        self.assertEqual(first_transaction.receipt.data["amount"], "10")
+
+        last_transaction = Transaction.objects.get(id=results[4]["transaction_id"])
+        self.assertEqual(last_transaction.card_balance_before, Decimal(90))
+        self.assertEqual(last_transaction.card_balance_after, Decimal("69.50"))
+        self.assertEqual(last_transaction.company_balance_after, Decimal("30.50"))
+
+        self.card.refresh_from_db()
+        self.card1.refresh_from_db()
+        self.company.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal("69.50"))
+        self.assertEqual(self.card1.balance, Decimal(5))
+        self.assertEqual(self.company.get_balance(), Decimal("30.50"))
+        self.assertEqual(Notification.objects.filter(kind="receipt").count(), 2)
+
+    def test_reupload_replays_results(self):
+        payments = [
+            {"card_uid": self.card.card_uid, "amount": 10, "nonce": "tap-1"},
+            {"card_uid": self.card.card_uid, "amount": 10, "nonce": "tap-1"},
+            {"card_uid": self.card.card_uid, "amount": 10, "nonce": "tap-2"},
+        ]
+        results = self.post_batch(payments).json()["results"]
+        self.assertEqual(results[0], results[1])
+
+        payments.append({"card_uid": self.card.card_uid, "amount": 10, "nonce": "tap-3"})
+        reupload_results = self.post_batch(payments).json()["results"]
+        self.assertEqual(reupload_results[:3], results)
+        self.assertEqual(reupload_results[3]["status"], 200)
+
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(70))
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_nonce_reused_with_another_payment(self):
+        payments = [
+            {"card_uid": self.card.card_uid, "amount": 10, "nonce": "tap-1"},
+            {"card_uid": self.card.card_uid, "amount": 20, "nonce": "tap-1"},
+        ]
+        results = self.post_batch(payments).json()["results"]
+        self.assertEqual([result["status"] for result in results], [200, 422])
+
+        reupload = [{"card_uid": self.card.card_uid, "amount": 30, "nonce": "tap-1"}, payments[0]]
+        reupload_results = self.post_batch(reupload).json()["results"]
+        self.assertEqual(reupload_results[0]["status"], 422)
+        self.assertEqual(reupload_results[1], results[0])
+
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(90))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_queries_do_not_depend_on_batch_size(self):
+        payments = [{"card_uid": self.card.card_uid, "amount": 1, "nonce": f"tap-{i}"} for i in range(50)]
+        with CaptureQueriesContext(connection) as context:
+            response = self.post_batch(payments)
+        self.assertEqual(response.status_code, 200)
+
+        queries = [query["sql"] for query in context.captured_queries if "SAVEPOINT" not in query["sql"]]
+        self.assertLessEqual(len(queries), 11, queries)
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.balance, Decimal(50))
+        self.assertEqual(LedgerEntry.objects.filter(kind="payment").count(), 100)
+
+
+class WriteOffMoneyConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        self.url = "/terminal_api/write_off_money/"
+
+        user = User.objects.create(username="testname", email="test@gmail.com")
+        profile = Profile.objects.create(user=user)
+        self.card = Card.objects.create(owner=profile, _card_uid="b2af5522", _balance=100)
+        self.company = Company.objects.create(name="Company")
+        self.company.generate_token()
+
+    def test_concurrent_payments_do_not_overdraw_card(self):
+        body = {"card_uid": self.card.card_uid, "amount": 7, "company_token": self.company.company_token}
+        barrier = threading.Barrier(30)
+        status_codes = []
+
+        def pay():
+            try:
+                client = Client()
+                barrier.wait()
+                status_codes.append(client.post(self.url, body).status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=pay) for _ in range(30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.card.refresh_from_db()
+        self.company.refresh_from_db()
+        self.assertEqual(status_codes.count(200), 14)  # 100 // 7
+        self.assertEqual(status_codes.count(400), 16)
+        self.assertEqual(self.card.balance, Decimal(2))
+        self.assertEqual(self.company.get_balance(), Decimal(98))
+        self.assertEqual(Transaction.objects.count(), 14)
+        self.assertEqual(
+            sorted(Transaction.objects.values_list("card_balance_after", flat=True)),
+            [Decimal(100 - 7 * i) for i in range(14, 0, -1)],
+        )
+
+    def test_concurrent_payments_to_one_company(self):
+        profile = self.card.owner
+        cards = [Card.objects.create(owner=profile, _card_uid=f"{i:08x}", _balance=10) for i in range(20)]
+        barrier = threading.Barrier(len(cards))
+        status_codes = []
+
+        def pay(card: Card):
+            try:
+                client = Client()
+                barrier.wait()
+                body = {"card_uid": card.card_uid, "amount": 3, "company_token": self.company.company_token}
+                status_codes.append(client.post(self.url, body).status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=pay, args=(card,)) for card in cards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(status_codes, [200] * 20)
+        self.assertEqual(self.company.get_balance(), Decimal(60))
+        self.assertGreater(self.company.balance_shards.count(), 1)
+
+        call_command("fold_company_balances", stdout=StringIO())
+        self.company.refresh_from_db()
+        self.assertEqual(self.company._balance, Decimal(60))
+        self.assertEqual(self.company.balance_shards.count(), 0)
+
+    def test_concurrent_retries_make_one_payment(self):
+        body = {"card_uid": self.card.card_uid, "amount": 7, "company_token": self.company.company_token}
+        headers = {"Idempotency-Key": "retried-payment"}
+        barrier = threading.Barrier(10)
+        transaction_ids = []
+
+        def pay():
+            try:
+                client = Client()
+                barrier.wait()
+                transaction_ids.append(client.post(self.url, body, headers=headers).json()["transaction_id"])
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=pay) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.card.refresh_from_db()
+        self.assertEqual(len(set(transaction_ids)), 1)
+        self.assertEqual(self.card.balance, Decimal(93))
+        self.assertEqual(Transaction.objects.count(), 1)
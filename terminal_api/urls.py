@@ -2,4 +2,7 @@ from django.urls import path
 
 from . import views
 
-urlpatterns = [path("write_off_money/", views.WriteOffMoney.as_view())]
+urlpatterns = [
+    path("write_off_money/", views.WriteOffMoney.as_view()),
+    path("batch_write_off_money/", views.BatchWriteOffMoney.as_view()),
+]
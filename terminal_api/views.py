@@ -1,133 +1,273 @@
 import logging
-from decimal import Decimal
-from multiprocessing import Process
+from decimal import Decimal, InvalidOperation
 
-from django.contrib.sites.shortcuts import get_current_site
 from django.db import transaction as django_transaction
-from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from rest_framework.request import Request
 from rest_framework.views import APIView
 
-from telegram_bot.bot_send_receipt import run_async_send_receipt_in_process
-from client_api.views import GetCardBalance
-from database_models.models import Card, Company, Receipt, Transaction
+from database_models.balances import (
+    write_off_money,
+    get_write_off_error,
+    write_off_money_batch,
+    get_receipt_render_status,
+)
+from database_models.idempotency import (
+    claim_idempotency_key,
+    claim_idempotency_keys,
+    get_request_hash,
+    is_same_request,
+    save_idempotent_response,
+    save_idempotent_responses,
+)
+from database_models.models import Company, Receipt, Transaction, Notification, IdempotencyKey
+from database_models.utils import check_hex_digit
+from ecoreceipt_api.metrics import stage_timer
+
+
+MAX_BATCH_SIZE = 500
+
+# Error reason: status code, message, message for showing on terminal lcd (max length 16 symbols)
+WRITE_OFF_ERRORS = {
+    "invalid_data": (400, "Error. Incorrect request body.", "Data is invalid"),
+    "card_not_found": (404, "Error. Card UID is incorrect.", "Card is invalid"),
+    "low_balance": (400, "Error. Card balance lower than write off sum.", "Balance is low"),
+    "company_not_found": (404, "Error. There is no registered company with this token.", "Token is invalid"),
+    "idempotency_key_reused": (422, "Error. Idempotency key was sent with another payment.", "Key is reused"),
+}
+
+
+def get_write_off_error_data(error: str) -> dict:
+    _, message, terminal_message = WRITE_OFF_ERRORS[error]
+    return {"success": False, "message": message, "terminal_message": terminal_message}
+
+
+def get_write_off_success_data(transaction: Transaction) -> dict:
+    return {
+        "success": True,
+        "transaction_id": transaction.id,
+        "receipt_id": transaction.receipt.id,
+        "message": "",
+        "terminal_message": "Payment success",
+    }
 
 
 class WriteOffMoney(APIView):
     @django_transaction.atomic
     def post(self, request: Request):
+        # Terminal sends the same key (or nonce) when it retries payment, retry gets stored response
+        idempotency_key = str(request.headers.get("Idempotency-Key") or request.data.get("nonce") or "")
+        company_token = str(request.data.get("company_token") or "")[:15]  # longer tokens are invalid anyway
+
+        if idempotency_key:
+            if len(idempotency_key) > IdempotencyKey._meta.get_field("key").max_length:
+                return Response(data=get_write_off_error_data("invalid_data"), status=400)
+
+            request_hash = get_request_hash(request.data.get("card_uid"), request.data.get("amount"), company_token)
+            stored_key = claim_idempotency_key(idempotency_key, company_token, request_hash)
+            if stored_key is not None and not is_same_request(stored_key, request_hash):
+                logging.log(logging.INFO, "Idempotency key reused with another payment: %s", idempotency_key)
+                error = "idempotency_key_reused"
+                return Response(data=get_write_off_error_data(error), status=WRITE_OFF_ERRORS[error][0])
+            if stored_key is not None:
+                logging.log(logging.INFO, "Replay response for idempotency key: %s", idempotency_key)
+                return Response(
+                    data=stored_key.response_body,
+                    status=stored_key.response_status,
+                    headers={"Idempotent-Replayed": "true"},
+                )
+
+        response = self.make_payment(request)
+        if idempotency_key and response.status_code < 500:
+            save_idempotent_response(idempotency_key, company_token, response.status_code, response.data)
+        return response
+
+    def make_payment(self, request: Request) -> Response:
         try:
             card_uid = request.data.get("card_uid")
             write_off_amount = Decimal(request.data.get("amount", 0))  # TODO: check if write_off_amount is numeric
             company_token = request.data.get("company_token")
             logging.log(
-                logging.INFO,
-                f"Data from request - card_uid: {card_uid}, write_off_amount: {write_off_amount}, company_token: {company_token}",
+                logging.DEBUG,
+                "Data from request - card_uid: %s, write_off_amount: %s, company_token: %s",
+                card_uid,
+                write_off_amount,
+                company_token,
             )
 
-            if card_uid is None or write_off_amount is None or company_token is None:
-                return Response(
-                    data={
-                        "success": False,
-                        "message": "Error. Incorrect request body.",
-                        "terminal_message": "Data is invalid",  # message for showing on terminal lcd (max length 16 symbols)
-                    },
-                    status=400,
-                )
+            if card_uid is None or company_token is None or write_off_amount <= 0:
+                return Response(data=get_write_off_error_data("invalid_data"), status=400)
 
-            response = GetCardBalance().get(request=request, card_uid=card_uid)
-            if response.status_code != 200:
-                return Response(
-                    data={
-                        "success": False,
-                        "message": "Error. Card UID is incorrect.",
-                        "terminal_message": "Card is invalid",
-                    },
-                    status=404,
+            card_uid = card_uid.lower()
+            result = write_off_money(card_uid, company_token, write_off_amount) if check_hex_digit(card_uid) else None
+            if result is None:
+                error = get_write_off_error(card_uid, company_token, write_off_amount)
+                logging.log(logging.INFO, "Payment was not made: %s", error)
+                return Response(data=get_write_off_error_data(error), status=WRITE_OFF_ERRORS[error][0])
+
+            # Receipt is only queued here, render_receipts worker renders it if it is sent to telegram,
+            # otherwise it is rendered when its image is requested. Stage is writing of transaction and receipt rows,
+            # rendering itself is observed by stages of make_receipt operation
+            with stage_timer("write_off_money", "record"):
+                transaction = Transaction()
+                transaction.card_id = result.card_id
+                transaction.company_id = result.company_id
+                transaction.receipt = Receipt.objects.create(
+                    render_status=get_receipt_render_status(result.owner_telegram_chat_id), data=result.receipt_data
                 )
+                transaction.amount = write_off_amount
+                transaction.card_balance_before = result.card_balance_after + write_off_amount
+                transaction.card_balance_after = result.card_balance_after
+                transaction.company_balance_before = result.company_balance_after - write_off_amount
+                transaction.company_balance_after = result.company_balance_after
+                transaction.save()
+            logging.log(logging.INFO, "Payment transaction made with id: %s", transaction.id)
 
-            card_current_balance = response.data["balance"]
-            logging.log(logging.INFO, f"Current user card balance: {card_current_balance}")
+            # Receipt will be sent to telegram after render_receipts worker renders it, if card owner is logged in
+            if result.owner_telegram_chat_id:
+                with stage_timer("write_off_money", "notify"):
+                    Notification.objects.create(
+                        kind=Notification.KINDS["receipt"],
+                        telegram_chat_id=result.owner_telegram_chat_id,
+                        text=f"Card balance: {result.card_balance_after}",
+                        receipt=transaction.receipt,
+                    )
 
-            if Decimal(card_current_balance) < write_off_amount:  # Check if card balance bigger then write off sum
-                return Response(
-                    data={
-                        "success": False,
-                        "message": "Error. Card balance lower than write off sum.",
-                        "terminal_message": "Balance is low",
-                    },
-                    status=400,
-                )
+            return Response(data=get_write_off_success_data(transaction), status=200)
+        except Exception as ex:
+            logging.log(logging.INFO, "WriteOffMoney finished with unexpected error: %s", ex)
+            django_transaction.set_rollback(True)
+            return Response(
+                data={"success": False, "message": f"Error. {str(ex)}.", "terminal_message": "Unexpected error"},
+                status=500,
+            )
 
-            companies = Company.objects.filter(_company_token=company_token)
-            if not companies.count():  # Check if company registered in system
-                return Response(
-                    data={
-                        "success": False,
-                        "message": "Error. There is no registered company with this token.",
-                        "terminal_message": "Token is invalid",
-                    },
-                    status=404,
-                )
 
-            logging.log(logging.INFO, "Start of making payment transaction")
-            card = Card.objects.get(_card_uid=card_uid)
-            company = companies.first()
-
-            transaction = Transaction()
-            transaction.card = card
-            transaction.company = company
-
-            transaction.receipt = Receipt()
-            transaction.receipt.save()
-            transaction.amount = write_off_amount
-            transaction.card_balance_before = card.balance
-            transaction.company_balance_before = company.balance
-
-            card.balance = card.balance - write_off_amount
-            company.balance = company.balance + write_off_amount
-
-            card.save()
-            company.save()
-
-            transaction.card_balance_after = card.balance
-            transaction.company_balance_after = company.balance
-            transaction.save()
-            logging.log(logging.INFO, "End of making payment transaction")
-
-            receipt_path = transaction.receipt.get_receipt_img()
-            logging.log(logging.INFO, f"Generated receipt path: {receipt_path}")
-
-            # If user logged in, then send receipt to telegram bot
-            tokens = Token.objects.filter(user=card.owner.user)
-            logging.log(logging.INFO, f"Check if user logged in system by tokens: {tokens}")
-            if tokens.count() != 0:
-                logging.log(logging.INFO, "Making subprocess for async sending receipt image in telegram bot")
-                request_site = get_current_site(request)
-                logging.log(logging.INFO, f"Current site: {request_site.domain}")
-                process = Process(
-                    target=run_async_send_receipt_in_process,
-                    args=(
-                        f"http://{request_site.domain}/media/{receipt_path}",
-                        card.owner.telegram_chat_id,
-                        f"Card balance: {card.balance}",
-                    ),
+class BatchWriteOffMoney(APIView):
+    """Upload of card taps which terminal queued while it was offline.
+
+    Every payment may have a nonce, so the batch can be uploaded again after a failed upload.
+    Payments are applied in order in one db transaction, with constant count of queries for the whole batch.
+
+    """
+
+    @django_transaction.atomic
+    def post(self, request: Request):
+        try:
+            company_token = request.data.get("company_token")
+            payments = request.data.get("payments")
+            logging.log(logging.DEBUG, "Batch from request - company_token: %s", company_token)
+
+            if company_token is None or not isinstance(payments, list) or not 0 < len(payments) <= MAX_BATCH_SIZE:
+                return Response(data=get_write_off_error_data("invalid_data"), status=400)
+
+            company = Company.objects.select_for_update(no_key=True).filter(_company_token=company_token).first()
+            if company is None:
+                return Response(data=get_write_off_error_data("company_not_found"), status=404)
+
+            nonces = [self.get_nonce(payment) for payment in payments]
+            request_hashes = [self.get_request_hash(payment, company_token) for payment in payments]
+            first_hashes = {}  # nonce: request hash of first payment with it
+            for nonce, request_hash in zip(nonces, request_hashes):
+                if nonce:
+                    first_hashes.setdefault(nonce, request_hash)
+            claimed_keys, stored_keys = claim_idempotency_keys(list(first_hashes), company_token, first_hashes)
+
+            results: list[tuple[int, dict] | None] = [None] * len(payments)
+            first_indexes = {}  # nonce: index of first payment with it
+            write_offs = []  # (index, card_uid, amount)
+            reused_key = (
+                WRITE_OFF_ERRORS["idempotency_key_reused"][0],
+                get_write_off_error_data("idempotency_key_reused"),
+            )
+            for index, (payment, nonce, request_hash) in enumerate(zip(payments, nonces, request_hashes)):
+                if nonce in stored_keys:
+                    stored_key = stored_keys[nonce]
+                    if is_same_request(stored_key, request_hash):
+                        results[index] = (stored_key.response_status, stored_key.response_body)
+                    else:
+                        results[index] = reused_key
+                elif nonce in first_indexes:  # the same tap twice in one batch, result is taken from the first
+                    if request_hash != first_hashes[nonce]:
+                        results[index] = reused_key
+                    continue
+                elif nonce is None:
+                    results[index] = (400, get_write_off_error_data("invalid_data"))
+                else:
+                    if nonce:
+                        first_indexes[nonce] = index
+                    write_off = self.parse_write_off(payment)
+                    if write_off is None:
+                        results[index] = (400, get_write_off_error_data("invalid_data"))
+                    else:
+                        write_offs.append((index, *write_off))
+
+            transactions = write_off_money_batch(company, [(card_uid, amount) for _, card_uid, amount in write_offs])
+            for (index, _, _), transaction in zip(write_offs, transactions):
+                if isinstance(transaction, Transaction):
+                    results[index] = (200, get_write_off_success_data(transaction))
+                else:
+                    results[index] = (WRITE_OFF_ERRORS[transaction][0], get_write_off_error_data(transaction))
+
+            for index, nonce in enumerate(nonces):
+                if results[index] is None:
+                    results[index] = results[first_indexes[nonce]]
+
+            # Receipts will be sent to telegram after render_receipts worker renders them
+            Notification.objects.bulk_create(
+                [
+                    Notification(
+                        kind=Notification.KINDS["receipt"],
+                        telegram_chat_id=transaction.card.owner.telegram_chat_id,
+                        text=f"Card balance: {transaction.card_balance_after}",
+                        receipt=transaction.receipt,
+                    )
+                    for transaction in transactions
+                    if isinstance(transaction, Transaction) and transaction.card.owner.telegram_chat_id
+                ]
+            )
+            if claimed_keys:
+                save_idempotent_responses(
+                    claimed_keys, {nonce: results[first_indexes[nonce]] for nonce in claimed_keys}
                 )
-                process.start()
 
+            logging.log(logging.INFO, "Batch of %s payments applied to %s", len(payments), company.name)
             return Response(
                 data={
                     "success": True,
-                    "transaction_id": transaction.id,
+                    "results": [{"status": status, **data} for status, data in results],
                     "message": "",
-                    "terminal_message": "Payment success",
                 },
                 status=200,
             )
         except Exception as ex:
-            logging.log(logging.INFO, f"WriteOffMoney finished with unexpected error: {str(ex)}")
+            logging.log(logging.INFO, "BatchWriteOffMoney finished with unexpected error: %s", ex)
+            django_transaction.set_rollback(True)
             return Response(
                 data={"success": False, "message": f"Error. {str(ex)}.", "terminal_message": "Unexpected error"},
                 status=500,
             )
+
+    @staticmethod
+    def get_nonce(payment) -> str | None:
+        """Nonce of payment, empty string if payment has no nonce and None if nonce is invalid"""
+        nonce = str(payment.get("nonce") or "") if isinstance(payment, dict) else ""
+        return nonce if len(nonce) <= IdempotencyKey._meta.get_field("key").max_length else None
+
+    @staticmethod
+    def get_request_hash(payment, company_token: str) -> str:
+        if not isinstance(payment, dict):
+            return get_request_hash(None, None, company_token)
+        return get_request_hash(payment.get("card_uid"), payment.get("amount"), company_token)
+
+    @staticmethod
+    def parse_write_off(payment) -> tuple[str, Decimal] | None:
+        if not isinstance(payment, dict) or not isinstance(payment.get("card_uid"), str):
+            return None
+        try:
+            amount = Decimal(str(payment.get("amount", 0)))
+        except InvalidOperation:
+            return None
+        if not amount.is_finite() or amount <= 0:
+            return None
+        return payment["card_uid"].lower(), amount